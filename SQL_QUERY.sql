@@ -1,2 +1,11 @@
 SELECT * from operation_log_battery_1 ORDER BY time_control DESC LIMIT 40;
-SELECT * from operation_log_control_1 ORDER BY time_control DESC LIMIT 40;
\ No newline at end of file
+SELECT * from operation_log_control_1 ORDER BY time_control DESC LIMIT 40;
+SELECT * from operation_log_parameters_control_1 ORDER BY time_control DESC LIMIT 40;
+-- Latency of the control loop per stage (DB manager in collector mode, see latency_report.py)
+SELECT stage, count(*), percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY latency) from latency_traces GROUP BY stage;
+-- Hypertable schema (dbmanager_mqtt.py --dbschema hypertable): the channels are ids, the views have the names
+SELECT * from operation_log_control_1_view ORDER BY time_control DESC LIMIT 40;
+-- Recent values of one channel: index scan on (channel_id, time_control DESC)
+SELECT time_control, values_channel from operation_log_control_1 WHERE channel_id = (SELECT channel_id from channels WHERE channel = 'forecast') ORDER BY time_control DESC LIMIT 40;
+-- Size on disk before/after the compression
+SELECT * from hypertable_compression_stats('operation_log_control_1');
@@ -2,11 +2,19 @@ import paho.mqtt.client as mqtt
 import pandas as pd
 import json
 import time
-from commons.parameters import BatteryParameters, ControlParameters, Topics, bcolors
+from commons.parameters import BatteryParameters, ControlParameters, Topics
+from commons.message_view import TimeSeriesView
 from commons.SMABattery import SMABattery
+from commons.module_runtime import ModuleRuntime
+from commons.tracing import Stages, StageHistograms, stamp
+from commons.publisher import Publisher, SUPERSEDED, BEST_EFFORT
+from commons.wire_format import payload_summary
+from commons.log import get_logger, configure, lazy, LEVELS
 import argparse
-import schedule
 import datetime
+import os
+
+log = get_logger('battery')
 
 """
 Mapping of the variables names between BatteryModule and SMAModule:
@@ -67,9 +75,8 @@ class BatteryModule:
             self.battery_params[BatteryParameters.MAX_POWER_DISCHARGE] = -self.sma_battery.MAX_DISCHARGE_VALUE / 1000.0
             self.battery_params[BatteryParameters.MAX_POWER_CHARGE] = self.sma_battery.MAX_CHARGE_VALUE / 1000.0
 
-            print(f"Current SoC from SMA: {self.battery_params[BatteryParameters.SOC_INI_ACTUAL]}")
-            print(f"Current POWER OUTPUT from SMA: {self.power_output}  [kW]")
-            print(f"Current POWER OUTPUT from SMA: {self.battery_params[BatteryParameters.POWER_OUTPUT]}  [kW]")
+            log.debug('sma_status', soc=self.battery_params[BatteryParameters.SOC_INI_ACTUAL],
+                      power_output_kw=self.power_output)
 
         return self.battery_params
 
@@ -78,13 +85,15 @@ class BatteryModule:
 
         if set(kwargs.keys()).issubset(BatteryParameters.VALID_KEYS):
             self.battery_params.update(kwargs)
-            print(f"Parameters updated: {kwargs}")
+            log.info('battery_parameters_updated', parameters=lazy(str, kwargs))
         else:
-            print("One of the dictionary keys is not valid")
+            log.warning('invalid_battery_parameters',
+                        keys=lazy(sorted, set(kwargs.keys()) - set(BatteryParameters.VALID_KEYS)))
 
     def set_emergency_solutions(self, emergency_solutions):
-        """Get the last optimal set points in case the battery lost connection"""
-        assert isinstance(emergency_solutions, pd.DataFrame)
+        """Get the last optimal set points in case the battery lost connection.
+        A TimeSeriesView is kept as it is, the data frame is only built with emergency_solutions.to_frame()"""
+        assert isinstance(emergency_solutions, (pd.DataFrame, TimeSeriesView))
 
         self.emergency_solutions = emergency_solutions
 
@@ -95,14 +104,13 @@ class BatteryModule:
         if ((new_power_output >= -max_power_discharge) & (new_power_output <= max_power_charge)):
             if self.enable_sma:
                 self.sma_battery.changePower(new_power_output * 1000)  # Power in Watts to the inverter of the battery
-                print(f"Power output updated on the inverter: {new_power_output} [kW]")
-            else:
-                print(f"Power output updated: {new_power_output} [kW]")
+            log.debug('power_output_updated', power_output_kw=new_power_output, inverter=self.enable_sma)
 
             self.power_output = new_power_output
             self.battery_params[BatteryParameters.POWER_OUTPUT] = new_power_output
         else:
-            print('New power output outside battery limits. OUTPUT POWER WAS NOT UPDATED!!!')
+            log.warning('power_output_out_of_limits', power_output_kw=new_power_output,
+                        max_power_discharge=max_power_discharge, max_power_charge=max_power_charge)
 
     def simulate_battery_operation(self, delta_t_sim=1):
         """
@@ -125,9 +133,9 @@ class BatteryModule:
 
         if (future_charge >= minimum_charge) & (future_charge <= maximum_charge):
             self.battery_params[BatteryParameters.SOC_INI_ACTUAL] += delta_change_charge
-            print(f"Battery changed!!! New SoC: {round(self.battery_params[BatteryParameters.SOC_INI_ACTUAL], 3)}")
-        else:
-            print("Battery limits exceeded (totally full or discharged), battery SoC stays the same.")
+            log.debug('soc_updated', soc=round(self.battery_params[BatteryParameters.SOC_INI_ACTUAL], 3))
+        else:  # Totally full or discharged
+            log.warning('soc_limit_reached', soc=round(current_charge, 3), rate_limit=60.0)
 
 
 class BatteryMQTT(BatteryModule, mqtt.Client):
@@ -147,24 +155,25 @@ class BatteryMQTT(BatteryModule, mqtt.Client):
         BatteryModule.__init__(self, id=battery_id, enable_sma=enable_sma, modbus_ip=modbus_ip, modbus_port=modbus_port)
         mqtt.Client.__init__(self, client_id=client_id_mqtt)
 
-        self.topics = Topics
-
-        # Subscribe
-        self.topics.controller_set_battery_power_topic += f"battery_{battery_id}"
-        self.topics.user_set_battery_parameters_topic += f"battery_{battery_id}"
-
-        # Publish
-        self.topics.battery_settings_topic += f"battery_{battery_id}"
+        self.topics = Topics.table(# Subscribe
+                                   controller_set_battery_power_topic=f"battery_{battery_id}",
+                                   user_set_battery_parameters_topic=f"battery_{battery_id}",
+                                   # Publish
+                                   battery_settings_topic=f"battery_{battery_id}",
+                                   latency_trace=f"battery_{battery_id}")
+        self.latency = StageHistograms()  # Latency of the traced set points (see commons.tracing)
+        self.publisher = Publisher(self, policies={self.topics.battery_settings_topic: SUPERSEDED,  # Status reports
+                                                   self.topics.latency_trace: BEST_EFFORT})
 
         self.qos = 1  # QoS of the MQTT messages
         self.connect(host=mqtt_server_ip,
                      port=mqtt_server_port)
 
     def on_connect(self, mqtt, obj, flags, rc):
-        print("Connected with result code " + str(rc))
+        log.info('connected', client_id=self._client_id.decode('utf-8'), rc=rc)
 
         # Subscriber topics
-        print(f"Subscribing to: {self.topics.controller_set_battery_power_topic}")
+        log.info('subscribe', topic=self.topics.controller_set_battery_power_topic)
         self.subscribe(self.topics.controller_set_battery_power_topic, self.qos)
 
         # # Send the battery parameters to the controller for the first time
@@ -176,29 +185,24 @@ class BatteryMQTT(BatteryModule, mqtt.Client):
 
     def on_message(self, client, userdata, msg):
         is_command_processed = False
-        print("--" * 100)
-        print(bcolors.OKGREEN + f"Message received on topic: {msg.topic}" + bcolors.ENDC)
+        log.debug('message_received', topic=msg.topic, size=len(msg.payload))
         # TODO: Check that all incomming messages are not empty
 
         if msg.topic == self.topics.controller_set_battery_power_topic:  # Received a new power set point
-            print(bcolors.OKGREEN + "Receiving power set point" + bcolors.ENDC)
-            received_message = msg.payload.decode('utf-8')
-
-            if received_message:  # Set point of power from te controller has a time stamp
-                received_message_frame = pd.read_json(received_message,
-                                                      convert_dates=[ControlParameters.DATE_STAMP_OPTIMAL])
-                received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL,
-                                                                          drop=True)
-                new_battery_power_set_point = received_message_frame[ControlParameters.BATTERY_POWER_OPTIMAL][0]
+            if msg.payload:  # Set point of power from te controller has a time stamp (binary or JSON message)
+                received_message = TimeSeriesView.from_payload(msg.payload,
+                                                               date_column=ControlParameters.DATE_STAMP_OPTIMAL)
+                new_battery_power_set_point = received_message.first(ControlParameters.BATTERY_POWER_OPTIMAL)
                 self.set_power_output(new_battery_power_set_point)
-                self.set_emergency_solutions(received_message_frame)
+                self.set_emergency_solutions(received_message)
+                if received_message.trace is not None:
+                    self.finish_trace(received_message.trace)
                 is_command_processed = True
             else:
-                print(bcolors.FAIL + "Empty message received" + bcolors.ENDC)
+                log.warning('empty_message', topic=msg.topic)
                 is_command_processed = False
 
         elif msg.topic == self.topics.user_set_battery_parameters_topic:
-            print(bcolors.OKGREEN + "Receiving new battery parameters from user" + bcolors.ENDC)
             received_message = msg.payload.decode('utf-8')
 
             if received_message:
@@ -207,23 +211,29 @@ class BatteryMQTT(BatteryModule, mqtt.Client):
                 self.publish_response(topic=self.topics.battery_settings_topic, payload=received_message_dict)
                 is_command_processed = True
             else:
-                print(bcolors.FAIL + "Empty message received" + bcolors.ENDC)
+                log.warning('empty_message', topic=msg.topic)
                 is_command_processed = False
 
-        if is_command_processed:
-            print("All messages processed")
-        else:
-            print("Something went wrong")
+        if not is_command_processed:
+            log.warning('message_not_processed', topic=msg.topic)
 
     def publish_response(self, topic, payload):
-        print(bcolors.OKBLUE + f"Publishing on topic: {topic}" + bcolors.ENDC)
-        result_mqtt = self.publish(topic=topic, payload=payload)
-
-        return result_mqtt
+        log.debug('publish', topic=topic, payload=lazy(payload_summary, payload))
+        self.publisher.publish(topic, payload)
 
     def process_mqtt_messages(self):
         self.loop()
 
+    def finish_trace(self, trace):
+        """The set point was applied: record the latency and send the trace to the collector (DB manager)"""
+        stamp(trace, Stages.BATTERY_APPLY)
+        self.latency.record(trace)
+        self.publisher.publish(self.topics.latency_trace, json.dumps(trace))
+
+    def print_latency_summary(self):
+        if self.latency.traces:
+            self.latency.print_summary(f"Latency per stage, battery {self.id}")
+
     # def simulate_heart_beat(self, delta_t_sim):
     #     self.simulate_battery_operation(delta_t_sim=delta_t_sim)  # Charge/Discharge the battery
     #     battery_parameters_dict = self.get_battery_parameters()
@@ -253,13 +263,6 @@ class BatteryMQTT(BatteryModule, mqtt.Client):
         #                       payload=message_dict)
 
 
-def scheduler_simulation_job(battery_instance):
-    battery_instance.virtual_battery_operation()
-
-def scheduler_report_battery_statys_job(battery_instance):
-    battery_instance.send_battery_parameters()
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
@@ -284,6 +287,9 @@ if __name__ == '__main__':
                         help="Delay time for reporting the battery parameters/status.")
     parser.add_argument('--smatest', required=False, default=True, action='store_false',
                         help="Test the operation of the inverter via the docker container")
+    parser.add_argument('--log-level', required=False, type=str, default=None, choices=LEVELS,
+                        help="Level of the log. DEBUG logs every message and its payload. Default: the environment "
+                             "variable LOG_LEVEL or INFO.")
 
     args, unknown = parser.parse_known_args()
 
@@ -294,6 +300,8 @@ if __name__ == '__main__':
     print(f"Enable inverter: {args.enableinverter}")
     print(f"Simulation every: {args.simdelay} seconds")
     print(f"Report battery parameters every: {args.statusdelay} seconds")
+    print(f"Log level: {args.log_level or os.environ.get('LOG_LEVEL', 'INFO')}")
+    configure(args.log_level)
 
     battery = BatteryMQTT(battery_id=args.batteryid,
                           client_id_mqtt=args.clientid,
@@ -321,21 +329,23 @@ if __name__ == '__main__':
             time.sleep(1)
 
 
+    runtime = ModuleRuntime()
+    runtime.add_client(battery)
+    runtime.add_stop_callback(battery.print_latency_summary)
+    runtime.add_stop_callback(battery.publisher.close)
+
     if args.enableinverter and args.mode == 0:
         print(f"SMA enabled. BUT IN SIMULATION MODE! -- Sim delay: {args.simdelay} seconds")
-        schedule.every(args.simdelay).seconds.do(scheduler_simulation_job, battery_instance=battery)
+        runtime.every(args.simdelay, battery.virtual_battery_operation)
     elif args.enableinverter and args.mode == 1:
         # Real operation of the battery.
         print(f"SMA enabled. Controlling in real life!! -- Reporting battery status every: {args.statusdelay} seconds.")
-        schedule.every(args.statusdelay).seconds.do(scheduler_report_battery_statys_job, battery_instance=battery)
+        runtime.every(args.statusdelay, battery.send_battery_parameters)
     elif not args.enableinverter and args.mode == 0:
         print(f"SMA disabled (Simulation mode). Controlling a VIRTUAL battery!! -- Sim delay: {args.simdelay} seconds")
-        schedule.every(args.simdelay).seconds.do(scheduler_simulation_job, battery_instance=battery)
-        schedule.every(args.statusdelay).seconds.do(scheduler_report_battery_statys_job, battery_instance=battery)
+        runtime.every(args.simdelay, battery.virtual_battery_operation)
+        runtime.every(args.statusdelay, battery.send_battery_parameters)
     else:
         raise ValueError("Can not disable inverter and control the real battery at the same time. Check input arguments.")
 
-
-    while True:
-        battery.process_mqtt_messages()
-        schedule.run_pending()
\ No newline at end of file
+    runtime.run()
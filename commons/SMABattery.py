@@ -37,6 +37,10 @@ from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder
 import argparse
 import json
+from commons.log import get_logger
+
+log = get_logger('sma')
+
 
 class SMABattery:
     MODBUS_IP = '192.168.105.20'
@@ -63,28 +67,25 @@ class SMABattery:
         try:
             self.sunSpecClient = clientSunspec.SunSpecClientDevice(clientSunspec.TCP, 126, ipaddr=self.MODBUS_IP, ipport=self.MODBUS_PORT, timeout=2.0)
             self.modbusClient = ModbusClient(self.MODBUS_IP, port=self.MODBUS_PORT, unit_id=3 , auto_open=True, auto_close=True)
-            print("Connection sucessful!")
+            log.info('sma_connected', ip=self.MODBUS_IP, port=self.MODBUS_PORT)
             return True
         except:
-            print("Error connecting to the inverter")
+            log.error('sma_connection_failed', ip=self.MODBUS_IP, port=self.MODBUS_PORT)
             return False
 
     def changePower(self, power):  # Input power in Watts.
-        print(f"changePower {power}")
         limited = self.__limit(power, self.MAX_DISCHARGE_VALUE, self.MAX_CHARGE_VALUE)
         self.SETPOINT = limited
-        print(f"__limit result: {limited}")
-        
-        print("/changePower")
+        log.debug('sma_change_power', power_w=power, limited_w=limited)
 
     def send_scheduled(self):
-        print("Start scheduled sending")
+        log.info('sma_scheduled_sending')
         # 40149 Active power setpoint - int32
         # 40151 Eff./reac. pow. contr. via comm. 802 = "active" 803 = "inactive", ENUM - uint32
         # 40153 Reactive power setpoint - uint32
         # 0x0322 is the value (802) to activate the control of power via modbus communication
         while True:
-            print(f"Sending... {self.SETPOINT}W")
+            log.debug('sma_send_set_point', set_point_w=self.SETPOINT)
             self.__sendModbus(self.ACTIVATE_CONTROL_ADDRESS, 0x0322, "uint32")
             self.__sendModbus(self.CHANGE_POWER_ADDRESS, self.SETPOINT, "int32")
             time.sleep(5)
@@ -108,12 +109,11 @@ class SMABattery:
         return int(max(min(num, maximum), minimum))
 
     def __sendModbus(self, address, value, type):
-        print("__sendModbus")
         try:
             if(self.modbusClient.connect() == False):
-                print("Modbus connection lost, trying to reconnect...")
+                log.warning('modbus_connection_lost')
                 self.modbusClient = ModbusClient(self.MODBUS_IP, port=self.MODBUS_PORT, unit_id=3 , auto_open=True, auto_close=True)
-                print("Modbus Connected: {}".format(self.modbusClient.connect()))
+                log.info('modbus_reconnect', connected=self.modbusClient.connect())
             else:
                 # SMA expects everything in Big Endian format
                 builder = BinaryPayloadBuilder(byteorder=Endian.Big, wordorder=Endian.Big)
@@ -125,11 +125,10 @@ class SMABattery:
                 registers = builder.to_registers()
                 self.modbusClient.write_registers(address, registers, unit=3)
         except:
-            print("sending failed. trying reconnect and resend")
+            log.warning('modbus_send_failed', address=address, rate_limit=10.0)  # Reconnect and send again
             self.connect()
             time.sleep(1)
             self.__sendModbus(address, value, type)
-        print("/__sendModbus")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""
+Delta-encoded stream of a rolling time series window (e.g., the forecast of the simulation mode).
+
+Between two publications the window only shifts by a few samples. The sender publishes a keyframe (the full window)
+every 'keyframe_interval' messages (or when the new window is not a shift of the previous one) and, in between, only
+the samples appended at the end of the window. The receiver keeps the window in a ring buffer and rebuilds it.
+
+Both messages are binary frames (see commons.wire_format) with the entries 'stream', 'seq', 'shift' and 'window' in
+the meta data. A receiver that misses a message (sequence gap) drops the deltas until the next keyframe.
+"""
+
+from commons.wire_format import encode_frame, parse_binary, is_binary, HEADER, TRACE_KEY
+from commons.message_view import TimeSeriesView
+import numpy as np
+import pandas as pd
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+KEYFRAME = 'key'
+DELTA = 'delta'
+
+
+def is_stream(payload):
+    """True if the payload is a keyframe or a delta of a stream"""
+    if not is_binary(payload):
+        return False
+
+    meta_length = HEADER.unpack_from(payload)[-1]
+
+    return b'"stream"' in bytes(payload[HEADER.size:HEADER.size + meta_length])
+
+
+class StreamEncoder:
+    def __init__(self, keyframe_interval=96, float_dtype=np.float64):
+        """
+        Parameters:
+        -----------
+            keyframe_interval: int: Messages between two keyframes (a keyframe every 'keyframe_interval' messages).
+            float_dtype: np.dtype: Type used for the float columns (see commons.wire_format.encode_frame).
+        """
+        assert keyframe_interval > 0, "The keyframe interval should be positive"
+        self.keyframe_interval = keyframe_interval
+        self.float_dtype = float_dtype
+        self.sequence = 0
+        self.last_window = None
+        self.messages_since_keyframe = 0
+
+    def encode(self, frame, trace=None):
+        """
+        Parameters:
+        -----------
+            frame: pd.DataFrame or pd.Series: Current window, indexed by regular time stamps.
+            trace: dict: Latency trace of the message (see commons.tracing). None if the message is not traced.
+
+        Returns:
+        --------
+            bytes: Keyframe or delta message.
+        """
+        if isinstance(frame, pd.Series):
+            frame = frame.to_frame()
+
+        shift = self.find_shift(frame)
+        self.sequence += 1
+        extra_meta = {} if trace is None else {TRACE_KEY: trace}
+
+        if (shift is None) or (self.messages_since_keyframe + 1 >= self.keyframe_interval):
+            message = encode_frame(frame, float_dtype=self.float_dtype,
+                                   extra_meta={'stream': KEYFRAME, 'seq': self.sequence, 'shift': 0,
+                                               'window': len(frame), **extra_meta})
+            self.messages_since_keyframe = 0
+        else:
+            message = encode_frame(frame.iloc[len(frame) - shift:], float_dtype=self.float_dtype,
+                                   extra_meta={'stream': DELTA, 'seq': self.sequence, 'shift': shift,
+                                               'window': len(frame), **extra_meta})
+            self.messages_since_keyframe += 1
+
+        self.last_window = frame
+
+        return message
+
+    def find_shift(self, frame):
+        """Number of samples that the window moved since the last message. None if a delta is not possible."""
+        last_window = self.last_window
+        if (last_window is None or len(last_window) != len(frame) or len(frame) < 2 or
+                list(last_window.columns) != list(frame.columns) or last_window.index.name != frame.index.name):
+            return None
+
+        step = frame.index[1] - frame.index[0]
+        if step <= pd.Timedelta(0):
+            return None
+
+        shift = (frame.index[0] - last_window.index[0]) / step
+        if (shift != int(shift)) or not (0 < shift < len(frame)):
+            return None
+        shift = int(shift)
+
+        # The overlapping part should be the same (the values of a forecast could have been updated)
+        if not (np.array_equal(last_window.values[shift:], frame.values[:-shift], equal_nan=True) and
+                last_window.index[shift:].equals(frame.index[:-shift])):
+            return None
+
+        return shift
+
+
+class StreamDecoder:
+    def __init__(self):
+        self.buffer = None  # column name -> np.array (ring buffer)
+        self.head = 0  # Position of the oldest sample of the window in the ring buffer
+        self.start_ns = None  # First time stamp of the window [ns]
+        self.step_ns = None
+        self.tz = None
+        self.index_name = None
+        self.sequence = None
+
+        # Counters
+        self.keyframes = 0
+        self.deltas = 0
+        self.dropped = 0
+
+    def decode(self, payload):
+        """
+        Update the window with a keyframe or a delta.
+
+        Returns:
+        --------
+            TimeSeriesView: Current window. None if the message was dropped (delta without a valid keyframe).
+        """
+        (time_stamps_ns, columns, meta) = parse_binary(payload)
+
+        if meta['stream'] == KEYFRAME:
+            self.buffer = {column: np.array(values) for (column, values) in columns.items()}
+            self.head = 0
+            self.start_ns = int(time_stamps_ns[0])
+            self.step_ns = int(time_stamps_ns[1] - time_stamps_ns[0]) if len(time_stamps_ns) > 1 else None
+            self.tz = meta['tz']
+            self.index_name = meta['index']
+            self.sequence = meta['seq']
+            self.keyframes += 1
+
+            return self.window(trace=meta.get(TRACE_KEY))
+
+        window = meta['window']
+        shift = meta['shift']
+        if (self.buffer is None or meta['seq'] != self.sequence + 1 or self.step_ns is None or
+                len(next(iter(self.buffer.values()))) != window or set(columns) != set(self.buffer) or
+                time_stamps_ns[0] != self.start_ns + window * self.step_ns):
+            self.dropped += 1
+            self.buffer = None  # Out of sync until the next keyframe
+
+            return None
+
+        positions = (self.head + np.arange(shift)) % window
+        for (column, values) in columns.items():
+            self.buffer[column][positions] = values
+        self.head = (self.head + shift) % window
+        self.start_ns += shift * self.step_ns
+        self.sequence = meta['seq']
+        self.deltas += 1
+
+        return self.window(trace=meta.get(TRACE_KEY))
+
+    def window(self, trace=None):
+        window = len(next(iter(self.buffer.values())))
+        time_stamps_ns = self.start_ns + (self.step_ns or 0) * np.arange(window, dtype=np.int64)
+        order = (self.head + np.arange(window)) % window
+
+        return TimeSeriesView(time_stamps_ns, {column: values[order] for (column, values) in self.buffer.items()},
+                              tz=self.tz, index_name=self.index_name, trace=trace)
@@ -0,0 +1,245 @@
+"""
+Inboxes between the MQTT network loop (producer) and a worker thread (consumer).
+
+CoalescingInbox: messages on "latest wins" topics are coalesced: only the newest message per topic is kept until the
+worker takes the pending messages, older ones are counted and dropped. Messages on any other topic are all kept, in
+order.
+
+BoundedInbox: all the messages are kept in order, up to 'max_items' in memory. When the worker does not keep up, the
+backpressure policy decides: BLOCK the producer (the broker then holds the messages), DROP_OLDEST or SPILL the new
+messages to a file on disk, read back in order when the worker caught up.
+
+Like queue.Queue, the worker calls task_done() after processing a batch, so join() waits until all was processed.
+"""
+
+import threading
+import tempfile
+import pickle
+import time
+from collections import OrderedDict, deque
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class CoalescingInbox:
+    def __init__(self, latest_wins_topics=()):
+        self.latest_wins_topics = set(latest_wins_topics)
+        self.pending = OrderedDict()  # topic -> list of payloads, in order of arrival of the topics
+        self.condition = threading.Condition()
+        self.closed = False
+        self.unfinished = 0  # Messages put and not processed yet (coalesced messages are not counted)
+
+        # Counters
+        self.received = 0
+        self.coalesced = 0
+        self.coalesced_per_topic = dict()
+
+    def put(self, topic, payload):
+        with self.condition:
+            self.received += 1
+            if topic in self.latest_wins_topics:
+                if topic in self.pending:
+                    self.coalesced += 1
+                    self.coalesced_per_topic[topic] = self.coalesced_per_topic.get(topic, 0) + 1
+                else:
+                    self.unfinished += 1
+                self.pending[topic] = [payload]
+            else:
+                self.pending.setdefault(topic, []).append(payload)
+                self.unfinished += 1
+            self.condition.notify_all()  # The worker and the callers of join()
+
+    def take_all(self, timeout=None):
+        """
+        Wait until there are messages and take all of them at once.
+
+        Returns:
+        --------
+            OrderedDict: topic -> list of payloads. Empty if the timeout expired. None if the inbox is closed.
+        """
+        with self.condition:
+            while (not self.pending) and (not self.closed):
+                if not self.condition.wait(timeout):
+                    return OrderedDict()
+
+            if self.closed and not self.pending:
+                return None
+
+            batch = self.pending
+            self.pending = OrderedDict()
+
+            return batch
+
+    def task_done(self, batch):
+        """The messages of a batch (from take_all()) were processed"""
+        with self.condition:
+            self.unfinished -= sum(len(payloads) for payloads in batch.values())
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all the messages were processed. Returns False if the timeout expired."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def pending_count(self):
+        with self.condition:
+            return sum(len(payloads) for payloads in self.pending.values())
+
+
+class BoundedInbox:
+    def __init__(self, max_items=1000, policy=BLOCK, spill_dir=None):
+        """
+        Parameters:
+        -----------
+            max_items: int: Items held in memory.
+            policy: str: BLOCK, DROP_OLDEST or SPILL (what put() does when the memory is full).
+            spill_dir: str: Directory of the spill file (SPILL). Default: the temporary directory of the system.
+        """
+        assert max_items > 0, "The inbox should hold at least one item"
+        assert policy in POLICIES, f"Backpressure policy should be one of {POLICIES}"
+        self.max_items = max_items
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.unfinished = 0  # Items put and not processed yet (dropped items are not counted)
+
+        self.spill_file = None  # Items that did not fit in memory (pickled), in order
+        self.spill_read = 0  # Offset of the next item to read back
+        self.spilled_pending = 0
+
+        # Counters
+        self.received = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.blocked_time = 0.0  # Time the producer waited for room [seconds]
+        self.max_depth = 0
+
+    def put(self, item):
+        """Returns False if the item was not queued (inbox closed)"""
+        with self.condition:
+            if self.closed:
+                return False
+            self.received += 1
+
+            if self.spilled_pending or len(self.pending) >= self.max_items:
+                if self.policy == BLOCK:
+                    start = time.perf_counter()
+                    self.condition.wait_for(lambda: len(self.pending) < self.max_items or self.closed)
+                    self.blocked_time += time.perf_counter() - start
+                    if self.closed:  # Closed while waiting: the worker will not process it
+                        self.dropped += 1
+                        return False
+                    self.pending.append(item)
+                elif self.policy == DROP_OLDEST:
+                    self.pending.popleft()
+                    self.pending.append(item)
+                    self.dropped += 1
+                    self.unfinished -= 1
+                else:  # The items spilled before this one are read back first
+                    self.spill(item)
+            else:
+                self.pending.append(item)
+
+            self.unfinished += 1
+            self.max_depth = max(self.max_depth, self.depth())
+            self.condition.notify_all()  # The worker and the callers of join()
+
+        return True
+
+    def spill(self, item):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='inbox_', suffix='.spill', dir=self.spill_dir)
+        self.spill_file.seek(0, 2)
+        pickle.dump(item, self.spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spilled += 1
+        self.spilled_pending += 1
+
+    def unspill(self):
+        """Read back up to max_items spilled items into the memory"""
+        self.spill_file.seek(self.spill_read)
+        while self.spilled_pending and len(self.pending) < self.max_items:
+            self.pending.append(pickle.load(self.spill_file))
+            self.spilled_pending -= 1
+        self.spill_read = self.spill_file.tell()
+
+        if not self.spilled_pending:  # Reuse the file from the start
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_read = 0
+
+    def take_all(self, timeout=None):
+        """
+        Wait until there are items and take the ones in memory at once.
+
+        Returns:
+        --------
+            list: Items in order. Empty if the timeout expired. None if the inbox is closed and empty.
+        """
+        with self.condition:
+            while (not self.pending) and (not self.spilled_pending) and (not self.closed):
+                if not self.condition.wait(timeout):
+                    return []
+
+            if not self.pending and self.spilled_pending:
+                self.unspill()
+
+            if self.closed and not self.pending:
+                return None
+
+            batch = list(self.pending)
+            self.pending.clear()
+            self.condition.notify_all()  # Producers waiting for room
+
+            return batch
+
+    def task_done(self, batch):
+        """The items of a batch (from take_all()) were processed"""
+        with self.condition:
+            self.unfinished -= len(batch)
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all the items were processed. Returns False if the timeout expired."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished <= 0, timeout)
+
+    def close(self):
+        """No more items are accepted. The worker takes the pending ones, then take_all() returns None."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def depth(self):
+        """Items waiting: in memory and spilled"""
+        return len(self.pending) + self.spilled_pending
+
+    def stats(self):
+        with self.condition:
+            return {'policy': self.policy,
+                    'depth': self.depth(),
+                    'max_depth': self.max_depth,
+                    'received': self.received,
+                    'dropped': self.dropped,
+                    'spilled': self.spilled,
+                    'blocked_time': round(self.blocked_time, 3)}
+
+    def release(self):
+        """Delete the spill file"""
+        with self.condition:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+                self.spilled_pending = 0
@@ -0,0 +1,440 @@
+"""
+Minimal local MQTT 3.1.1 broker for integration tests and benchmarks, without an external mosquitto.
+
+Supported: CONNECT (clean sessions, last will), SUBSCRIBE/UNSUBSCRIBE with '+' and '#' wildcards, PUBLISH QoS 0 and 1
+(the QoS granted is at most 1), PINGREQ and the keep alive timeout. Not supported: retained messages (the retain flag is
+ignored), persistent sessions, QoS 2 and authentication (username/password are accepted and not checked).
+
+The broker runs on its own event loop, in a thread (start()/stop()) or in a subprocess (python -m commons.local_broker).
+With port 0 the OS gives a free (ephemeral) port:
+
+    broker = LocalBroker(port=0)
+    port = broker.start()
+    controller = ControlMQTT(..., mqtt_server_ip='127.0.0.1', mqtt_server_port=port)
+    ...
+    broker.stop()
+    print(broker.topic_stats())  # topic -> messages and payload bytes in/out
+"""
+
+from commons.parameters import bcolors
+import paho.mqtt.client as mqtt
+import argparse
+import asyncio
+import itertools
+import signal
+import struct
+import threading
+import uuid
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+# Control packet types (MQTT 3.1.1, section 2.2.1)
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+PROTOCOLS = {(b'MQTT', 4), (b'MQIsdp', 3)}  # MQTT 3.1.1 and 3.1
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_PROTOCOL = 1
+CONNACK_BAD_CLIENT_ID = 2
+SUBACK_FAILURE = 0x80
+MAX_QOS = 1
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class TopicStats:
+    def __init__(self):
+        self.messages_in = 0  # Published by the clients
+        self.bytes_in = 0  # Payload bytes
+        self.messages_out = 0  # Delivered to the subscribers (one message per subscriber)
+        self.bytes_out = 0
+
+    def as_dict(self):
+        return {'messages_in': self.messages_in,
+                'bytes_in': self.bytes_in,
+                'messages_out': self.messages_out,
+                'bytes_out': self.bytes_out}
+
+
+def encode_length(length):
+    """Remaining length of a packet (variable length integer)"""
+    encoded = bytearray()
+    while True:
+        (length, digit) = divmod(length, 128)
+        encoded.append(digit | 0x80 if length else digit)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+def read_string(body, offset):
+    """Returns: (bytes, offset after the string)"""
+    if offset + 2 > len(body):
+        raise ProtocolError("Truncated packet")
+    (length,) = struct.unpack_from('!H', body, offset)
+    end = offset + 2 + length
+    if end > len(body):
+        raise ProtocolError("Truncated packet")
+
+    return body[offset + 2:end], end
+
+
+async def read_packet(reader):
+    """Returns: (first byte of the fixed header, body of the packet)"""
+    first_byte = (await reader.readexactly(1))[0]
+    (length, multiplier) = (0, 1)
+    for _ in range(4):
+        digit = (await reader.readexactly(1))[0]
+        length += (digit & 0x7f) * multiplier
+        if not digit & 0x80:
+            break
+        multiplier *= 128
+    else:
+        raise ProtocolError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b''
+
+    return first_byte, body
+
+
+def publish_packet(topic, payload, qos, mid=None):
+    variable_header = encode_string(topic) + (struct.pack('!H', mid) if qos else b'')
+    return (bytes([PUBLISH << 4 | qos << 1]) + encode_length(len(variable_header) + len(payload))
+            + variable_header + payload)
+
+
+class BrokerSession:
+    """Connection of one client"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.keepalive = 0
+        self.subscriptions = dict()  # topic filter -> granted QoS
+        self.will = None  # (topic, payload, qos) published if the connection is lost without DISCONNECT
+        self.mids = itertools.cycle(range(1, 65536))
+        self.unacknowledged = set()  # mid of the QoS 1 messages sent to the client
+
+    def send(self, packet):
+        if not self.writer.is_closing():
+            self.writer.write(packet)
+
+    def next_mid(self):
+        mid = next(self.mids)
+        self.unacknowledged.add(mid)
+        return mid
+
+
+class LocalBroker:
+    STOP_TIMEOUT = 5.0  # [seconds]
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """
+        Parameters:
+        -----------
+            host: str: Address to listen on.
+            port: int: TCP port. 0 uses a free port, see the attribute 'port' after start().
+        """
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.sessions = dict()  # client id -> BrokerSession
+        self.routes = dict()  # topic -> list of (session, QoS) (cache of the subscriptions)
+        self.connection_tasks = dict()  # task -> writer of the connection
+        self.stats_lock = threading.Lock()
+        self.stats = dict()  # topic -> TopicStats
+        self.connections = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Run the broker in a daemon thread. Returns the port once the broker accepts connections."""
+        assert self.thread is None, "The broker is running already"
+        ready = threading.Event()
+        errors = []
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self.listen())
+            except OSError as error:  # e.g., port in use
+                errors.append(error)
+                ready.set()
+                self.loop.close()
+                return
+            ready.set()
+            try:
+                self.loop.run_forever()
+            finally:
+                self.loop.run_until_complete(self.close_sessions())
+                self.loop.close()
+
+        self.thread = threading.Thread(target=serve, name='local_broker', daemon=True)
+        self.thread.start()
+        ready.wait()
+        if errors:
+            self.thread = None
+            raise errors[0]
+
+        return self.port
+
+    def stop(self):
+        """Close the connections and the server (safe to call from any thread)"""
+        if self.thread is None:
+            return
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.STOP_TIMEOUT)
+        self.thread = None
+
+    def run_forever(self):
+        """Run the broker in this thread, until SIGTERM or KeyboardInterrupt"""
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        except (NotImplementedError, RuntimeError, ValueError):  # Windows or not the main thread
+            pass
+        try:
+            self.loop.run_until_complete(self.listen())
+            print(f"Listening on {self.host}:{self.port}", flush=True)
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            print(bcolors.WARNING + "Interrupted" + bcolors.ENDC)
+        finally:
+            self.loop.run_until_complete(self.close_sessions())
+            self.loop.close()
+
+    async def listen(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close_sessions(self):
+        self.server.close()
+        for writer in self.connection_tasks.values():  # The handlers return at the end of the stream
+            writer.close()
+        await asyncio.gather(*self.connection_tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def topic_stats(self):
+        """Returns: dict: topic -> {'messages_in', 'bytes_in', 'messages_out', 'bytes_out'} (thread safe)"""
+        with self.stats_lock:
+            return {topic: stats.as_dict() for (topic, stats) in self.stats.items()}
+
+    def totals(self):
+        totals = TopicStats().as_dict()
+        for stats in self.topic_stats().values():
+            for (key, value) in stats.items():
+                totals[key] += value
+
+        return totals
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats.clear()
+
+    def print_summary(self):
+        print(bcolors.HEADER + f"Local broker {self.host}:{self.port}, connections: {self.connections}" + bcolors.ENDC)
+        print(f"{'topic':<50} {'msg in':>10} {'bytes in':>12} {'msg out':>10} {'bytes out':>12}")
+        for (topic, stats) in sorted(self.topic_stats().items()):
+            print(f"{topic:<50} {stats['messages_in']:>10} {stats['bytes_in']:>12} "
+                  f"{stats['messages_out']:>10} {stats['bytes_out']:>12}")
+
+    async def handle_connection(self, reader, writer):
+        session = BrokerSession(reader, writer)
+        clean_disconnect = False
+        task = asyncio.current_task()
+        self.connection_tasks[task] = writer
+        try:
+            (first_byte, body) = await asyncio.wait_for(read_packet(reader), self.STOP_TIMEOUT)
+            if first_byte >> 4 != CONNECT or not self.connect(session, body):
+                return
+            timeout = 1.5 * session.keepalive if session.keepalive else None  # MQTT 3.1.1, section 3.1.2.10
+
+            while True:
+                (first_byte, body) = await asyncio.wait_for(read_packet(reader), timeout)
+                packet_type = first_byte >> 4
+                if packet_type == PUBLISH:
+                    self.on_publish(session, first_byte, body)
+                elif packet_type == PUBACK:
+                    session.unacknowledged.discard(struct.unpack('!H', body[:2])[0])
+                elif packet_type == SUBSCRIBE:
+                    self.on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    clean_disconnect = True
+                    return
+                else:
+                    raise ProtocolError(f"Unsupported packet type: {packet_type}")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass  # Connection lost or keep alive expired
+        except (ProtocolError, struct.error, IndexError, UnicodeDecodeError) as error:
+            print(bcolors.FAIL + f"Local broker: client {session.client_id!r} disconnected: {error}" + bcolors.ENDC)
+        finally:
+            self.connection_tasks.pop(task, None)
+            self.close_session(session, clean_disconnect)
+
+    def connect(self, session, body):
+        """CONNECT packet. Returns False if the connection was refused."""
+        (protocol, offset) = read_string(body, 0)
+        if len(body) < offset + 4:
+            raise ProtocolError("Truncated packet")
+        (level, flags, session.keepalive) = struct.unpack_from('!BBH', body, offset)
+        (client_id, offset) = read_string(body, offset + 4)
+        if flags & 0x04:  # Last will
+            (will_topic, offset) = read_string(body, offset)
+            (will_payload, offset) = read_string(body, offset)
+            session.will = (will_topic.decode('utf-8'), will_payload, min((flags >> 3) & 0x03, MAX_QOS))
+
+        if (protocol, level) not in PROTOCOLS:
+            return_code = CONNACK_BAD_PROTOCOL
+        elif not client_id and not flags & 0x02:  # An empty client id needs a clean session
+            return_code = CONNACK_BAD_CLIENT_ID
+        else:
+            return_code = CONNACK_ACCEPTED
+        session.send(bytes([CONNACK << 4, 2, 0, return_code]))
+        if return_code != CONNACK_ACCEPTED:
+            return False
+
+        session.client_id = client_id.decode('utf-8') if client_id else f"local_{uuid.uuid4().hex[:16]}"
+        previous = self.sessions.get(session.client_id)
+        if previous is not None:  # Session take over: the previous connection is closed (without its will)
+            previous.will = None
+            previous.writer.close()
+            self.routes.clear()
+        self.sessions[session.client_id] = session
+        self.connections += 1
+
+        return True
+
+    def close_session(self, session, clean_disconnect):
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+            if session.subscriptions:
+                self.routes.clear()
+        if not clean_disconnect and session.will is not None:
+            (topic, payload, qos) = session.will
+            self.route(topic, payload, qos)
+        session.writer.close()
+
+    def on_publish(self, session, first_byte, body):
+        qos = (first_byte >> 1) & 0x03
+        if qos > MAX_QOS:
+            raise ProtocolError("QoS 2 is not supported")
+        (topic, offset) = read_string(body, 0)
+        if qos:
+            (mid,) = struct.unpack_from('!H', body, offset)
+            offset += 2
+            session.send(bytes([PUBACK << 4, 2]) + struct.pack('!H', mid))
+
+        self.route(topic.decode('utf-8'), body[offset:], qos)
+
+    def route(self, topic, payload, qos):
+        """Deliver a message to the subscribed clients"""
+        subscribers = self.routes.get(topic)
+        if subscribers is None:
+            subscribers = []
+            for subscriber in self.sessions.values():  # One delivery per client, with the highest QoS granted
+                granted = [granted_qos for (topic_filter, granted_qos) in subscriber.subscriptions.items()
+                           if mqtt.topic_matches_sub(topic_filter, topic)]
+                if granted:
+                    subscribers.append((subscriber, max(granted)))
+            self.routes[topic] = subscribers
+
+        encoded_topic = topic.encode('utf-8')
+        for (subscriber, granted_qos) in subscribers:
+            delivery_qos = min(qos, granted_qos)
+            subscriber.send(publish_packet(encoded_topic, payload, delivery_qos,
+                                           subscriber.next_mid() if delivery_qos else None))
+
+        with self.stats_lock:
+            stats = self.stats.get(topic)
+            if stats is None:
+                stats = self.stats[topic] = TopicStats()
+            stats.messages_in += 1
+            stats.bytes_in += len(payload)
+            stats.messages_out += len(subscribers)
+            stats.bytes_out += len(payload) * len(subscribers)
+
+    def on_subscribe(self, session, body):
+        mid = body[:2]
+        (offset, return_codes) = (2, bytearray())
+        while offset < len(body):
+            (topic_filter, offset) = read_string(body, offset)
+            requested_qos = body[offset] & 0x03
+            offset += 1
+            topic_filter = topic_filter.decode('utf-8')
+            if self.valid_filter(topic_filter):
+                session.subscriptions[topic_filter] = min(requested_qos, MAX_QOS)
+                return_codes.append(min(requested_qos, MAX_QOS))
+            else:
+                return_codes.append(SUBACK_FAILURE)
+        if not return_codes:
+            raise ProtocolError("SUBSCRIBE without topic filters")
+        self.routes.clear()
+        session.send(bytes([SUBACK << 4]) + encode_length(2 + len(return_codes)) + mid + bytes(return_codes))
+
+    def on_unsubscribe(self, session, body):
+        mid = body[:2]
+        offset = 2
+        while offset < len(body):
+            (topic_filter, offset) = read_string(body, offset)
+            session.subscriptions.pop(topic_filter.decode('utf-8'), None)
+        self.routes.clear()
+        session.send(bytes([UNSUBACK << 4, 2]) + mid)
+
+    @staticmethod
+    def valid_filter(topic_filter):
+        """'#' only as the last level, '+' and '#' only as a whole level"""
+        if not topic_filter:
+            return False
+        levels = topic_filter.split('/')
+        for (position, level) in enumerate(levels):
+            if '#' in level and (level != '#' or position != len(levels) - 1):
+                return False
+            if '+' in level and level != '+':
+                return False
+
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-H', '--host', required=False, type=str, default='127.0.0.1',
+                        help="Address to listen on")
+    parser.add_argument('-P', '--port', required=False, type=int, default=1883,
+                        help="TCP port. 0 uses a free port (printed at start up)")
+    args, unknown = parser.parse_known_args()
+
+    print(f"ip address: {args.host}")
+    print(f"Port: {args.port}")
+
+    broker = LocalBroker(host=args.host, port=args.port)
+    broker.run_forever()
+    broker.print_summary()
@@ -0,0 +1,177 @@
+"""
+Structured and leveled logging of the modules (stdlib logging underneath).
+
+A record is an event name with key=value fields, formatted only if its level is enabled:
+
+    log = get_logger('control')
+    log.info('battery_online', battery_id=1)
+    log.debug('message_received', topic=msg.topic, payload=lazy(payload_summary, msg.payload))
+    log.info('solver_stats', rate_limit=10.0, solved=12)  # At most one record every 10 seconds
+    log.debug('publish', topic=topic, sample=100)  # One record of every 100
+    log.warning('battery_offline', control_id=2, rate_limit=60.0, key=2)  # Limited separately per controller
+
+    2021-11-02 10:15:00.123 INFO    control battery_online battery_id=1
+
+Levels: DEBUG for the per-message records and the payloads, INFO for the changes of state and periodic statistics
+(the production level, no payloads), WARNING and ERROR. The level is set by configure(), e.g., from the --log-level
+argument of the modules, or by the environment variable LOG_LEVEL.
+"""
+
+from commons.parameters import bcolors
+import logging
+import threading
+import time
+import os
+import sys
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+ROOT_LOGGER = 'dose'
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+DEFAULT_LEVEL = 'INFO'
+LEVEL_COLORS = {logging.DEBUG: '',
+                logging.INFO: '',
+                logging.WARNING: bcolors.WARNING,
+                logging.ERROR: bcolors.FAIL,
+                logging.CRITICAL: bcolors.FAIL}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class lazy:
+    """Value of a field computed only if the record is written, e.g., lazy(payload_summary, payload)"""
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+class KeyValueFormatter(logging.Formatter):
+    def __init__(self, colors=False):
+        super().__init__()
+        self.colors = colors
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        line = (f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')}.{int(record.msecs):03d} {record.levelname:<7} "
+                f"{record.name[len(ROOT_LOGGER) + 1:] or ROOT_LOGGER} {record.getMessage()}")
+        if fields:
+            line += " " + " ".join(f"{key}={format_value(value)}" for (key, value) in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        if self.colors and LEVEL_COLORS.get(record.levelno):
+            line = LEVEL_COLORS[record.levelno] + line + bcolors.ENDC
+
+        return line
+
+
+def format_value(value):
+    text = str(value)
+    if not text or any(character.isspace() or character in '="' for character in text):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+    return text
+
+
+class StructuredLogger:
+    def __init__(self, logger):
+        self.logger = logger
+        self.limits = dict()  # (event, key) -> [time of the last record, suppressed records, records seen]
+        self.lock = threading.Lock()
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, rate_limit=None, sample=None, key=None, exc_info=None, **fields):
+        """
+        Parameters:
+        -----------
+            event: str: Name of the event (one word, e.g., 'message_received').
+            rate_limit: float: Write at most one record of the event every 'rate_limit' seconds.
+            sample: int: Write one record of every 'sample' records of the event.
+            key: hashable: Rate limit and sample the records of the event separately per key, e.g., the id of the
+                 controller that writes them. Default: one limit for all the records of the event.
+            fields: Values of the record. Use lazy() for values that are expensive to compute.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        if rate_limit is not None or sample is not None:
+            suppressed = self.suppressed((event, key), rate_limit, sample)
+            if suppressed is None:
+                return
+            if suppressed:
+                fields['suppressed'] = suppressed
+        self.logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def suppressed(self, limit_key, rate_limit, sample):
+        """Returns the records of (event, key) suppressed since the last one, or None if this one is suppressed"""
+        now = time.monotonic()
+        with self.lock:
+            limit = self.limits.setdefault(limit_key, [None, 0, 0])
+            limit[2] += 1
+            if ((sample is not None and (limit[2] - 1) % sample)
+                    or (rate_limit is not None and limit[0] is not None and now - limit[0] < rate_limit)):
+                limit[1] += 1
+                return None
+            (suppressed, limit[0], limit[1]) = (limit[1], now, 0)
+
+        return suppressed
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        """Error with the traceback of the exception being handled"""
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def configure(level=None, stream=None, colors=None):
+    """
+    Parameters:
+    -----------
+        level: str: 'DEBUG', 'INFO', 'WARNING' or 'ERROR'. None uses the environment variable LOG_LEVEL (default INFO).
+        stream: file: Output of the records. Default: sys.stdout.
+        colors: bool: Color the warnings and errors. None colors them if the stream is a terminal.
+    """
+    global _configured
+    level = (level or os.environ.get('LOG_LEVEL') or DEFAULT_LEVEL).upper()
+    assert level in LEVELS, f"Log level should be one of {LEVELS}"
+    stream = stream if stream is not None else sys.stdout
+    colors = colors if colors is not None else (hasattr(stream, 'isatty') and stream.isatty())
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(KeyValueFormatter(colors=colors))
+    root = logging.getLogger(ROOT_LOGGER)
+    with _configure_lock:
+        for previous in list(root.handlers):
+            root.removeHandler(previous)
+        root.addHandler(handler)
+        root.setLevel(level)
+        root.propagate = False
+        _configured = True
+
+
+def get_logger(name):
+    """Logger of a module, e.g., get_logger('control'). Configured with the defaults if configure() was not called."""
+    if not _configured:
+        with _configure_lock:
+            needs_configuration = not _configured
+        if needs_configuration:
+            configure()
+
+    return StructuredLogger(logging.getLogger(f"{ROOT_LOGGER}.{name}"))
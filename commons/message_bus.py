@@ -0,0 +1,211 @@
+"""
+In-process message bus: the MQTT modules exchange their messages in memory, without a broker and without a network.
+
+BusClient replaces the network methods of paho's mqtt.Client (connect, subscribe, publish, loop, ...) by calls to a
+MessageBus. on_bus() derives a module class (e.g., ControlMQTT) that talks to the bus, so the production classes, with
+their topics and callbacks, run unchanged in one process:
+
+    bus = MessageBus()
+    controller = on_bus(ControlMQTT, bus)(control_id=1, ..., mqtt_server_ip=None, mqtt_server_port=None)
+    battery = on_bus(BatteryMQTT, bus)(battery_id=1, ...)
+
+The payloads are passed by reference (no copies). The bus queues the callbacks of the clients (on_connect, on_message,
+on_publish) and runs them in dispatch(): with the module runtime (ModuleRuntime.add_bus()) or step by step in a
+simulation (run_until_idle()). The retain flag and the QoS levels are accepted but have no effect: every message is
+delivered once to every subscribed client.
+"""
+
+from commons.parameters import bcolors
+from collections import deque
+import paho.mqtt.client as mqtt
+import threading
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class MessageBus:
+    def __init__(self):
+        self.subscriptions = dict()  # BusClient -> set of topic filters
+        self.routes = dict()  # topic -> list of subscribed clients (cache of the subscriptions)
+        self.pending = deque()  # (callback, args) run by dispatch()
+        self.lock = threading.Lock()
+        self.on_pending = None  # Called when a callback is queued on an empty bus (see ModuleRuntime.add_bus())
+
+        # Counters
+        self.messages = 0
+        self.deliveries = 0
+
+    def attach(self, client):
+        with self.lock:
+            self.subscriptions.setdefault(client, set())
+            self.routes.clear()
+
+    def detach(self, client):
+        with self.lock:
+            self.subscriptions.pop(client, None)
+            self.routes.clear()
+
+    def subscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions.setdefault(client, set()).add(topic_filter)
+            self.routes.clear()
+
+    def unsubscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions.get(client, set()).discard(topic_filter)
+            self.routes.clear()
+
+    def publish(self, topic, payload, qos=0):
+        with self.lock:
+            subscribers = self.routes.get(topic)
+            if subscribers is None:
+                subscribers = [client for (client, topic_filters) in self.subscriptions.items()
+                               if any(mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in topic_filters)]
+                self.routes[topic] = subscribers
+            self.messages += 1
+            self.deliveries += len(subscribers)
+
+        for client in subscribers:
+            self.call_soon(client.deliver, topic, payload, qos)
+
+    def call_soon(self, callback, *args):
+        """Queue a callback for dispatch() (thread safe)"""
+        with self.lock:
+            was_idle = not self.pending
+            self.pending.append((callback, args))
+
+        if was_idle and self.on_pending is not None:
+            self.on_pending()
+
+    def dispatch(self):
+        """Run the queued callbacks, also the ones queued meanwhile. Returns the number of callbacks."""
+        count = 0
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return count
+                (callback, args) = self.pending.popleft()
+
+            try:
+                callback(*args)
+            except Exception as error:  # A failing module does not stop the delivery to the others
+                print(bcolors.FAIL + f"Bus callback failed: {type(error).__name__}: {error}" + bcolors.ENDC)
+            count += 1
+
+    def run_until_idle(self, workers=()):
+        """
+        Dispatch until no callback is queued (simulation step by step).
+
+        Parameters:
+        -----------
+            workers: list: Objects with a wait_idle() method (e.g., ControlAgent) that publish from their own threads.
+                           The bus also waits for them.
+        """
+        while True:
+            self.dispatch()
+            for worker in workers:
+                worker.wait_idle()
+            with self.lock:
+                if not self.pending:
+                    return
+
+
+class BusClient(mqtt.Client):
+    """Network methods of mqtt.Client on a MessageBus. Use on_bus() to derive the class of a module."""
+    bus = None
+    bus_connected = False
+    bus_mid = 0
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        assert self.bus is not None, "The client is not on a bus (see on_bus())"
+        self.bus_connected = True
+        self.bus.attach(self)
+        self.bus.call_soon(self.notify_connect)
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self, *args, **kwargs):
+        self.bus_connected = False
+        self.bus.detach(self)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self._userdata, mqtt.MQTT_ERR_SUCCESS)
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        self.bus.subscribe(self, topic)
+        self.bus_mid += 1
+
+        return mqtt.MQTT_ERR_SUCCESS, self.bus_mid
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        self.bus.unsubscribe(self, topic)
+        self.bus_mid += 1
+
+        return mqtt.MQTT_ERR_SUCCESS, self.bus_mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode('ascii')
+        elif payload is None:
+            payload = b''
+        elif not isinstance(payload, (bytes, bytearray)):
+            raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+        self.bus_mid += 1
+        message_info = mqtt.MQTTMessageInfo(self.bus_mid)
+        if not self.bus_connected:
+            message_info.rc = mqtt.MQTT_ERR_NO_CONN
+            return message_info
+
+        self.bus.publish(topic, payload, qos=qos)
+        self.bus.call_soon(self.notify_publish, self.bus_mid)  # "Acknowledged" after the delivery
+        message_info.rc = mqtt.MQTT_ERR_SUCCESS
+
+        return message_info
+
+    def loop(self, timeout=1.0, max_packets=1):
+        self.bus.dispatch()
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return mqtt.MQTT_ERR_SUCCESS if self.bus_connected else mqtt.MQTT_ERR_NO_CONN
+
+    def socket(self):
+        return None
+
+    def want_write(self):
+        return False
+
+    # Callbacks run by MessageBus.dispatch()
+    def notify_connect(self):
+        if self.bus_connected and self.on_connect is not None:
+            self.on_connect(self, self._userdata, {'session present': 0}, 0)
+
+    def notify_publish(self, mid):
+        if self.on_publish is not None:
+            self.on_publish(self, self._userdata, mid)
+
+    def deliver(self, topic, payload, qos):
+        if not self.bus_connected or self.on_message is None:
+            return
+
+        message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        message.payload = payload
+        message.qos = qos
+        self.on_message(self, self._userdata, message)
+
+
+def on_bus(module_class, bus):
+    """
+    Class of a MQTT module (subclass of mqtt.Client, e.g., ControlMQTT) that uses the message bus instead of a broker.
+    The host and port given to the module are not used.
+    """
+    return type(f"{module_class.__name__}OnBus", (BusClient, module_class), {'bus': bus})
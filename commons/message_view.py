@@ -0,0 +1,114 @@
+"""
+Lightweight decoding of the time series messages (forecasts, optimal results and battery set points).
+
+Most receivers only need a few values of a message, e.g., the first set point of the battery or the first row of the
+results for the database. TimeSeriesView parses a payload (binary frame or pandas JSON) straight into numpy arrays and
+only builds a data frame when it is asked for one.
+"""
+
+from commons.wire_format import is_binary, parse_binary, to_time_index, HEADER_KEY, FRAME_KEY, TRACE_KEY
+import numpy as np
+import pandas as pd
+import json
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class TimeSeriesView:
+    def __init__(self, time_stamps_ns, columns, tz=None, index_name=None, header=None, trace=None):
+        """
+        Parameters:
+        -----------
+            time_stamps_ns: np.array: Time stamps as int64 nanoseconds (UTC if tz is given).
+            columns: dict: column name -> np.array
+            tz: str: Time zone of the time stamps. None for naive time stamps.
+            index_name: str: Name of the time index.
+            header: dict: Scalars sent with the time series (empty if the message had no header).
+            trace: dict: Latency trace of the message (see commons.tracing). None if the message is not traced.
+        """
+        self.time_stamps_ns = time_stamps_ns
+        self.columns = columns
+        self.tz = tz
+        self.index_name = index_name
+        self.header = header if header is not None else dict()
+        self.trace = trace
+        self._frame = None
+
+    @classmethod
+    def from_payload(cls, payload, date_column):
+        """
+        Parameters:
+        -----------
+            payload: bytes: Binary frame or pandas JSON message (orient 'columns' or 'records').
+            date_column: str: Name of the date column of the JSON messages.
+        """
+        if is_binary(payload):
+            (time_stamps_ns, columns, meta) = parse_binary(payload)
+            return cls(time_stamps_ns, columns, tz=meta['tz'], index_name=meta['index'], header=meta.get(HEADER_KEY),
+                       trace=meta.get(TRACE_KEY))
+
+        message = json.loads(payload)
+        (header, trace) = (None, None)
+        if isinstance(message, dict) and HEADER_KEY in message and FRAME_KEY in message:
+            (header, trace, message) = (message[HEADER_KEY], message.get(TRACE_KEY), message[FRAME_KEY])
+
+        if isinstance(message, list):  # orient='records'
+            records = message
+            names = list(records[0].keys()) if records else [date_column]
+            message = {name: [record.get(name) for record in records] for name in names}
+        else:  # orient='columns': {column: {row: value}}
+            message = {name: list(values.values()) for (name, values) in message.items()}
+
+        (time_stamps_ns, tz) = cls.parse_iso_dates(message.pop(date_column))
+        columns = {name: np.array(values, dtype=np.float64) for (name, values) in message.items()}
+
+        return cls(time_stamps_ns, columns, tz=tz, index_name=date_column, header=header, trace=trace)
+
+    @staticmethod
+    def parse_iso_dates(dates):
+        """ISO dates of pandas to_json(date_format='iso') to int64 nanoseconds. Returns also the time zone."""
+        if all(date_.endswith('Z') for date_ in dates):  # UTC, parsed by numpy
+            return np.array([date_[:-1] for date_ in dates], dtype='datetime64[ns]').view(np.int64), 'UTC'
+
+        time_stamps = pd.DatetimeIndex(pd.to_datetime(dates))  # Naive or with explicit offsets
+        if time_stamps.tz is not None:
+            return time_stamps.tz_convert('UTC').asi8, str(time_stamps.tz)
+
+        return time_stamps.asi8, None
+
+    def __len__(self):
+        return len(self.time_stamps_ns)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def first(self, name):
+        """First value of a column as a python scalar"""
+        return self.columns[name][0].item()
+
+    def first_row(self):
+        return {name: values[0].item() for (name, values) in self.columns.items()}
+
+    def time_index(self, rows=None):
+        time_stamps_ns = self.time_stamps_ns if rows is None else self.time_stamps_ns[:rows]
+
+        return to_time_index(time_stamps_ns, tz=self.tz, name=self.index_name)
+
+    def to_frame(self, rows=None):
+        """
+        Data frame indexed by the time stamps (same as commons.wire_format.read_frame()).
+
+        Parameters:
+        -----------
+            rows: int: Only the first 'rows' rows. None for all of them (the frame is kept for the next calls).
+        """
+        if rows is not None:
+            return pd.DataFrame({name: values[:rows] for (name, values) in self.columns.items()},
+                                index=self.time_index(rows))
+
+        if self._frame is None:
+            self._frame = pd.DataFrame(self.columns, index=self.time_index())
+
+        return self._frame
+
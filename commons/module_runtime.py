@@ -0,0 +1,259 @@
+"""
+Asyncio runtime of the MQTT modules (forecast, control, battery and dbmanager).
+
+The modules used to busy-poll their MQTT client (client.loop()) in a while loop and to pace the periodic work with
+time.sleep() or the 'schedule' package. The runtime runs everything on one asyncio event loop instead:
+
+    - MQTT I/O: the sockets of the paho clients are watched by the event loop (paho "external event loop" callbacks),
+      so a message is handled as soon as it arrives and an idle module does not poll.
+    - Timers: periodic jobs with a fixed cadence (the next run is planned from the start of the previous run, not from
+      its end, so the time of the job does not add up as drift).
+    - Executor: blocking jobs (e.g., HTTP or modbus requests) run in a thread pool, out of the event loop.
+    - Shutdown: SIGINT/SIGTERM (or stop()) cancel the jobs, run the stop callbacks of the modules and disconnect the
+      clients after their queued messages were sent.
+
+Several modules (clients) can be hosted by the same runtime, i.e., in one process and one event loop. The clients can
+also be on an in-process message bus (see commons.message_bus and add_bus()).
+"""
+
+from commons.parameters import bcolors
+from concurrent import futures
+import paho.mqtt.client as mqtt
+import asyncio
+import functools
+import threading
+import signal
+import math
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class JobStats:
+    def __init__(self):
+        self.runs = 0
+        self.failed = 0
+        self.overruns = 0  # Runs skipped because the job took longer than its period
+        self.max_lag = 0.0  # Largest delay of a run with respect to its planned time [seconds]
+
+    def as_dict(self):
+        return {'runs': self.runs,
+                'failed': self.failed,
+                'overruns': self.overruns,
+                'max_lag': self.max_lag}
+
+
+class ModuleRuntime:
+    MISC_INTERVAL = 1.0  # Keep alive and retries of the MQTT clients [seconds]
+    RECONNECT_DELAY = 5.0  # [seconds]
+    SHUTDOWN_TIMEOUT = 5.0  # Time to send the queued messages before closing the connections [seconds]
+
+    def __init__(self, executor_workers=2):
+        """
+        Parameters:
+        -----------
+            executor_workers: int: Threads of the executor of the blocking jobs.
+        """
+        self.loop = asyncio.SelectorEventLoop()  # add_reader()/add_writer() are needed (also on Windows)
+        self.executor = futures.ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='runtime')
+        self.clients = []
+        self.client_tasks = []
+        self.jobs = []
+        self.job_stats = dict()  # name of the job -> JobStats
+        self.stop_callbacks = []
+        self.stopping = False
+        self.stopped = self.loop.create_future()
+        self.loop_thread = None  # Thread running the event loop
+
+    def add_client(self, client):
+        """
+        Watch the socket of a paho client with the event loop. The client can be connected already.
+
+        Parameters:
+        -----------
+            client: mqtt.Client: Client of a module (e.g., ControlMQTT, BatteryMQTT).
+        """
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.clients.append(client)
+        self.client_tasks.append(self.loop.create_task(self.client_misc(client)))
+
+        sock = client.socket()
+        if sock is not None:  # connect() was called before the client was added
+            self.on_socket_open(client, None, sock)
+            if client.want_write():
+                self.on_socket_register_write(client, None, sock)
+
+    def add_bus(self, bus):
+        """Dispatch the callbacks of a MessageBus (commons.message_bus) in the event loop, as soon as they are queued"""
+        bus.on_pending = lambda: self.call_in_loop(self.schedule_dispatch, bus)
+        if bus.pending:
+            self.schedule_dispatch(bus)
+
+    def schedule_dispatch(self, bus):
+        if not self.loop.is_closed():
+            self.loop.call_soon(bus.dispatch)
+
+    def every(self, interval, job, *args, in_executor=False, name=None):
+        """
+        Run job(*args) every 'interval' seconds, starting now. The job is stopped when it returns False.
+
+        Parameters:
+        -----------
+            interval: float: Period of the job [seconds].
+            job: callable: Function or coroutine function.
+            in_executor: bool: Run the job in the executor (blocking jobs). Otherwise, it runs in the event loop and
+                               it should be short.
+            name: str: Name of the job in the statistics. Default: name of the function.
+        """
+        assert interval > 0, "The period of a job should be positive"
+        name = name if name is not None else getattr(job, '__name__', repr(job))
+        stats = self.job_stats.setdefault(name, JobStats())
+        task = self.loop.create_task(self.periodic(interval, job, args, in_executor, name, stats))
+        self.jobs.append(task)
+
+        return task
+
+    def run_in_executor(self, function, *args):
+        """Run a blocking function in the executor. Returns an asyncio future."""
+        return self.loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    def add_stop_callback(self, callback):
+        """callback() runs in the executor during the shutdown, before the clients are disconnected."""
+        self.stop_callbacks.append(callback)
+
+    def stop(self):
+        """Stop the runtime. Safe to call from any thread, run() returns after the shutdown."""
+        self.call_in_loop(self.set_stopped)
+
+    def run(self):
+        """Run the event loop until stop() or SIGINT/SIGTERM."""
+        self.loop_thread = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):  # Windows or not the main thread
+                pass
+
+        try:
+            self.loop.run_until_complete(self.stopped)
+        except KeyboardInterrupt:
+            print(bcolors.WARNING + "Interrupted" + bcolors.ENDC)
+        finally:
+            self.loop.run_until_complete(self.shutdown())
+            self.loop.close()
+
+    async def shutdown(self):
+        self.stopping = True
+        print(bcolors.WARNING + "Shutting down the module runtime..." + bcolors.ENDC)
+
+        tasks = self.jobs + self.client_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for callback in self.stop_callbacks:
+            try:
+                await self.run_in_executor(callback)
+            except Exception as error:
+                print(bcolors.FAIL + f"Stop callback failed: {error!r}" + bcolors.ENDC)
+
+        for client in self.clients:
+            client.disconnect()  # Sent after the queued messages, then paho closes the socket
+
+        deadline = self.loop.time() + self.SHUTDOWN_TIMEOUT
+        while any(client.socket() is not None for client in self.clients) and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+        self.executor.shutdown(wait=True)
+        for (name, stats) in self.job_stats.items():
+            print(f"Job {name}: {stats.as_dict()}")
+
+    def set_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def periodic(self, interval, job, args, in_executor, name, stats):
+        next_run = self.loop.time()
+        while True:
+            stats.max_lag = max(stats.max_lag, self.loop.time() - next_run)
+            try:
+                if in_executor:
+                    result = await self.run_in_executor(job, *args)
+                else:
+                    result = job(*args)
+                    if asyncio.iscoroutine(result):
+                        result = await result
+            except Exception as error:  # The job is reported and runs again in the next period
+                print(bcolors.FAIL + f"Job {name} failed: {error!r}" + bcolors.ENDC)
+                stats.failed += 1
+                result = None
+            stats.runs += 1
+
+            if result is False:
+                return
+
+            next_run += interval
+            now = self.loop.time()
+            if next_run < now:  # The job took longer than its period: skip the missed runs
+                missed = math.ceil((now - next_run) / interval)
+                stats.overruns += missed
+                next_run += missed * interval
+            await asyncio.sleep(next_run - now)
+
+    async def client_misc(self, client):
+        """Keep alive, retries of the QoS > 0 messages and reconnection of a client"""
+        while True:
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(self.RECONNECT_DELAY)
+                if client.socket() is not None:  # Reconnected meanwhile
+                    continue
+                print(bcolors.WARNING + f"Reconnecting client {client._client_id!r}..." + bcolors.ENDC)
+                try:
+                    await self.run_in_executor(client.reconnect)
+                except (OSError, ValueError) as error:
+                    print(bcolors.FAIL + f"Reconnection failed: {error!r}" + bcolors.ENDC)
+                continue
+
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    # paho calls the socket callbacks from the thread that opened/closed the socket or queued a message (e.g., a
+    # solver thread publishing a result). The event loop is only changed from its own thread.
+    def call_in_loop(self, callback, *args):
+        if self.loop_thread in (None, threading.get_ident()):
+            callback(*args)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call_in_loop(self.watch_reader, client, sock.fileno())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.unwatch, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.watch_writer, client, sock.fileno())
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock.fileno())
+
+    def watch_reader(self, client, fd):
+        if self.is_socket_of(client, fd):
+            self.loop.add_reader(fd, client.loop_read)
+
+    def watch_writer(self, client, fd):
+        if self.is_socket_of(client, fd):
+            self.loop.add_writer(fd, client.loop_write)
+
+    def unwatch(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    @staticmethod
+    def is_socket_of(client, fd):
+        """False if the socket was closed before the event loop processed the callback"""
+        sock = client.socket()
+        return sock is not None and sock.fileno() == fd
@@ -1,3 +1,6 @@
+from collections import namedtuple
+
+
 class BatteryParameters:
     NOMINAL_ENERGY = 'pb_nom'  # Nominal power of the battery in kWh
     MAX_POWER_DISCHARGE = 'pb_discharge_max' # Max. power to discharge in kW
@@ -34,6 +37,12 @@ class ControlParameters:
     VALID_KEYS = [POWER_THRESHOLD,
                   OPTIMIZER_WINDOW]
 
+    # Time series of the results message. The battery and controller parameters go once in the header.
+    TRAJECTORIES = [FORECAST_VALUES,
+                    BATTERY_POWER_OPTIMAL,
+                    NET_POWER_OPTIMAL,
+                    SOC_BATTERY_OPTIMAL]
+
 
 class Topics:
     sensor_topic                       = r"sensor/active_power/"
@@ -47,7 +56,33 @@ class Topics:
     # controller_to_battery_topic        = r"controller/set_power_battery/"
     controller_settings_response       = r"controller/settings_response/"
     controller_set_battery_power_topic = r"controller/set_power_battery/"
+    latency_trace                      = r"monitor/latency_trace/"
+
+    @classmethod
+    def names(cls):
+        return [name for (name, value) in vars(cls).items() if not name.startswith('_') and isinstance(value, str)]
+
+    @classmethod
+    def table(cls, **suffixes):
+        """
+        Topic table of one module instance. The class attributes are only the prefixes of the topics and are never
+        modified, so several modules (or controllers) can live in the same process.
+
+        Parameters:
+        -----------
+            suffixes: str: Suffix per topic name e.g., forecast_topic="gebouw_l1", battery_settings_topic="battery_1"
+
+        Returns:
+        --------
+            TopicTable: Immutable named tuple with all the topics.
+        """
+        unknown_topics = set(suffixes) - set(cls.names())
+        assert not unknown_topics, f"Unknown topics: {unknown_topics}"
+
+        return TopicTable(**{name: getattr(cls, name) + suffixes.get(name, "") for name in cls.names()})
+
 
+TopicTable = namedtuple('TopicTable', Topics.names())
 
 
 class bcolors:
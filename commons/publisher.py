@@ -0,0 +1,203 @@
+"""
+Outbound publish pipeline of the MQTT modules: per-topic QoS, outbound queues and a bounded in-flight window.
+
+The modules hand their messages to Publisher.publish(), which queues them per topic and passes them to the paho client
+while less than 'max_inflight' QoS > 0 messages wait for their acknowledgement. The policy of a topic sets its QoS and
+what happens when the broker (or the network) does not keep up:
+
+    SUPERSEDED: only the newest message is kept (forecasts, trajectories, status reports): the oldest is dropped.
+    GUARANTEED: QoS 1 and never dropped (battery set points, commands). Sent before the other topics.
+    BEST_EFFORT: QoS 0, up to 100 queued messages (diagnostics, e.g., latency traces).
+
+The publisher reports the publish-to-ack latency (from publish() until paho reports the message as sent/acknowledged)
+and the occupancy of the queues.
+"""
+
+from commons.parameters import bcolors
+from commons.tracing import LatencyHistogram
+from collections import deque, OrderedDict
+import paho.mqtt.client as mqtt
+import threading
+import time
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class PublishPolicy:
+    def __init__(self, qos=1, max_queued=None, retain=False):
+        """
+        Parameters:
+        -----------
+            qos: int: QoS of the messages of the topic.
+            max_queued: int: Messages of the topic waiting in the queue. When the queue is full, the oldest message is
+                             dropped. None never drops a message (guaranteed delivery, sent first).
+            retain: bool: Retain flag of the messages.
+        """
+        assert max_queued is None or max_queued > 0, "The queue should hold at least one message"
+        self.qos = qos
+        self.max_queued = max_queued
+        self.retain = retain
+
+    @property
+    def guaranteed(self):
+        return self.max_queued is None
+
+    def __repr__(self):
+        return f"PublishPolicy(qos={self.qos}, max_queued={self.max_queued}, retain={self.retain})"
+
+
+SUPERSEDED = PublishPolicy(qos=1, max_queued=1)
+GUARANTEED = PublishPolicy(qos=1, max_queued=None)
+BEST_EFFORT = PublishPolicy(qos=0, max_queued=100)
+
+
+class Publisher:
+    MAX_PENDING_ACKS = 10000  # QoS 0 messages lost in a disconnection are never acknowledged
+
+    def __init__(self, client, policies=None, default_policy=GUARANTEED, max_inflight=20):
+        """
+        Parameters:
+        -----------
+            client: mqtt.Client: Client that sends the messages. Its on_publish callback is used by the publisher.
+            policies: dict: topic -> PublishPolicy
+            default_policy: PublishPolicy: Policy of the topics without a policy.
+            max_inflight: int: QoS > 0 messages passed to the client and not acknowledged yet.
+        """
+        self.client = client
+        self.policies = dict(policies or {})
+        self.default_policy = default_policy
+        self.max_inflight = max_inflight
+        self.client.max_inflight_messages_set(max(max_inflight, 20))  # paho should not queue the window again
+        self.client.on_publish = self.on_publish
+
+        self.queues = OrderedDict()  # topic -> deque of (sequence, payload, time of publish())
+        self.sequence = 0
+        self.inflight = 0
+        self.pending_acks = OrderedDict()  # mid -> (topic, time of publish(), qos)
+        self.early_acks = set()  # Acknowledged before client.publish() returned (QoS 0 written at once)
+        self.lock = threading.RLock()
+        self.idle = threading.Condition(self.lock)
+
+        # Statistics
+        self.published = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.dropped = dict()  # topic -> messages dropped by the policy
+        self.max_occupancy = 0
+        self.ack_latency = LatencyHistogram()
+
+    def set_policy(self, topic, policy):
+        with self.lock:
+            self.policies[topic] = policy
+
+    def policy(self, topic):
+        return self.policies.get(topic, self.default_policy)
+
+    def publish(self, topic, payload):
+        """Queue a message (thread safe). It is sent as soon as the in-flight window allows it."""
+        policy = self.policy(topic)
+        with self.lock:
+            queue = self.queues.setdefault(topic, deque())
+            if policy.max_queued is not None and len(queue) >= policy.max_queued:
+                queue.popleft()  # Superseded by the new message
+                self.dropped[topic] = self.dropped.get(topic, 0) + 1
+            self.sequence += 1
+            queue.append((self.sequence, payload, time.perf_counter()))
+            self.max_occupancy = max(self.max_occupancy, self.occupancy())
+
+        self.pump()
+
+    def pump(self):
+        """Pass the queued messages to the client while the in-flight window has room"""
+        while True:
+            with self.lock:
+                if self.inflight >= self.max_inflight:
+                    return
+                topic = self.next_topic()
+                if topic is None:
+                    return
+                (_, payload, queued_at) = self.queues[topic].popleft()
+                policy = self.policy(topic)
+                if policy.qos > 0:
+                    self.inflight += 1
+
+            # Not under self.lock: paho calls on_publish() holding its own locks
+            try:
+                message_info = self.client.publish(topic, payload, qos=policy.qos, retain=policy.retain)
+            except (TypeError, ValueError) as error:  # Invalid payload/topic
+                print(bcolors.FAIL + f"Message on topic {topic} not published: {error}" + bcolors.ENDC)
+                message_info = None
+
+            with self.lock:
+                if message_info is None or (message_info.rc != mqtt.MQTT_ERR_SUCCESS and policy.qos == 0):
+                    self.failed += 1  # QoS > 0 messages stay in the client and are sent after a reconnection
+                    if policy.qos > 0:
+                        self.inflight -= 1
+                    self.idle.notify_all()
+                    continue
+
+                self.published += 1
+                if message_info.mid in self.early_acks:
+                    self.early_acks.discard(message_info.mid)
+                    self.record_ack(queued_at, policy.qos)
+                else:
+                    self.pending_acks[message_info.mid] = (topic, queued_at, policy.qos)
+                    while len(self.pending_acks) > self.MAX_PENDING_ACKS:
+                        self.pending_acks.popitem(last=False)
+
+    def next_topic(self):
+        """Topic of the next message: guaranteed topics first, then the oldest message"""
+        candidates = [(not self.policy(topic).guaranteed, queue[0][0], topic)
+                      for (topic, queue) in self.queues.items() if queue]
+
+        return min(candidates)[2] if candidates else None
+
+    def on_publish(self, client, userdata, mid):
+        """paho: the message was sent (QoS 0) or acknowledged by the broker (QoS > 0)"""
+        with self.lock:
+            pending = self.pending_acks.pop(mid, None)
+            if pending is None:
+                self.early_acks.add(mid)
+                return
+            (_, queued_at, qos) = pending
+            self.record_ack(queued_at, qos)
+
+        self.pump()
+
+    def record_ack(self, queued_at, qos):
+        self.acknowledged += 1
+        self.ack_latency.record(time.perf_counter() - queued_at)
+        if qos > 0:
+            self.inflight -= 1
+        self.idle.notify_all()
+
+    def occupancy(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def drain(self, timeout=5.0):
+        """Wait until the queues are empty and the QoS > 0 messages are acknowledged. Returns True if drained."""
+        self.pump()
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.occupancy() and not self.inflight, timeout=timeout)
+
+    def stats(self):
+        with self.lock:
+            return {'published': self.published,
+                    'acknowledged': self.acknowledged,
+                    'failed': self.failed,
+                    'dropped': dict(self.dropped),
+                    'queued': {topic: len(queue) for (topic, queue) in self.queues.items() if queue},
+                    'max_queued': self.max_occupancy,
+                    'inflight': self.inflight,
+                    'ack_latency_p50': self.ack_latency.percentile(50),
+                    'ack_latency_p99': self.ack_latency.percentile(99)}
+
+    def print_summary(self):
+        print(bcolors.HEADER + f"Publisher: {self.stats()}" + bcolors.ENDC)
+
+    def close(self, timeout=5.0):
+        """Send the queued messages before the client disconnects (stop callback of the module runtime)"""
+        if not self.drain(timeout=timeout):
+            print(bcolors.WARNING + "Publisher: not all the messages were sent" + bcolors.ENDC)
+        self.print_summary()
@@ -0,0 +1,164 @@
+"""
+In-process solver for the convex quadratic program (QP) of the peak shaving MPC, written in the battery power only:
+
+    minimize    1/2 sum(p * x^2) + q' x
+    subject to  x_lower <= x <= x_upper
+                s_lower <= cumsum(w * x) <= s_upper
+
+i.e., a diagonal hessian, box constraints on the variables and box constraints on the (weighted) prefix sums of the
+variables, which is how the state of charge of the battery evolves. Bounds can be +/- inf.
+
+The solver is a primal-dual interior point method (Mehrotra predictor-corrector). The structure is exploited in the
+Newton step: with v = cumsum(w * dx) as unknown, the reduced system diag(p + d_x) + S' diag(d_s) S becomes tridiagonal
+and is solved in O(n) with a banded Cholesky factorization. No external process and no files.
+"""
+
+import numpy as np
+from scipy.linalg import cholesky_banded, cho_solve_banded
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class QPStatus:
+    OPTIMAL = 'optimal'
+    MAX_ITERATIONS = 'max_iterations'
+    INFEASIBLE = 'infeasible'
+
+
+class PrefixSumQP:
+    STEP_TO_BOUNDARY = 0.99
+
+    def __init__(self, tolerance=1e-6, max_iter=50):
+        """
+        Parameters:
+        -----------
+            tolerance: float: Tolerance of the primal residual, dual residual and complementarity gap.
+            max_iter: int: Maximum number of Newton iterations.
+        """
+        self.tolerance = tolerance
+        self.max_iter = max_iter
+
+        # Statistics
+        self.solve_count = 0
+        self.last_iterations = None
+        self.total_iterations = 0
+
+    def solve(self, p, q, w, x_lower, x_upper, s_lower, s_upper):
+        """
+        Solve the QP. All the arguments are arrays with the length of the number of variables.
+
+        Returns:
+        --------
+            x: np.array: Primal solution.
+            status: str: One of QPStatus.
+        """
+        p, q, w = (np.asarray(array_, dtype=float) for array_ in (p, q, w))
+        upper = np.concatenate([np.asarray(x_upper, dtype=float), np.asarray(s_upper, dtype=float)])
+        lower = np.concatenate([np.asarray(x_lower, dtype=float), np.asarray(s_lower, dtype=float)])
+        n = len(q)
+
+        if np.any(lower > upper):
+            return np.zeros(n), QPStatus.INFEASIBLE
+
+        # Constraints as G x <= h with G = [C; -C] and C x = [x; cumsum(w * x)]. Infinite bounds are inactive rows.
+        active = np.concatenate([np.isfinite(upper), np.isfinite(lower)])
+        h = np.where(active, np.concatenate([upper, -lower]), 0.0)
+        n_active = max(int(np.sum(active)), 1)
+
+        def G_dot(x_):
+            Cx = np.concatenate([x_, np.cumsum(w * x_)])
+            return np.concatenate([Cx, -Cx])
+
+        def G_t_dot(y_):
+            y_c = y_[:2 * n] - y_[2 * n:]
+            return y_c[:n] + w * np.cumsum(y_c[n:][::-1])[::-1]
+
+        tolerance_primal = self.tolerance * (1.0 + np.max(np.abs(h)))
+        tolerance_dual = self.tolerance * (1.0 + np.max(np.abs(q)))
+
+        x = np.zeros(n)
+        s = np.where(active, np.maximum(h - G_dot(x), 1.0), 1.0)
+        z = np.where(active, 1.0, 0.0)
+
+        status = QPStatus.MAX_ITERATIONS
+        iteration = 0
+        while iteration < self.max_iter:
+            residual_dual = p * x + q + G_t_dot(z)
+            residual_primal = np.where(active, G_dot(x) + s - h, 0.0)
+            mu = (s @ z) / n_active
+
+            if (np.max(np.abs(residual_dual)) <= tolerance_dual and
+                    np.max(np.abs(residual_primal)) <= tolerance_primal and mu <= self.tolerance):
+                status = QPStatus.OPTIMAL
+                break
+
+            iteration += 1
+            weights = np.where(active, z / s, 0.0)
+            d_c = weights[:2 * n] + weights[2 * n:]
+            factors = self._factorize(p + d_c[:n], d_c[n:], w)
+
+            # Predictor (affine scaling) step
+            residual_complementarity = s * z
+            (dx, ds, dz) = self._newton_step(factors, G_dot, G_t_dot, active, s, z, weights, w, residual_dual,
+                                             residual_primal, residual_complementarity)
+            alpha = min(self._max_step(s, ds), self._max_step(z, dz))
+            mu_affine = ((s + alpha * ds) @ (z + alpha * dz)) / n_active
+            sigma = (mu_affine / mu) ** 3 if mu > 0 else 0.0  # mu = 0 without active constraints
+
+            # Corrector step
+            residual_complementarity = np.where(active, s * z + ds * dz - sigma * mu, 0.0)
+            (dx, ds, dz) = self._newton_step(factors, G_dot, G_t_dot, active, s, z, weights, w, residual_dual,
+                                             residual_primal, residual_complementarity)
+            alpha = min(1.0, self.STEP_TO_BOUNDARY * min(self._max_step(s, ds), self._max_step(z, dz)))
+
+            x = x + alpha * dx
+            s = s + alpha * ds
+            z = z + alpha * dz
+
+        self.solve_count += 1
+        self.last_iterations = iteration
+        self.total_iterations += iteration
+
+        return x, status
+
+    @staticmethod
+    def _factorize(d_x, d_s, w):
+        """
+        Banded Cholesky factorization of the tridiagonal matrix Delta' diag(d_x / w^2) Delta + diag(d_s), where Delta
+        is the first difference operator (inverse of the cumulative sum).
+        """
+        e = d_x / w ** 2
+        banded = np.zeros((2, len(e)))
+        banded[0, 1:] = -e[1:]  # Upper diagonal
+        banded[1, :] = e + np.append(e[1:], 0.0) + d_s  # Main diagonal
+
+        return cholesky_banded(banded, lower=False, check_finite=False)
+
+    @staticmethod
+    def _newton_step(factors, G_dot, G_t_dot, active, s, z, weights, w, residual_dual, residual_primal,
+                     residual_complementarity):
+        """Solve the reduced Newton system (diag(p) + G' W G) dx = rhs and recover the steps of s and z."""
+        rhs = -residual_dual - G_t_dot(weights * residual_primal - residual_complementarity / s)
+
+        # Change of variables v = cumsum(w * dx)  ->  tridiagonal system in v
+        g = rhs / w
+        v = cho_solve_banded((factors, False), g - np.append(g[1:], 0.0), check_finite=False)
+        dx = np.diff(v, prepend=0.0) / w
+
+        dz = weights * (G_dot(dx) + residual_primal) - residual_complementarity / s
+        ds = np.where(active, -(residual_complementarity + s * dz) / np.where(active, z, 1.0), 0.0)
+
+        return dx, ds, dz
+
+    @staticmethod
+    def _max_step(v, dv):
+        """Largest step in [0, 1] such that v + step * dv >= 0"""
+        negative = dv < 0
+        if not np.any(negative):
+            return 1.0
+
+        return min(1.0, np.min(-v[negative] / dv[negative]))
+
+    def mean_iterations(self):
+        return self.total_iterations / self.solve_count if self.solve_count else None
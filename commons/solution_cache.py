@@ -0,0 +1,78 @@
+"""
+Bounded LRU cache of optimal MPC solutions.
+
+Simulation replays, parameter sweeps and restarts feed the controller with exactly the same inputs. The key of an entry
+is a hash of the forecast quantized with a tolerance, the battery and controller parameters and the shape of the
+problem, so those runs skip the solver.
+"""
+
+from collections import OrderedDict
+import hashlib
+import numpy as np
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class SolutionCache:
+    def __init__(self, max_entries=128, tolerance=1e-3):
+        """
+        Parameters:
+        -----------
+            max_entries: int: Number of solutions kept. The least recently used solution is evicted first.
+            tolerance: float: Quantization step of the forecast values [kW]. Forecasts that quantize to the same
+                              values share the solution.
+        """
+        assert max_entries > 0, "The cache needs at least one entry"
+        assert tolerance > 0, "The quantization tolerance should be positive"
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.entries = OrderedDict()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, forecast, battery_params, controller_params, *problem_shape):
+        """
+        Parameters:
+        -----------
+            forecast: array-like: Forecast values of the horizon.
+            battery_params: dict: Battery parameters used by the optimizer.
+            controller_params: dict: Controller parameters used by the optimizer (threshold, window).
+            problem_shape: Anything else that changes the solution e.g., solver, formulation, blocks of the horizon.
+        """
+        quantized = np.round(np.asarray(forecast, dtype=float) / self.tolerance).astype(np.int64)
+
+        key = hashlib.blake2b(digest_size=16)
+        key.update(quantized.tobytes())
+        key.update(repr(sorted(battery_params.items())).encode())
+        key.update(repr(sorted(controller_params.items())).encode())
+        key.update(repr(problem_shape).encode())
+
+        return key.hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the stored results frame or None"""
+        results_optimizer = self.entries.get(key)
+        if results_optimizer is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return results_optimizer.copy()
+
+    def put(self, key, results_optimizer):
+        self.entries[key] = results_optimizer.copy()
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def clear(self):
+        self.entries.clear()
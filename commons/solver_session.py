@@ -0,0 +1,123 @@
+"""
+Solver session for the receding horizon (MPC) loop of the control module.
+
+Consecutive MPC problems only differ by a one-step shift of the forecast. The session keeps the solver object, its
+options and the warm-start suffixes alive across solves, and seeds every new solve with the previous primal (and dual)
+trajectory shifted by one time step. The number of iterations of every solve is recorded to monitor the effect.
+"""
+
+from pyomo.environ import SolverFactory, Suffix, Var, Constraint, SolverStatus, TerminationCondition
+import tempfile
+import os
+import re
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+
+class IpoptSession:
+    ITERATIONS_PATTERN = re.compile(r"Number of Iterations\.*:\s*(\d+)")
+    WARM_START_OPTIONS = {'warm_start_init_point': 'yes',
+                          'warm_start_bound_push': 1e-6,
+                          'warm_start_mult_bound_push': 1e-6,
+                          'mu_init': 1e-6}
+
+    def __init__(self, solver_name='ipopt', warm_start=True, **options):
+        """
+        Parameters:
+        -----------
+            solver_name: str: Name of the solver for the pyomo SolverFactory.
+            warm_start: bool: Seed each solve with the shifted previous solution (primal and dual values).
+            options: Extra options passed to the solver e.g., max_iter=500, tol=1e-6.
+        """
+        self.solver_name = solver_name
+        self.solver = SolverFactory(solver_name)
+        self.solver.options.update(options)
+        self.warm_start = warm_start
+
+        self.model = None  # Model that owns the warm-start suffixes
+        self.has_solution = False  # The model holds a valid solution from the last solve
+
+        # Solver log is written on a file that is reused on every solve to read the iteration count.
+        file_descriptor, self.log_file = tempfile.mkstemp(prefix=f"{solver_name}_session_", suffix=".log")
+        os.close(file_descriptor)
+
+        # Statistics of the session
+        self.solve_count = 0
+        self.last_iterations = None
+        self.total_iterations = 0
+
+    def attach(self, model):
+        """Add the suffixes to import/export the dual values. Only needed once per model (i.e., after a rebuild)."""
+        if model is self.model:
+            return
+
+        model.dual = Suffix(direction=Suffix.IMPORT_EXPORT)
+        model.ipopt_zL_out = Suffix(direction=Suffix.IMPORT)
+        model.ipopt_zU_out = Suffix(direction=Suffix.IMPORT)
+        model.ipopt_zL_in = Suffix(direction=Suffix.EXPORT)
+        model.ipopt_zU_in = Suffix(direction=Suffix.EXPORT)
+
+        self.model = model
+        self.has_solution = False
+
+    def shift_solution(self, model):
+        """Shift the primal values of all indexed variables (and the duals of all indexed constraints) one step ahead.
+        The last step repeats the last value of the previous solution."""
+        for variable in model.component_objects(Var, active=True):
+            if variable.is_indexed():
+                index = list(variable.keys())
+                values = [variable[t].value for t in index]
+                for (t, value_) in zip(index, values[1:] + values[-1:]):
+                    variable[t].value = value_
+
+        for constraint in model.component_objects(Constraint, active=True):
+            if constraint.is_indexed():
+                index = list(constraint.keys())
+                duals = [model.dual.get(constraint[t]) for t in index]
+                for (t, dual_) in zip(index, duals[1:] + duals[-1:]):
+                    if dual_ is not None:
+                        model.dual[constraint[t]] = dual_
+
+        for suffix_out, suffix_in in [(model.ipopt_zL_out, model.ipopt_zL_in),
+                                      (model.ipopt_zU_out, model.ipopt_zU_in)]:
+            suffix_in.clear()
+            suffix_in.update(suffix_out)
+
+    def solve(self, model):
+        """Solve the model warm started from the previous solution. Returns the pyomo results object."""
+        self.attach(model)
+
+        if self.warm_start and self.has_solution:
+            self.shift_solution(model)
+            self.solver.options.update(self.WARM_START_OPTIONS)
+        else:
+            for option in self.WARM_START_OPTIONS:
+                self.solver.options.pop(option, None)
+
+        results = self.solver.solve(model, tee=False, logfile=self.log_file)
+
+        self.has_solution = ((results.solver.status == SolverStatus.ok) and
+                             (results.solver.termination_condition == TerminationCondition.optimal))
+        self.solve_count += 1
+        self.last_iterations = self.read_iterations()
+        if self.last_iterations is not None:
+            self.total_iterations += self.last_iterations
+
+        return results
+
+    def read_iterations(self):
+        try:
+            with open(self.log_file) as log:
+                match = self.ITERATIONS_PATTERN.search(log.read())
+        except OSError:
+            return None
+
+        return int(match.group(1)) if match else None
+
+    def mean_iterations(self):
+        return self.total_iterations / self.solve_count if self.solve_count else None
+
+    def close(self):
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
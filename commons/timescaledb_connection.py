@@ -8,13 +8,224 @@ https://naysan.ca/2020/05/09/pandas-to-postgresql-using-psycopg2-bulk-insert-per
 
 import psycopg2 as ps
 from psycopg2 import extras
+from commons.log import get_logger
+from commons.tracing import LatencyHistogram
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import functools
+import threading
+import time
+import csv
+import io
 import sys
 
 __version__ = "1.0.0"
 __author__ = "Mauricio Salazar"
 
+log = get_logger('timescaledb')
+
+CONNECTION_ERRORS = (ps.OperationalError, ps.InterfaceError)  # The connection is broken (server restart, network)
+LOG_COLUMNS = ('time_control', 'channel', 'values_channel')  # Tables of create_table()
+HYPERTABLE_LOG_COLUMNS = ('time_control', 'channel_id', 'values_channel')  # Tables of create_table(), HYPERTABLE
+LATENCY_COLUMNS = ('time_trace', 'trace_id', 'stage', 'latency')  # Tables of create_latency_table()
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00'  # Signature, flags, extension
+COPY_BINARY_TRAILER = b'\xff\xff'
+POSTGRES_EPOCH_US = 946684800 * 10 ** 6  # 2000-01-01 UTC, origin of the binary timestamps [microseconds]
+
+# Schema of the log tables
+PLAIN = 'plain'  # (time_control, channel VARCHAR, values_channel), no index
+HYPERTABLE = 'hypertable'  # Timescale hypertable (time_control, channel_id SMALLINT, values_channel), compressed
+SCHEMAS = (PLAIN, HYPERTABLE)
+CHANNELS_TABLE = 'channels'  # channel_id -> channel name, shared by the hypertables of the database
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Persistent connections to one database, shared by the threads of a module.
+
+    A connection is checked ('SELECT 1') before it is used if it was idle for more than HEALTH_CHECK_INTERVAL seconds,
+    and replaced if it is broken. New connections are opened with retries and an exponential backoff.
+    """
+    HEALTH_CHECK_INTERVAL = 30.0  # [seconds]
+
+    def __init__(self, size=4, max_retries=5, backoff=0.5, max_backoff=30.0, acquire_timeout=30.0, **connect_kwargs):
+        """
+        Parameters:
+        -----------
+            size: int: Max. open connections.
+            max_retries: int: Retries to open a connection before the error is raised.
+            backoff: float: Delay before the first retry, doubled after each retry up to max_backoff [seconds].
+            acquire_timeout: float: Max. time waiting for a free connection [seconds].
+            connect_kwargs: Arguments of psycopg2.connect() e.g., host, port, user, password, dbname.
+        """
+        assert size > 0, "The pool should hold at least one connection"
+        self.size = size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.acquire_timeout = acquire_timeout
+        self.connect_kwargs = connect_kwargs
+
+        self.idle = deque()  # (connection, time of the last use)
+        self.opened = 0  # Connections open (idle or in use)
+        self.prepared = dict()  # id(connection) -> names of the statements prepared on the connection
+        self.condition = threading.Condition()
+
+        # Statistics
+        self.connections_opened = 0
+        self.connections_discarded = 0
+        self.health_checks_failed = 0
+
+    @contextmanager
+    def connection(self, autocommit=False):
+        """
+        Connection of the pool. The transaction is committed at the end of the block, or rolled back if the block
+        raised an exception. A broken connection is closed and replaced later by a new one.
+        """
+        connection = self.acquire()
+        discard = False
+        try:
+            connection.autocommit = autocommit
+            yield connection
+            if not autocommit:
+                connection.commit()
+        except CONNECTION_ERRORS:
+            discard = True
+            raise
+        except BaseException:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            self.release(connection, discard=discard)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self.condition:
+            while True:
+                if self.idle:
+                    (connection, last_used) = self.idle.pop()  # The most recently used one (likely healthy)
+                    break
+                if self.opened < self.size:
+                    (connection, last_used) = (None, None)
+                    self.opened += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No free connection after {self.acquire_timeout} s (pool size {self.size})")
+                self.condition.wait(remaining)
+
+        if connection is not None and not self.is_healthy(connection, last_used):
+            self.health_checks_failed += 1
+            self.close_connection(connection)
+            connection = None
+
+        if connection is None:
+            try:
+                connection = self.open_connection()
+            except BaseException:
+                with self.condition:
+                    self.opened -= 1
+                    self.condition.notify()
+                raise
+
+        return connection
+
+    def release(self, connection, discard=False):
+        if discard or connection.closed:
+            self.connections_discarded += 1
+            self.close_connection(connection)
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            return
+
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def open_connection(self):
+        """New connection, with retries and exponential backoff"""
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection = ps.connect(**self.connect_kwargs)
+                self.connections_opened += 1
+                self.prepared[id(connection)] = set()
+                return connection
+            except ps.OperationalError as error:
+                if attempt == self.max_retries:
+                    raise
+                log.warning('db_connect_retry', attempt=attempt + 1, delay=delay, error=str(error).strip())
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+
+    def close_connection(self, connection):
+        self.prepared.pop(id(connection), None)
+        try:
+            connection.close()
+        except CONNECTION_ERRORS:
+            pass
+
+    def is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def prepare(self, connection, name, statement):
+        """Prepare a statement once per connection (run it with 'EXECUTE name (...)')"""
+        prepared = self.prepared.setdefault(id(connection), set())
+        if name not in prepared:
+            with connection.cursor() as cur:
+                cur.execute(f"PREPARE {name} AS {statement}")
+            prepared.add(name)
+
+    def close(self):
+        """Close the idle connections (the ones in use are closed when they are released)"""
+        with self.condition:
+            while self.idle:
+                (connection, _) = self.idle.pop()
+                self.close_connection(connection)
+                self.opened -= 1
+
+    def stats(self):
+        with self.condition:
+            return {'size': self.size,
+                    'open': self.opened,
+                    'idle': len(self.idle),
+                    'connections_opened': self.connections_opened,
+                    'connections_discarded': self.connections_discarded,
+                    'health_checks_failed': self.health_checks_failed}
+
+
 class TimescaledbConnection:
-    def __init__(self, username, password, host='localhost', port=5432):
+    def __init__(self, username, password, host='localhost', port=5432, pool_size=4, schema=PLAIN,
+                 chunk_interval='1 day', compress_after='7 days'):
+        """
+        Parameters:
+        -----------
+            pool_size: int: Persistent connections to the database of the tables (see ConnectionPool).
+            schema: str: Schema of the log tables of create_table(): PLAIN or HYPERTABLE. HYPERTABLE stores the channel
+                         as a SMALLINT id (see CHANNELS_TABLE and the view '<table>_view' with the names), with an
+                         index (channel_id, time_control DESC) and the native compression of Timescale.
+            chunk_interval: str: Time range of a chunk of the hypertables (PostgreSQL interval, e.g., '1 day').
+            compress_after: str: Age of the chunks compressed by the compression policy. None: no policy.
+        """
+        assert schema in SCHEMAS, f"Schema should be one of {SCHEMAS}"
         self.username = username
         self.password = password
         self.host = host
@@ -22,71 +233,112 @@ class TimescaledbConnection:
         # self.clear_table = clear_table
         self.db_name = None
         # self.table_name = None
+        self.pool_size = pool_size
+        self.db_pools = dict()  # Database name -> ConnectionPool (None: default database of the user)
+        self.db_pools_lock = threading.Lock()
+        self.schema = schema
+        self.chunk_interval = chunk_interval
+        self.compress_after = compress_after
+        self.table_schemas = dict()  # Table name -> schema of the log tables created by create_table()
+        self.db_channel_ids = dict()  # Channel name -> channel_id (cache of CHANNELS_TABLE)
 
         assert self.check_connection(), "Check connection to the database. Is timescaledb/docker running?"
 
         self.create_db(db_name="test_python_db")
+        self.close_db([db_name for db_name in self.db_pools if db_name != self.db_name])  # Only used at start up
         # self.create_table(table_name="operation_log", clear_table=clear_table)
 
+    def db_pool(self, db_name):
+        with self.db_pools_lock:
+            pool = self.db_pools.get(db_name)
+            if pool is None:
+                connect_kwargs = dict(host=self.host, port=self.port, user=self.username, password=self.password)
+                if db_name is not None:
+                    connect_kwargs['dbname'] = db_name
+                # The administration databases are only used at start up
+                size = self.pool_size if db_name == self.db_name else 1
+                pool = self.db_pools[db_name] = ConnectionPool(size=size, **connect_kwargs)
+
+        return pool
+
+    def db_execute(self, operation, db_name=None, autocommit=False):
+        """
+        Run operation(pool, connection, cursor) with a connection of the pool of the database, in one transaction.
+        If the connection was broken, the operation is retried once with a new connection (the broken transaction
+        was not committed).
+
+        Returns:
+        --------
+            Result of the operation.
+        """
+        pool = self.db_pool(db_name)
+        for attempt in range(2):
+            try:
+                with pool.connection(autocommit=autocommit) as conn:
+                    with conn.cursor() as cur:
+                        return operation(pool, conn, cur)
+            except CONNECTION_ERRORS as error:
+                if attempt:
+                    raise
+                log.warning('db_connection_lost', db_name=db_name, error=str(error).strip())
+
+    def close_db(self, db_names=None):
+        """Close the connections of the databases (all of them by default, e.g., as stop callback of the module)"""
+        with self.db_pools_lock:
+            for db_name in list(self.db_pools if db_names is None else db_names):
+                pool = self.db_pools.pop(db_name)
+                log.info('db_pool_closed', db_name=db_name, **pool.stats())
+                pool.close()
+
     def check_connection(self, db_name="postgres"):
-        conn = None
-        try:
-            print("Testing connection with PostgreSQL database...")
-            conn = ps.connect(host=self.host, port=self.port, user=self.username, password=self.password, dbname=db_name)
-            cur = conn.cursor()
-            print('PostgreSQL database version:')
+        def operation(pool, conn, cur):
             cur.execute('SELECT version()')
-            db_version = cur.fetchone()
-            print(db_version)
-            cur.close()
+            return cur.fetchone()
+
+        try:
+            log.info('db_check_connection', host=self.host, port=self.port)
+            db_version = self.db_execute(operation, db_name=db_name)
+            log.info('db_version', version=db_version[0])
+            return True
         except (Exception, ps.DatabaseError) as error:
-            print(error)
-        finally:
-            if conn is not None:
-                conn.close()
-                print('Database connection closed.')
-                return True
+            log.error('db_connection_failed', error=str(error).strip())
             return False
 
     def create_db(self, db_name="test_python_db"):
         self.db_name = db_name
-        conn = None
-        try:
-            conn = ps.connect(host=self.host, port=self.port, user=self.username, password=self.password)
-            cur = conn.cursor()
-            conn.autocommit = True
-            cur.execute(f"""SELECT datname FROM pg_catalog.pg_database WHERE datname = '{self.db_name}'""")
+
+        def operation(pool, conn, cur):
+            cur.execute("""SELECT datname FROM pg_catalog.pg_database WHERE datname = %s""", (self.db_name,))
             exists = cur.fetchone()
             if not exists:
                 # cur.execute(f"""DROP DATABASE IF EXISTS {self.db_name}""")
                 cur.execute(f"""CREATE DATABASE {self.db_name}""")
-                print("Database created")
+                log.info('db_created', db_name=self.db_name)
             else:
-                print("Database exists")
-            cur.close()
+                log.info('db_exists', db_name=self.db_name)
+
+        try:
+            self.db_execute(operation, autocommit=True)  # CREATE DATABASE can not run in a transaction
         except Exception as error:
-            print(f"{type(error).__name__}: {error}")
-            print(f"Query: {cur.query}")
-            cur.close()
-        else:
-            conn.autocommit = False
-        finally:
-            if conn is not None:
-                conn.close()
-                print('Database connection closed.')
-        cur.close()
+            log.error('db_create_failed', db_name=self.db_name, error=f"{type(error).__name__}: {error}")
 
     def create_table(self, table_name, clear_table=False):
+        """
+        Log table with the schema of the connection. A table that already exists with the PLAIN schema keeps it (and
+        is written as such) in HYPERTABLE mode: clear the table to convert it. In HYPERTABLE mode, the other errors
+        are raised (e.g., Timescale not available), so the module does not start writing to a table it could not
+        create.
+        """
         assert self.db_name is not None, "Create a database first"
         # self.table_name = table_name
-        conn = None
-        try:
-            conn = ps.connect(host=self.host, port=self.port, user=self.username, password=self.password, dbname=self.db_name)
-            cur = conn.cursor()
 
+        def operation(pool, conn, cur):
             if clear_table:
-                cur.execute(f"""DROP TABLE IF EXISTS {table_name};""")
-                print("Table cleared.")
+                cur.execute(f"""DROP TABLE IF EXISTS {table_name} CASCADE;""")
+                log.info('table_cleared', table_name=table_name)
+
+            if self.schema == HYPERTABLE:
+                return self.create_hypertable(cur, table_name)
 
             cur.execute(f"""
                          CREATE TABLE IF NOT EXISTS {table_name} (
@@ -94,36 +346,154 @@ class TimescaledbConnection:
                             channel VARCHAR (100),
                             values_channel FLOAT);
                         """)
-            conn.commit()
-            cur.close()
+            return PLAIN
+
+        try:
+            self.table_schemas[table_name] = self.db_execute(operation, db_name=self.db_name)
         except (Exception, ps.DatabaseError) as error:
-            print(error)
-            cur.close()
-        finally:
-            if conn is not None:
-                conn.close()
-                print('Database connection closed.')
-        cur.close()
+            log.error('create_table_failed', table_name=table_name, schema=self.schema, error=str(error).strip())
+            if self.schema == HYPERTABLE:
+                raise
+
+    def create_hypertable(self, cur, table_name):
+        """Returns the schema of the table: HYPERTABLE, or PLAIN if the table already existed with that schema"""
+        cur.execute("""SELECT column_name FROM information_schema.columns WHERE table_name = %s""", (table_name,))
+        columns = {row[0] for row in cur.fetchall()}
+        if columns and 'channel_id' not in columns:
+            log.warning('hypertable_skipped', table_name=table_name, schema=PLAIN,
+                        reason="The table exists with the plain schema. Clear it to create the hypertable.")
+            return PLAIN
+
+        cur.execute("""CREATE EXTENSION IF NOT EXISTS timescaledb;""")
+        cur.execute(f"""
+                     CREATE TABLE IF NOT EXISTS {CHANNELS_TABLE} (
+                        channel_id SMALLSERIAL PRIMARY KEY,
+                        channel VARCHAR (100) UNIQUE NOT NULL);
+                    """)
+        cur.execute(f"""
+                     CREATE TABLE IF NOT EXISTS {table_name} (
+                        time_control TIMESTAMPTZ NOT NULL,
+                        channel_id SMALLINT NOT NULL,
+                        values_channel FLOAT);
+                    """)
+        cur.execute("""SELECT create_hypertable(%s, 'time_control', chunk_time_interval => %s::interval,
+                                                if_not_exists => TRUE)""", (table_name, self.chunk_interval))
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS {table_name}_channel_time_idx
+                        ON {table_name} (channel_id, time_control DESC);""")
+        cur.execute(f"""
+                     CREATE OR REPLACE VIEW {table_name}_view AS
+                        SELECT time_control, channel, values_channel
+                        FROM {table_name} JOIN {CHANNELS_TABLE} USING (channel_id);
+                    """)
+
+        cur.execute("""SELECT compression_enabled FROM timescaledb_information.hypertables
+                       WHERE hypertable_name = %s""", (table_name,))
+        if not cur.fetchone()[0]:  # The settings can not change once chunks are compressed
+            cur.execute(f"""ALTER TABLE {table_name} SET (timescaledb.compress,
+                                                         timescaledb.compress_segmentby = 'channel_id',
+                                                         timescaledb.compress_orderby = 'time_control DESC');""")
+        if self.compress_after is not None:
+            cur.execute("""SELECT add_compression_policy(%s, %s::interval, if_not_exists => TRUE)""",
+                        (table_name, self.compress_after))
+        log.info('hypertable_created', table_name=table_name, chunk_interval=self.chunk_interval,
+                 compress_after=self.compress_after)
+
+        return HYPERTABLE
+
+    def is_hypertable(self, table_name):
+        return self.table_schemas.get(table_name) == HYPERTABLE
+
+    def channel_ids(self, channels):
+        """channel_id of the channels (registered in CHANNELS_TABLE the first time)"""
+        missing = sorted(set(channels) - set(self.db_channel_ids))
+        if missing:
+            def operation(pool, conn, cur):
+                extras.execute_values(cur, f"""INSERT INTO {CHANNELS_TABLE} (channel) VALUES %s
+                                               ON CONFLICT (channel) DO NOTHING""", [(channel,) for channel in missing])
+                cur.execute(f"""SELECT channel, channel_id FROM {CHANNELS_TABLE} WHERE channel = ANY(%s)""", (missing,))
+                return cur.fetchall()
+
+            self.db_channel_ids.update(self.db_execute(operation, db_name=self.db_name))
+
+        return [self.db_channel_ids[channel] for channel in channels]
+
+    def channel_rows(self, rows):
+        """Rows (time, channel name, value) of a log table as rows (time, channel_id, value) of a hypertable"""
+        channels = sorted({row[1] for row in rows})
+        ids = dict(zip(channels, self.channel_ids(channels)))
+        return [(time_, ids[channel], value) for (time_, channel, value) in rows]
 
     def insert_data(self, df_output, table_name):
         assert self.db_name is not None, "Create a database first"
         # assert self.table_name is not None, "Create a table first"
 
-        conn = None
+        # data = [('2020-11-11 14:15:00+00:00','forecast',6.952342)]
+        data = list(df_output.itertuples(index=False, name=None))
+        columns = ', '.join(HYPERTABLE_LOG_COLUMNS if self.is_hypertable(table_name) else LOG_COLUMNS)
+        statement = f"insert_{table_name}"
+
+        def operation(pool, conn, cur):
+            pool.prepare(conn, statement, f"""insert into {table_name} ({columns})
+                                              values ($1, $2, $3)""")
+            extras.execute_batch(cur, f"EXECUTE {statement} (%s, %s, %s)", data, page_size=100)
+
         try:
-            conn = ps.connect(host=self.host, port=self.port, user=self.username, password=self.password, dbname=self.db_name)
-            cur = conn.cursor()
-            # data = [('2020-11-11 14:15:00+00:00','forecast',6.952342)]
-            data = list(df_output.itertuples(index=False, name=None))
-            insert_query = f"""insert into {table_name} (time_control, channel, values_channel) values %s"""
-            extras.execute_values(cur, insert_query, data, template=None, page_size=100)
-            conn.commit()
+            if self.is_hypertable(table_name):
+                data = self.channel_rows(data)
+            self.db_execute(operation, db_name=self.db_name)
         except (Exception, ps.DatabaseError) as error:
-            print(error)
-        finally:
-            if conn is not None:
-                conn.close()
-                print('Database connection closed.')
+            log.error('insert_failed', table_name=table_name, rows=len(data), error=str(error).strip())
+
+    def create_latency_table(self, table_name, clear_table=False):
+        """Table of the latency traces: one row per trace and stage (see commons.tracing)"""
+        assert self.db_name is not None, "Create a database first"
+
+        def operation(pool, conn, cur):
+            if clear_table:
+                cur.execute(f"""DROP TABLE IF EXISTS {table_name};""")
+                log.info('table_cleared', table_name=table_name)
+
+            cur.execute(f"""
+                         CREATE TABLE IF NOT EXISTS {table_name} (
+                            time_trace TIMESTAMPTZ,
+                            trace_id VARCHAR (32),
+                            stage VARCHAR (100),
+                            latency FLOAT);
+                        """)
+
+        try:
+            self.db_execute(operation, db_name=self.db_name)
+        except (Exception, ps.DatabaseError) as error:
+            log.error('create_table_failed', table_name=table_name, error=str(error).strip())
+
+    def insert_latencies(self, rows, table_name):
+        """
+        Parameters:
+        -----------
+            rows: list: Tuples (time_trace: str, trace_id: str, stage: str, latency: float [seconds])
+        """
+        assert self.db_name is not None, "Create a database first"
+        statement = f"insert_{table_name}"
+
+        def operation(pool, conn, cur):
+            pool.prepare(conn, statement, f"""insert into {table_name} (time_trace, trace_id, stage, latency)
+                                              values ($1, $2, $3, $4)""")
+            extras.execute_batch(cur, f"EXECUTE {statement} (%s, %s, %s, %s)", rows, page_size=100)
+
+        try:
+            self.db_execute(operation, db_name=self.db_name)
+        except (Exception, ps.DatabaseError) as error:
+            log.error('insert_failed', table_name=table_name, rows=len(rows), error=str(error).strip())
+
+    def fetch_all(self, query, parameters=None):
+        """Rows of a query (read only)"""
+        assert self.db_name is not None, "Create a database first"
+
+        def operation(pool, conn, cur):
+            cur.execute(query, parameters)
+            return cur.fetchall()
+
+        return self.db_execute(operation, db_name=self.db_name)
 
     def _connect(self, user, password, db_name):
         """ Connect to the PostgreSQL database server: Just for testing purposes """
@@ -140,6 +510,282 @@ class TimescaledbConnection:
         print("Connection successful...")
 
 
+class LongFrame:
+    """
+    Rows of a log table (time_control, channel, values_channel) as columns: one block of rows per channel, each with
+    the time stamps of the message. Built straight from the arrays of a message (no data frame, no tuple per row) and
+    written with the binary COPY format (see BufferedWriter). Missing values (NaN) are not written.
+    """
+
+    def __init__(self, time_stamps_ns, channels, values):
+        """
+        Parameters:
+        -----------
+            time_stamps_ns: np.array: int64 nanoseconds, UTC (naive time stamps are taken as UTC).
+            channels: tuple: Channel names, one per row of 'values'.
+            values: np.array: float64 of shape (channels, time stamps)
+        """
+        self.time_stamps_ns = time_stamps_ns
+        self.channels = channels
+        self.values = values
+        self.present = ~np.isnan(values)
+        self.size = int(np.count_nonzero(self.present))
+
+    @classmethod
+    def from_columns(cls, time_stamps_ns, columns, decimals=2):
+        """
+        Parameters:
+        -----------
+            time_stamps_ns: np.array: int64 nanoseconds (e.g., TimeSeriesView.time_stamps_ns).
+            columns: dict: channel name -> values (one per time stamp)
+            decimals: int: Values rounded to the decimals. None keeps them as they are.
+        """
+        time_stamps_ns = np.asarray(time_stamps_ns, dtype=np.int64)
+        values = np.empty((len(columns), len(time_stamps_ns)), dtype=np.float64)
+        for (row, column) in enumerate(columns.values()):
+            values[row] = column
+        if len(time_stamps_ns) > 1 and np.any(np.diff(time_stamps_ns) < 0):
+            order = np.argsort(time_stamps_ns, kind='stable')
+            (time_stamps_ns, values) = (time_stamps_ns[order], values[:, order])
+        if decimals is not None:
+            np.round(values, decimals, out=values)
+
+        return cls(time_stamps_ns, tuple(columns), values)
+
+    @classmethod
+    def from_frame(cls, frame, decimals=2):
+        """Wide data frame with a time index (or ISO dates), one column per channel"""
+        index = pd.DatetimeIndex(pd.to_datetime(frame.index))
+        if index.tz is not None:
+            index = index.tz_convert('UTC')
+
+        return cls.from_columns(index.asi8, {str(name): frame[name].to_numpy(dtype=np.float64)
+                                             for name in frame.columns}, decimals=decimals)
+
+    def __len__(self):
+        return self.size
+
+    def to_copy_binary(self, channel_ids=None):
+        """
+        Tuples of the binary COPY format (without header and trailer)
+
+        Parameters:
+        -----------
+            channel_ids: list: SMALLINT id of each channel (HYPERTABLE schema). None writes the channel names.
+        """
+        time_stamps_us = self.time_stamps_ns // 1000 - POSTGRES_EPOCH_US
+        channels = [channel.encode('utf-8') for channel in self.channels] if channel_ids is None else channel_ids
+        blocks = []
+        for (channel, values, present) in zip(channels, self.values, self.present):
+            (time_stamps, values) = (time_stamps_us, values) if present.all() else (time_stamps_us[present],
+                                                                                    values[present])
+            channel_format = '>i2' if channel_ids is not None else f'S{len(channel)}'
+            block = np.empty(len(time_stamps), dtype=copy_tuple_dtype(channel_format))
+            block['fields'] = 3
+            (block['time_length'], block['time']) = (8, time_stamps)
+            (block['channel_length'], block['channel']) = (block.dtype['channel'].itemsize, channel)
+            (block['value_length'], block['value']) = (8, values)
+            blocks.append(block.tobytes())
+
+        return b''.join(blocks)
+
+
+@functools.lru_cache(maxsize=256)
+def copy_tuple_dtype(channel_format):
+    """Packed big-endian tuple of the binary COPY format: (timestamptz, varchar 'S<n>' or smallint '>i2', float8)"""
+    return np.dtype([('fields', '>i2'),
+                     ('time_length', '>i4'), ('time', '>i8'),
+                     ('channel_length', '>i4'), ('channel', channel_format),
+                     ('value_length', '>i4'), ('value', '>f8')])
+
+
+class BufferedWriter:
+    """
+    Rows of the tables collected in memory and written with one 'COPY ... FROM STDIN' per table and flush, instead of
+    one INSERT per row and one transaction per message. Rows given as tuples are copied in CSV format, LongFrames in
+    binary format (no text conversion of the time stamps and values).
+
+    A table is flushed when it holds 'max_rows' rows (in add()) or when its oldest row waited 'max_delay' seconds (in
+    flush_due(), run it periodically). flush() writes all the tables, e.g., at the end of the simulation. The rows of
+    a failed flush are kept for the next one, up to 'max_buffered_rows' rows per table (the oldest are dropped).
+    """
+
+    def __init__(self, connection, max_rows=500, max_delay=1.0, max_buffered_rows=50000):
+        """
+        Parameters:
+        -----------
+            connection: TimescaledbConnection: Database of the tables.
+            max_rows: int: Rows of a table that trigger a flush.
+            max_delay: float: Max. time a row waits in the buffer (if flush_due() runs often enough) [seconds].
+            max_buffered_rows: int: Rows of a table kept while the database is not available.
+        """
+        assert 0 < max_rows <= max_buffered_rows, "Flush size should be positive and at most max_buffered_rows"
+        self.connection = connection
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_buffered_rows = max_buffered_rows
+
+        self.buffers = dict()  # Table name -> list of chunks (list of tuples or LongFrame)
+        self.counts = dict()  # Table name -> buffered rows
+        self.columns = dict()  # Table name -> column names
+        self.oldest = dict()  # Table name -> time of the oldest buffered row (time.monotonic())
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # One flush at a time: the rows are written in order
+
+        # Metrics
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.max_flush_rows = 0
+        self.copy_time = 0.0  # Time spent in the flushes [seconds]
+        self.flush_latency = LatencyHistogram()
+
+    def add(self, table_name, rows, columns=LOG_COLUMNS):
+        """
+        Parameters:
+        -----------
+            table_name: str: Table of the rows.
+            rows: iterable or LongFrame: Tuples with the values of the columns, e.g.,
+                                         ('2020-11-11 14:15:00+00:00', 'forecast', 6.95), or the rows of a log table.
+            columns: tuple: Column names of the values.
+        """
+        chunk = rows if isinstance(rows, LongFrame) else list(rows)
+        if not len(chunk):
+            return
+
+        with self.lock:
+            buffer = self.buffers.setdefault(table_name, [])
+            self.columns[table_name] = columns
+            if not buffer:
+                self.oldest[table_name] = time.monotonic()
+            buffer.append(chunk)
+            self.counts[table_name] = self.counts.get(table_name, 0) + len(chunk)
+            full = self.counts[table_name] >= self.max_rows
+
+        if full:
+            self.flush([table_name])
+
+    def buffered_rows(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def flush_due(self):
+        """Flush the tables that are full or waited 'max_delay' seconds (periodic job of the module runtime)"""
+        now = time.monotonic()
+        with self.lock:
+            due = [table_name for (table_name, count) in self.counts.items()
+                   if count and (count >= self.max_rows or now - self.oldest[table_name] >= self.max_delay)]
+        if due:
+            self.flush(due)
+        log.info('db_writer_stats', rate_limit=60.0, **self.stats())
+
+    def flush(self, table_names=None):
+        """Write the buffered rows of the tables (all of them by default). Returns the rows written."""
+        written = 0
+        with self.flush_lock:
+            for table_name in list(self.buffers if table_names is None else table_names):
+                with self.lock:
+                    chunks = self.buffers.get(table_name)
+                    if not chunks:
+                        continue
+                    count = self.counts[table_name]
+                    (self.buffers[table_name], self.counts[table_name]) = ([], 0)
+                    columns = self.columns[table_name]
+
+                if self.copy_chunks(table_name, columns, chunks, count):
+                    written += count
+                else:
+                    self.restore(table_name, chunks)
+
+        return written
+
+    def encode_chunks(self, table_name, chunks):
+        """
+        Returns:
+        --------
+            (io.StringIO, io.BytesIO): Rows in CSV format (tuples) and in binary format (LongFrames). None if empty.
+        """
+        hypertable = self.connection.is_hypertable(table_name)
+        csv_buffer = io.StringIO()
+        rows_writer = csv.writer(csv_buffer, lineterminator='\n')  # None is written as an empty field: NULL
+        frames = []
+        for chunk in chunks:
+            if isinstance(chunk, LongFrame):
+                channel_ids = self.connection.channel_ids(chunk.channels) if hypertable else None
+                frames.append(chunk.to_copy_binary(channel_ids))
+            else:
+                rows_writer.writerows(self.connection.channel_rows(chunk) if hypertable else chunk)
+
+        return (csv_buffer if csv_buffer.tell() else None,
+                io.BytesIO(COPY_BINARY_HEADER + b''.join(frames) + COPY_BINARY_TRAILER) if frames else None)
+
+    def copy_chunks(self, table_name, columns, chunks, count):
+        if self.connection.is_hypertable(table_name):
+            columns = HYPERTABLE_LOG_COLUMNS
+        target = f"{table_name} ({', '.join(columns)})"
+
+        start = time.perf_counter()
+        try:
+            (csv_buffer, binary_buffer) = self.encode_chunks(table_name, chunks)
+
+            def operation(pool, conn, cur):
+                # db_execute() retries with a new connection if the connection was broken
+                if csv_buffer is not None:
+                    csv_buffer.seek(0)
+                    cur.copy_expert(f"COPY {target} FROM STDIN WITH (FORMAT csv)", csv_buffer)
+                if binary_buffer is not None:
+                    binary_buffer.seek(0)
+                    cur.copy_expert(f"COPY {target} FROM STDIN WITH (FORMAT binary)", binary_buffer)
+
+            self.connection.db_execute(operation, db_name=self.connection.db_name)
+        except (Exception, ps.DatabaseError) as error:
+            self.failed_flushes += 1
+            log.error('db_flush_failed', table_name=table_name, rows=count, error=str(error).strip())
+            return False
+        latency = time.perf_counter() - start
+
+        self.flushes += 1
+        self.rows_written += count
+        self.max_flush_rows = max(self.max_flush_rows, count)
+        self.copy_time += latency
+        self.flush_latency.record(latency)
+        log.debug('db_flush', table_name=table_name, rows=count, latency=f"{latency * 1e3:.2f}ms")
+
+        return True
+
+    def restore(self, table_name, chunks):
+        """Put the rows of a failed flush back in front of the rows added meanwhile"""
+        with self.lock:
+            buffer = chunks + self.buffers.get(table_name, [])
+            count = sum(len(chunk) for chunk in buffer)
+            dropped = 0
+            while count - dropped > self.max_buffered_rows and len(buffer) > 1:
+                dropped += len(buffer.pop(0))
+            if dropped:
+                self.rows_dropped += dropped
+                log.warning('db_rows_dropped', table_name=table_name, rows=dropped)
+            (self.buffers[table_name], self.counts[table_name]) = (buffer, count - dropped)
+            self.oldest[table_name] = time.monotonic()  # Retried after 'max_delay' seconds
+
+    def stats(self):
+        return {'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'rows_written': self.rows_written,
+                'rows_dropped': self.rows_dropped,
+                'rows_buffered': self.buffered_rows(),
+                'mean_flush_rows': round(self.rows_written / self.flushes, 1) if self.flushes else 0,
+                'max_flush_rows': self.max_flush_rows,
+                'flush_latency_p50': self.flush_latency.percentile(50),
+                'flush_latency_p99': self.flush_latency.percentile(99),
+                'rows_per_second': round(self.rows_written / self.copy_time) if self.copy_time else 0}
+
+    def close(self):
+        """Final flush (stop callback of the module, before the connections are closed)"""
+        self.flush()
+        log.info('db_writer_closed', **self.stats())
+
+
 if __name__ == "__main__":
     import pandas as pd
 
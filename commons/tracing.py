@@ -0,0 +1,164 @@
+"""
+End-to-end latency tracing of the control loop: forecast -> control -> battery / dbmanager.
+
+The forecast module starts a trace when it publishes a forecast. The trace travels with the time series messages
+(commons.wire_format, key 'trace') and every module adds the time of its stage:
+
+    forecast_publish -> control_receive -> model_build -> solve -> control_publish -> battery_apply
+                                                                                  \\-> db_insert
+
+A trace is a JSON serializable dict {'id': str, 'stages': {stage: unix time [seconds]}}. The latency of a stage is
+the time since the previous stage of the trace. Every module keeps histograms of the latencies of the traces that it
+finishes (StageHistograms), and the battery publishes its finished traces for the collector of the DB manager.
+"""
+
+from commons.parameters import bcolors
+import numpy as np
+import threading
+import uuid
+import time
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+LATENCY_TABLE = "latency_traces"  # Table of the collector (DB manager): one row per trace and stage
+
+
+class Stages:
+    FORECAST_PUBLISH = 'forecast_publish'
+    CONTROL_RECEIVE = 'control_receive'
+    MODEL_BUILD = 'model_build'  # Not stamped when the model lives in a fleet worker (included in 'solve')
+    SOLVE = 'solve'
+    CONTROL_PUBLISH = 'control_publish'
+    BATTERY_APPLY = 'battery_apply'
+    DB_INSERT = 'db_insert'
+    ORDER = [FORECAST_PUBLISH,
+             CONTROL_RECEIVE,
+             MODEL_BUILD,
+             SOLVE,
+             CONTROL_PUBLISH,
+             BATTERY_APPLY,
+             DB_INSERT]
+    CONTROL_PATH = ORDER[:ORDER.index(CONTROL_PUBLISH) + 1]  # Shared by the battery and the dbmanager branches
+    TOTAL_PREFIX = 'total_'  # End-to-end latency of a trace: 'total_' + last stage e.g., 'total_battery_apply'
+
+
+def new_trace(stage, time_stamp=None):
+    return {'id': uuid.uuid4().hex[:16],
+            'stages': {stage: time.time() if time_stamp is None else time_stamp}}
+
+
+def stamp(trace, stage, time_stamp=None):
+    """Add the time of a stage to the trace (in place). Does nothing if trace is None (message not traced)."""
+    if trace is not None:
+        trace['stages'][stage] = time.time() if time_stamp is None else time_stamp
+
+    return trace
+
+
+def stage_latencies(trace, stages=None):
+    """
+    Parameters:
+    -----------
+        trace: dict: Finished trace.
+        stages: list: Only these stages (and the total latency) are returned. None returns all of them.
+
+    Returns:
+    --------
+        dict: stage -> time since the previous stage of the trace [seconds], plus the end-to-end latency of the trace
+              (key Stages.TOTAL_PREFIX + last stage). The first stage has no latency.
+    """
+    time_stamps = [(stage, trace['stages'][stage]) for stage in Stages.ORDER if stage in trace['stages']]
+    latencies = {stage: time_stamp - previous_time_stamp
+                 for ((_, previous_time_stamp), (stage, time_stamp)) in zip(time_stamps[:-1], time_stamps[1:])
+                 if stages is None or stage in stages}
+    if len(time_stamps) > 1:
+        latencies[Stages.TOTAL_PREFIX + time_stamps[-1][0]] = time_stamps[-1][1] - time_stamps[0][1]
+
+    return latencies
+
+
+class LatencyHistogram:
+    def __init__(self, min_latency=1e-5, max_latency=1e3, buckets_per_decade=20):
+        """
+        Histogram with log spaced buckets: the percentiles have a relative error below 10**(1/buckets_per_decade) - 1
+        (12 % with 20 buckets per decade) and recording a value does not allocate.
+
+        Parameters:
+        -----------
+            min_latency: float: Upper edge of the first bucket [seconds].
+            max_latency: float: Lower edge of the overflow bucket [seconds].
+            buckets_per_decade: int: Resolution of the histogram.
+        """
+        decades = np.log10(max_latency / min_latency)
+        self.edges = np.logspace(np.log10(min_latency), np.log10(max_latency),
+                                 int(round(decades * buckets_per_decade)) + 1)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.counts[np.searchsorted(self.edges, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """Upper edge of the bucket of the q-th percentile [seconds] (the maximum for the overflow bucket)"""
+        if not self.count:
+            return None
+
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        if bucket >= len(self.edges):
+            return self.max
+
+        return min(float(self.edges[bucket]), self.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class StageHistograms:
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.histograms = dict()  # stage -> LatencyHistogram
+        self.traces = 0
+        self.lock = threading.Lock()  # Traces are finished by the network loop and by the solver threads
+
+    def record(self, trace, stages=None):
+        """
+        Parameters:
+        -----------
+            trace: dict: Finished trace. Ignored if None.
+            stages: list: Only these stages (and the total latencies) are recorded. None records all of them.
+        """
+        if trace is None:
+            return
+
+        latencies = stage_latencies(trace, stages=stages)
+        with self.lock:
+            self.traces += 1
+            for (stage, latency) in latencies.items():
+                self.histograms.setdefault(stage, LatencyHistogram()).record(latency)
+
+    def percentiles(self):
+        """stage -> {'count': int, 'p50': float, 'p95': float, 'p99': float} with the latencies in seconds"""
+        with self.lock:
+            return {stage: dict(count=histogram.count,
+                                **{f"p{q}": histogram.percentile(q) for q in self.PERCENTILES})
+                    for (stage, histogram) in self.histograms.items()}
+
+    def print_summary(self, title="Latency per stage"):
+        print(bcolors.HEADER + f"{title} ({self.traces} traces) [ms]" + bcolors.ENDC)
+        for (stage, stats) in sorted(self.percentiles().items(), key=lambda item: stage_order(item[0])):
+            print(f"    {stage:<28} n={stats['count']:<7} " +
+                  "  ".join(f"p{q}={stats[f'p{q}'] * 1e3:9.2f}" for q in self.PERCENTILES))
+
+
+def stage_order(stage):
+    """Sort key of the stages: pipeline order, then the totals"""
+    if stage.startswith(Stages.TOTAL_PREFIX):
+        return len(Stages.ORDER), stage
+    return (Stages.ORDER.index(stage), stage) if stage in Stages.ORDER else (len(Stages.ORDER) + 1, stage)
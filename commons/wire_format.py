@@ -0,0 +1,237 @@
+"""
+Binary wire format of the time series exchanged by the modules (forecasts, optimal results and battery set points).
+
+A regular time series only needs the first time stamp, the time step, the number of rows and the values. A frame is:
+
+    header:  magic (4s) | version (B) | flags (B) | columns (H) | start [ns] (q) | step [ns] (q) | rows (I) | meta (I)
+    meta:    JSON dict with the names and dtypes of the columns, the name and time zone of the index (8 bytes aligned)
+    data:    [time stamps as int64 if the series is irregular] + one little-endian array per column
+
+All numbers are little-endian, so the arrays are read without copies with np.frombuffer. The receivers detect the
+format with the magic bytes and fall back to the pandas JSON format otherwise, so JSON is still accepted (and sent
+with wire_format='json').
+
+A message can carry a header of scalars (e.g., the parameters of the optimization) next to the time series: in the
+meta data of a binary frame, or as {"header": {...}, "frame": {...}} in JSON. A latency trace (see commons.tracing) is
+sent the same way, with the key 'trace'.
+"""
+
+import struct
+import json
+import numpy as np
+import pandas as pd
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+MAGIC = b'MQWF'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHqqII')
+FLAG_IRREGULAR = 0x01  # The time stamps are sent as an int64 array
+ALIGNMENT = 8
+
+WIRE_FORMATS = ['json', 'binary', 'binary32']  # 'binary32' sends the float columns as float32
+HEADER_KEY = 'header'
+FRAME_KEY = 'frame'
+TRACE_KEY = 'trace'
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def is_binary(payload):
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(MAGIC)]) == MAGIC
+
+
+def encode_frame(frame, float_dtype=np.float64, extra_meta=None):
+    """
+    Parameters:
+    -----------
+        frame: pd.DataFrame: Numeric columns indexed by time stamps (pd.DatetimeIndex). A pd.Series is one column.
+        float_dtype: np.dtype: Type used for the float columns (e.g., np.float32 to halve the size).
+        extra_meta: dict: Extra (JSON serializable) entries for the meta data of the frame.
+
+    Returns:
+    --------
+        bytes: Binary frame.
+    """
+    if isinstance(frame, pd.Series):
+        frame = frame.to_frame()
+
+    time_stamps = pd.DatetimeIndex(frame.index)
+    rows = len(time_stamps)
+    time_stamps_ns = time_stamps.asi8  # UTC if the time stamps are tz-aware
+
+    flags = 0
+    start = int(time_stamps_ns[0]) if rows else 0
+    step = int(time_stamps_ns[1] - time_stamps_ns[0]) if rows > 1 else 0
+    if rows > 2 and np.any(np.diff(time_stamps_ns) != step):
+        flags |= FLAG_IRREGULAR
+
+    arrays = []
+    dtypes = []
+    for column in frame.columns:
+        values = np.asarray(frame[column].values)
+        if values.dtype.kind == 'f':
+            values = values.astype(np.dtype(float_dtype).newbyteorder('<'), copy=False)
+        elif values.dtype.kind in 'iub':
+            values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        else:
+            raise WireFormatError(f"Column '{column}' of type {values.dtype} can not be sent in a binary frame")
+        arrays.append(values)
+        dtypes.append(values.dtype.str)
+
+    meta = {'index': frame.index.name,
+            'tz': str(time_stamps.tz) if time_stamps.tz is not None else None,
+            'columns': [str(column) for column in frame.columns],
+            'dtypes': dtypes}
+    meta.update(extra_meta or {})
+    meta = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    meta += b' ' * (-(HEADER.size + len(meta)) % ALIGNMENT)
+
+    chunks = [HEADER.pack(MAGIC, VERSION, flags, len(arrays), start, step, rows, len(meta)), meta]
+    if flags & FLAG_IRREGULAR:
+        chunks.append(time_stamps_ns.astype('<i8').tobytes())
+    chunks.extend(values.tobytes() for values in arrays)
+
+    return b''.join(chunks)
+
+
+def parse_binary(payload):
+    """
+    Parse a binary frame with numpy only. The arrays are read-only views of the payload.
+
+    Returns:
+    --------
+        time_stamps_ns: np.array: Time stamps as int64 nanoseconds (UTC if meta['tz'] is not None).
+        columns: dict: column name -> np.array
+        meta: dict: Meta data of the frame (name of the index, time zone, ...)
+    """
+    payload = memoryview(payload)
+    if len(payload) < HEADER.size:
+        raise WireFormatError("Payload shorter than the header of a binary frame")
+
+    (magic, version, flags, n_columns, start, step, rows, meta_length) = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise WireFormatError("Payload is not a binary frame")
+    if version != VERSION:
+        raise WireFormatError(f"Binary frame version {version} not supported (version {VERSION} expected)")
+
+    offset = HEADER.size
+    meta = json.loads(bytes(payload[offset:offset + meta_length]))
+    offset += meta_length
+
+    if flags & FLAG_IRREGULAR:
+        time_stamps_ns = np.frombuffer(payload, dtype='<i8', count=rows, offset=offset)
+        offset += time_stamps_ns.nbytes
+    else:
+        time_stamps_ns = start + step * np.arange(rows, dtype=np.int64)
+
+    columns = dict()
+    for (column, dtype) in zip(meta['columns'], meta['dtypes']):
+        values = np.frombuffer(payload, dtype=dtype, count=rows, offset=offset)
+        offset += values.nbytes
+        columns[column] = values
+
+    if len(columns) != n_columns:
+        raise WireFormatError("Number of columns of the header and the meta data do not match")
+
+    return time_stamps_ns, columns, meta
+
+
+def to_time_index(time_stamps_ns, tz=None, name=None):
+    """pd.DatetimeIndex of int64 nanoseconds (UTC if tz is given)"""
+    time_stamps = pd.DatetimeIndex(np.asarray(time_stamps_ns, dtype=np.int64).view('datetime64[ns]'), name=name)
+    if tz is not None:
+        time_stamps = time_stamps.tz_localize('UTC').tz_convert(tz)
+
+    return time_stamps
+
+
+def decode_arrays(payload):
+    """
+    Decode a binary frame without building a data frame. The arrays are read-only views of the payload.
+
+    Returns:
+    --------
+        time_stamps: pd.DatetimeIndex: Time stamps of the series.
+        columns: dict: column name -> np.array
+        meta: dict: Meta data of the frame (name of the index, time zone, ...)
+    """
+    (time_stamps_ns, columns, meta) = parse_binary(payload)
+
+    return to_time_index(time_stamps_ns, tz=meta['tz'], name=meta['index']), columns, meta
+
+
+def decode_frame(payload):
+    (time_stamps, columns, meta) = decode_arrays(payload)
+
+    return pd.DataFrame(columns, index=time_stamps)
+
+
+def write_frame(frame, wire_format='json', orient=None, header=None, trace=None):
+    """
+    Serialize a time series for a MQTT payload.
+
+    Parameters:
+    -----------
+        frame: pd.DataFrame: Columns indexed by time stamps. The index name is the name of the date column in JSON.
+        wire_format: str: One of WIRE_FORMATS.
+        orient: str: Orientation of the JSON message (see pd.DataFrame.to_json). Not used by the binary formats.
+        header: dict: Scalars sent once with the time series (JSON serializable). None for no header.
+        trace: dict: Latency trace of the message (see commons.tracing). None if the message is not traced.
+    """
+    extra_meta = dict()
+    if header is not None:
+        extra_meta[HEADER_KEY] = header
+    if trace is not None:
+        extra_meta[TRACE_KEY] = trace
+
+    if wire_format == 'json':
+        message = frame.reset_index().to_json(date_format='iso', orient=orient)
+        if not extra_meta:
+            return message
+        message = f'{{"{HEADER_KEY}":{json.dumps(header or {})},"{FRAME_KEY}":{message}'
+        if trace is not None:
+            message += f',"{TRACE_KEY}":{json.dumps(trace)}'
+        return message + '}'
+    elif wire_format == 'binary':
+        return encode_frame(frame, extra_meta=extra_meta or None)
+    elif wire_format == 'binary32':
+        return encode_frame(frame, float_dtype=np.float32, extra_meta=extra_meta or None)
+
+    raise WireFormatError(f"Wire format should be one of {WIRE_FORMATS}")
+
+
+def read_frame(payload, date_column):
+    """
+    Deserialize a time series of a MQTT payload (binary or JSON, detected automatically).
+
+    Parameters:
+    -----------
+        payload: bytes: Payload of the message.
+        date_column: str: Name of the date column of the JSON messages. It becomes the index of the frame.
+
+    Returns:
+    --------
+        pd.DataFrame: Frame indexed by the time stamps.
+    """
+    if is_binary(payload):
+        return decode_frame(payload)
+
+    received_message = payload.decode('utf-8')
+    if received_message.startswith(f'{{"{HEADER_KEY}"'):  # The header is not part of the frame
+        received_message = json.dumps(json.loads(received_message)[FRAME_KEY])
+
+    received_message_frame = pd.read_json(received_message, convert_dates=[date_column])
+
+    return received_message_frame.set_index(date_column, drop=True)
+
+
+def payload_summary(payload):
+    """Text to print a payload in the logs"""
+    if is_binary(payload):
+        return f"<binary frame, {len(payload)} bytes>"
+
+    return payload
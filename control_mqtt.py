@@ -4,20 +4,66 @@ import pandas as pd
 import json
 import numpy as np
 import argparse
-from commons.parameters import BatteryParameters, ControlParameters, bcolors, Topics
+import threading
+from concurrent import futures
+from commons.parameters import BatteryParameters, ControlParameters, Topics
+from commons.inbox import CoalescingInbox
+from commons.solution_cache import SolutionCache
+from commons.wire_format import WIRE_FORMATS, write_frame, read_frame, payload_summary
+from commons.forecast_stream import StreamDecoder, is_stream
+from commons.message_view import TimeSeriesView
+from commons.module_runtime import ModuleRuntime
+from commons.tracing import Stages, StageHistograms, stamp
+from commons.publisher import Publisher, SUPERSEDED, GUARANTEED
+from commons.solver_session import IpoptSession
+from commons.qp_solver import PrefixSumQP, QPStatus
+from commons.log import get_logger, configure, lazy, LEVELS
 import os
 
+log = get_logger('control')
+
 
 class ControlModule:
     """
     Control module based on an MPC optimizer.
     """
-
-    def __init__(self):
+    SOLVERS = ['ipopt', 'qp']
+    FORMULATIONS = ['full', 'condensed']
+    # Battery parameters used by the optimizer (the key of the solution cache). POWER_OUTPUT is a measurement.
+    MODEL_BATTERY_PARAMETERS = [BatteryParameters.NOMINAL_ENERGY,
+                                BatteryParameters.MAX_POWER_DISCHARGE,
+                                BatteryParameters.MAX_POWER_CHARGE,
+                                BatteryParameters.DELTA_T,
+                                BatteryParameters.SOC_MIN,
+                                BatteryParameters.SOC_MAX,
+                                BatteryParameters.EFFICIENCY,
+                                BatteryParameters.SOC_INI_ACTUAL]
+
+    def __init__(self, solver='ipopt', formulation='full', fine_steps=None, block_length=4, cache_size=0,
+                 cache_tolerance=1e-3):
         """ Default battery settings that will be used for the optimizer (This avoids the optimizer to crash)
          This dictionary will be updated by the battery module constantly.
          The following parameters are the minimum required to do the optimization. Therefore, this is a "copy" of the
-         parameters that are in the battery module"""
+         parameters that are in the battery module
+
+         solver: 'ipopt' solves the pyomo model with ipopt. 'qp' solves the same problem in-process with the native
+                 convex QP solver (no pyomo model, no .nl files and no solver process).
+         formulation: 'full' pyomo model with Pb, Pn and SoCb as variables. 'condensed' pyomo model with Pb as the only
+                      variable, Pn and SoCb are reconstructed after the solve (only used by the 'ipopt' solver).
+         fine_steps: Move blocking of the horizon. The first 'fine_steps' steps keep the resolution of the forecast and
+                     after that Pb is held constant in blocks of 'block_length' steps. None disables the blocking.
+                     The size of the problem only shrinks with the 'condensed' formulation or the 'qp' solver, the
+                     'full' formulation adds equality constraints between the steps of a block.
+         cache_size: Number of optimal solutions kept in a LRU cache, keyed by the forecast (quantized with
+                     'cache_tolerance' [kW]) and the inputs of the optimizer (SoC, limits, threshold). 0 disables the
+                     cache."""
+        assert solver in self.SOLVERS, f"Solver should be one of {self.SOLVERS}"
+        assert formulation in self.FORMULATIONS, f"Formulation should be one of {self.FORMULATIONS}"
+        self.solver = solver
+        self.formulation = formulation
+        self.fine_steps = fine_steps
+        self.block_length = block_length
+
         self.battery_params = {BatteryParameters.NOMINAL_ENERGY: 16,
                                BatteryParameters.MAX_POWER_DISCHARGE: 6,
                                BatteryParameters.MAX_POWER_CHARGE: 6,
@@ -39,42 +85,63 @@ class ControlModule:
                                  np.zeros(self.controller_params[ControlParameters.OPTIMIZER_WINDOW])))
         self.time_stamps_forecast = None
         self.model = None
+        self.model_blocks = None
         self.update_optimization_model()
 
+        self.solver_session = None
+        self.create_solver_session()
+
+        self.solution_cache = SolutionCache(cache_size, cache_tolerance) if cache_size > 0 else None
+
         # Internal controller state variables: (Some could come from the user module).
         self.battery_on_line = False
 
+    def create_solver_session(self):
+        """The solver session is kept alive between solves (warm start for ipopt, problem structure for the QP)"""
+        if self.solver == 'ipopt':
+            self.solver_session = IpoptSession(warm_start=True)
+        else:
+            self.solver_session = PrefixSumQP()
+
+    def close(self):
+        """Release the solver session (the log file of ipopt)"""
+        if self.solver == 'ipopt' and self.solver_session is not None:
+            self.solver_session.close()
+
     def update_forecast(self, Pd):
         assert isinstance(Pd, pd.DataFrame), "Forecast should be a pandas Data Frame with timestamp"
-        power_values = Pd.values.ravel()
+        self.update_forecast_values(Pd.values.ravel(), Pd.index)
 
-        self.time_stamps_forecast = Pd.index[:self.controller_params[ControlParameters.OPTIMIZER_WINDOW]]
+    def update_forecast_values(self, power_values, time_stamps):
+        """Same as update_forecast() with the values and time stamps of the forecast as arrays"""
+        self.time_stamps_forecast = time_stamps[:self.controller_params[ControlParameters.OPTIMIZER_WINDOW]]
         self.forecast = dict(zip(range(self.controller_params[ControlParameters.OPTIMIZER_WINDOW]),
                                  power_values[:self.controller_params[ControlParameters.OPTIMIZER_WINDOW]]))
         self.update_optimization_model()
-        print("Forecast and model updated")
+        log.debug('forecast_updated', steps=len(self.forecast))
 
     def update_battery_parameters(self, **kwargs):
         if set(kwargs.keys()).issubset(BatteryParameters.VALID_KEYS):
             self.battery_params.update(kwargs)
-            print(f"BATTERY Parameters updated: {kwargs}")
-            print(f"SoC_ini in the controller: {round(self.battery_params[BatteryParameters.SOC_INI_ACTUAL], 3)}")
-
+            log.debug('battery_parameters_updated', parameters=lazy(str, kwargs),
+                      soc_ini=round(self.battery_params[BatteryParameters.SOC_INI_ACTUAL], 3))
         else:
-            print(bcolors.FAIL + "One of the dictionary keys of BATTERY parameters not valid" + bcolors.ENDC)
+            log.warning('invalid_battery_parameters',
+                        keys=lazy(sorted, set(kwargs.keys()) - set(BatteryParameters.VALID_KEYS)))
         self.update_optimization_model()
 
     def update_controller_parameters(self, **kwargs):
         if set(kwargs.keys()).issubset(ControlParameters.VALID_KEYS):
             self.controller_params.update(kwargs)
-            print(f"CONTROLLER Parameters updated: {kwargs}")
-            print(f"Power Threshold in the controller: {self.controller_params[ControlParameters.POWER_THRESHOLD]}")
+            log.info('controller_parameters_updated', parameters=lazy(str, kwargs),
+                     power_threshold=self.controller_params[ControlParameters.POWER_THRESHOLD])
         else:
-            print(bcolors.FAIL + "One of the dictionary keys of CONTROLLER parameters is not valid" + bcolors.ENDC)
+            log.warning('invalid_controller_parameters',
+                        keys=lazy(sorted, set(kwargs.keys()) - set(ControlParameters.VALID_KEYS)))
         self.update_optimization_model()
 
     def update_optimization_window(self, new_window):
-        print(f"New window: {int(new_window)}")
+        log.info('optimization_window_updated', window=int(new_window))
         self.controller_params[ControlParameters.OPTIMIZER_WINDOW] = int(new_window)
         self.update_optimization_model()
 
@@ -82,38 +149,78 @@ class ControlModule:
         self.controller_params[ControlParameters.POWER_THRESHOLD] = new_power_threshold
         self.update_optimization_model()
 
-    def update_optimization_model(self):
-        self.model = ControlModule.mpc_model(self.forecast,
-                                             self.controller_params[ControlParameters.POWER_THRESHOLD],
-                                             **self.battery_params)
+    def update_horizon_shape(self, fine_steps, block_length=4):
+        log.info('horizon_shape_updated', fine_steps=fine_steps, block_length=block_length)
+        self.fine_steps = fine_steps
+        self.block_length = int(block_length)
+        self.update_optimization_model()
 
-    def solve_model(self):
-        solver = SolverFactory('ipopt')
-        results = solver.solve(self.model, tee=False)
+    def horizon_blocks(self):
+        """Length (in time steps) of each block of the horizon where Pb is held constant"""
+        n = len(self.forecast)
+        if self.fine_steps is None:
+            return np.ones(n, dtype=int)
 
-        if (results.solver.status == SolverStatus.ok) and (
-                results.solver.termination_condition == TerminationCondition.optimal):
-            print('Found optimal solution')
-            print(f'-- SoC initial: {self.battery_params[BatteryParameters.SOC_INI_ACTUAL]}')
+        n_fine = min(int(self.fine_steps), n)
+        (n_blocks, remainder) = divmod(n - n_fine, self.block_length)
+        block_lengths = np.concatenate([np.ones(n_fine, dtype=int),
+                                        np.full(n_blocks, self.block_length, dtype=int)])
+        if remainder:
+            block_lengths = np.append(block_lengths, remainder)
 
-        elif results.solver.termination_condition == TerminationCondition.infeasible:
-            print('Solution Infeasible')
-            print(f'-- SoC initial: {self.battery_params[BatteryParameters.SOC_INI_ACTUAL]}')
+        return block_lengths
+
+    def update_optimization_model(self):
+        """The optimization model is persistent: it is built once per window size (and horizon shape) and afterwards
+        only its mutable parameters (forecast, SoC, limits and threshold) are patched in place."""
+        if self.solver != 'ipopt':  # The QP matrices are built at solve time from the current parameters.
+            return
+
+        blocks = tuple(self.horizon_blocks())
+        if (self.model is None) or (len(self.model.T) != len(self.forecast)) or (blocks != self.model_blocks):
+            if self.formulation == 'condensed':
+                mpc_model = ControlModule.mpc_model_condensed
+            else:
+                mpc_model = ControlModule.mpc_model
+            self.model = mpc_model(self.forecast,
+                                   self.controller_params[ControlParameters.POWER_THRESHOLD],
+                                   blocks=blocks,
+                                   **self.battery_params)
+            self.model_blocks = blocks
+        else:
+            ControlModule.update_mpc_model(self.model,
+                                           self.forecast,
+                                           self.controller_params[ControlParameters.POWER_THRESHOLD],
+                                           **self.battery_params)
+
+    def solve_model(self):
+        if self.solution_cache is not None:
+            model_battery_params = {key_: self.battery_params[key_] for key_ in self.MODEL_BATTERY_PARAMETERS}
+            cache_key = self.solution_cache.make_key(list(self.forecast.values()),
+                                                     model_battery_params,
+                                                     self.controller_params,
+                                                     self.solver,
+                                                     self.formulation,
+                                                     self.horizon_blocks())
+            results_optimizer = self.solution_cache.get(cache_key)
+            if results_optimizer is not None:
+                log.debug('solution_cache_hit', hit_ratio=round(self.solution_cache.hit_ratio(), 2))
+                results_optimizer[ControlParameters.DATE_STAMP_OPTIMAL] = self.time_stamps_forecast
+                for key_ in self.battery_params.keys() - model_battery_params.keys():  # Not part of the key
+                    results_optimizer[key_] = self.battery_params[key_]
+                return results_optimizer
+
+        if self.solver == 'qp':
+            (p_battery, p_net_demand, soc_battery) = self.solve_qp()
         else:
-            print('Something went wrong')
+            (p_battery, p_net_demand, soc_battery) = self.solve_ipopt()
 
         # Built optimal results data frame, adding the parameters used for the optimization
         results_dict = {ControlParameters.DATE_STAMP_OPTIMAL: self.time_stamps_forecast,
                         ControlParameters.FORECAST_VALUES: np.array(list(self.forecast.values())),
-                        ControlParameters.BATTERY_POWER_OPTIMAL:
-                            np.array([self.model.Pb[t].value
-                                      for t in np.arange(self.controller_params[ControlParameters.OPTIMIZER_WINDOW])]),
-                        ControlParameters.NET_POWER_OPTIMAL:
-                            np.array([self.model.Pn[t].value
-                                      for t in np.arange(self.controller_params[ControlParameters.OPTIMIZER_WINDOW])]),
-                        ControlParameters.SOC_BATTERY_OPTIMAL:
-                            np.array([self.model.SoCb[t].value
-                                      for t in np.arange(self.controller_params[ControlParameters.OPTIMIZER_WINDOW])])}
+                        ControlParameters.BATTERY_POWER_OPTIMAL: p_battery,
+                        ControlParameters.NET_POWER_OPTIMAL: p_net_demand,
+                        ControlParameters.SOC_BATTERY_OPTIMAL: soc_battery}
 
         battery_parameters = dict()
         for (key_, value_) in self.battery_params.items():
@@ -130,10 +237,138 @@ class ControlModule:
         results_dict.update(controller_parameters)
         results_optimizer = pd.DataFrame(results_dict)
 
+        if self.solution_cache is not None:
+            self.solution_cache.put(cache_key, results_optimizer)
+
         return results_optimizer
 
+    def soc_ini_within_limits(self):
+        """The full model fixes SoCb[0] = SoCini within [SoCmin, SoCmax]: it is infeasible otherwise"""
+        return (self.battery_params[BatteryParameters.SOC_MIN] <= self.battery_params[BatteryParameters.SOC_INI_ACTUAL]
+                <= self.battery_params[BatteryParameters.SOC_MAX])
+
+    def solve_ipopt(self):
+        if self.formulation == 'condensed' and not self.soc_ini_within_limits():  # Infeasible, as the full model
+            log.warning('solution_infeasible', soc_ini=self.battery_params[BatteryParameters.SOC_INI_ACTUAL])
+            p_battery = np.zeros(len(self.forecast))
+            return (p_battery,) + self.reconstruct_trajectories(p_battery)
+
+        results = self.solver_session.solve(self.model)
+
+        if (results.solver.status == SolverStatus.ok) and (
+                results.solver.termination_condition == TerminationCondition.optimal):
+            log.debug('optimal_solution', iterations=self.solver_session.last_iterations,
+                      soc_ini=self.battery_params[BatteryParameters.SOC_INI_ACTUAL])
+
+        elif results.solver.termination_condition == TerminationCondition.infeasible:
+            log.warning('solution_infeasible', soc_ini=self.battery_params[BatteryParameters.SOC_INI_ACTUAL])
+        else:
+            log.error('solver_failed', status=results.solver.status,
+                      termination=results.solver.termination_condition)
+
+        if self.formulation == 'condensed':
+            p_battery_blocks = np.array([self.model.Pb[b].value for b in self.model.B])
+            p_battery = np.repeat(p_battery_blocks, self.model_blocks)
+            return (p_battery,) + self.reconstruct_trajectories(p_battery)
+
+        p_battery = np.array([self.model.Pb[t].value for t in self.model.T])
+
+        p_net_demand = np.array([self.model.Pn[t].value for t in self.model.T])
+        soc_battery = np.array([self.model.SoCb[t].value for t in self.model.T])
+
+        return p_battery, p_net_demand, soc_battery
+
+    def solve_qp(self):
+        """Solve the MPC problem with the native QP solver. Same problem as mpc_model(), written in Pb only:
+
+            minimize     sum((Pd + Pb - Pn_max)^2)
+            subject to   -Pb_discharg_max <= Pb[t] <= Pb_charg_max
+                         SoCmin <= SoCini + (n_b * Delta_t / Pbnom) * sum(Pb[:t]) <= SoCmax
+
+        With move blocking, the variables are the Pb of each block and the SoC limits are checked at the end of each
+        block (the SoC is monotonic within a block), the last one at the last step of the horizon.
+        """
+        Pd = np.array(list(self.forecast.values()), dtype=float)
+        block_lengths = self.horizon_blocks()
+        block_starts = np.cumsum(block_lengths) - block_lengths
+        n = len(block_lengths)
+        c = (self.battery_params[BatteryParameters.EFFICIENCY] * self.battery_params[BatteryParameters.DELTA_T]
+             / self.battery_params[BatteryParameters.NOMINAL_ENERGY])
+        SoCini = self.battery_params[BatteryParameters.SOC_INI_ACTUAL]
+        SoCmin = self.battery_params[BatteryParameters.SOC_MIN]
+        SoCmax = self.battery_params[BatteryParameters.SOC_MAX]
+
+        # The prefix sum k is the SoC at the end of block k. The end of the last block is outside the horizon, so the
+        # last prefix sum is the SoC at its last step (t = n - 1), none if the last block has one step.
+        soc_weights = block_lengths.copy()
+        soc_lower = np.full(n, (SoCmin - SoCini) / c)
+        soc_upper = np.full(n, (SoCmax - SoCini) / c)
+        if block_lengths[-1] == 1:
+            (soc_lower[-1], soc_upper[-1]) = (-np.inf, np.inf)
+        else:
+            soc_weights[-1] -= 1
+
+        if self.soc_ini_within_limits():
+            (p_battery_blocks, status) = self.solver_session.solve(
+                p=2.0 * block_lengths,
+                q=2.0 * np.add.reduceat(Pd - self.controller_params[ControlParameters.POWER_THRESHOLD], block_starts),
+                w=soc_weights,
+                x_lower=np.full(n, -self.battery_params[BatteryParameters.MAX_POWER_DISCHARGE]),
+                x_upper=np.full(n, self.battery_params[BatteryParameters.MAX_POWER_CHARGE]),
+                s_lower=soc_lower,
+                s_upper=soc_upper)
+        else:
+            (p_battery_blocks, status) = (np.zeros(n), QPStatus.INFEASIBLE)
+
+        if status == QPStatus.OPTIMAL:
+            log.debug('optimal_solution', iterations=self.solver_session.last_iterations, soc_ini=SoCini)
+        elif status == QPStatus.INFEASIBLE:
+            log.warning('solution_infeasible', soc_ini=SoCini)
+        else:
+            log.error('solver_failed', status=status)
+
+        p_battery = np.repeat(p_battery_blocks, block_lengths)
+
+        return (p_battery,) + self.reconstruct_trajectories(p_battery)
+
+    def reconstruct_trajectories(self, p_battery):
+        """Net demand and state of charge of the battery that correspond to the battery power trajectory"""
+        Pd = np.array(list(self.forecast.values()), dtype=float)
+        c = (self.battery_params[BatteryParameters.EFFICIENCY] * self.battery_params[BatteryParameters.DELTA_T]
+             / self.battery_params[BatteryParameters.NOMINAL_ENERGY])
+
+        p_net_demand = Pd + p_battery
+        soc_battery = (self.battery_params[BatteryParameters.SOC_INI_ACTUAL]
+                       + c * np.concatenate([[0.0], np.cumsum(p_battery[:-1])]))
+
+        return p_net_demand, soc_battery
+
     @staticmethod
-    def mpc_model(Pd, Pn_max, **kwargs):
+    def split_results(results_optimizer):
+        """
+        Results message: the trajectories indexed by the time stamps and a header with the battery and controller
+        parameters, which are constant over the horizon (the results data frame repeats them on every row).
+        """
+        trajectories = results_optimizer.set_index(ControlParameters.DATE_STAMP_OPTIMAL)
+        parameters = [column for column in trajectories.columns if column not in ControlParameters.TRAJECTORIES]
+        header = {column: trajectories[column].values[0].item() for column in parameters}
+
+        return trajectories[ControlParameters.TRAJECTORIES], header
+
+    @staticmethod
+    def shift_results(results_optimizer):
+        """Optimal trajectory shifted one time step ahead: the first step is dropped and the last one is repeated"""
+        shifted = pd.concat([results_optimizer.iloc[1:], results_optimizer.iloc[[-1]]], ignore_index=True)
+
+        time_stamps = results_optimizer[ControlParameters.DATE_STAMP_OPTIMAL]
+        if (len(time_stamps) > 1) and (time_stamps.iloc[-1] is not None):
+            shifted.loc[len(shifted) - 1, ControlParameters.DATE_STAMP_OPTIMAL] = \
+                time_stamps.iloc[-1] + (time_stamps.iloc[-1] - time_stamps.iloc[-2])
+
+        return shifted
+
+    @staticmethod
+    def mpc_model(Pd, Pn_max, blocks=None, **kwargs):
         # Set default parameters to avoid a crash in the optimizer
         Pbnom = kwargs.setdefault(BatteryParameters.NOMINAL_ENERGY, 15)
         Pb_discharg_max = kwargs.setdefault(BatteryParameters.MAX_POWER_DISCHARGE, 6)
@@ -184,7 +419,7 @@ class ControlModule:
             if t == 0:
                 return (model.SoCb[t] == model.SoCini)
             else:
-                return (model.SoCb[t] == model.SoCb[t - 1] + (n_b * model.Pb[t - 1] * Delta_t) / (model.Pbnom))
+                return (model.SoCb[t] == model.SoCb[t - 1] + (model.n_b * model.Pb[t - 1] * model.Delta_t) / (model.Pbnom))
 
         model.define_state_of_charge_battery = Constraint(model.T, rule=define_state_of_charge_battery_rule)
 
@@ -208,13 +443,118 @@ class ControlModule:
 
         model.define_limits_charg = Constraint(model.T, rule=define_limits_charg_rule)
 
+        # Move blocking: Pb is held constant within each block of the horizon
+        block_starts = set(T) if blocks is None else set((np.cumsum(blocks) - np.array(blocks)).tolist())
+
+        def define_move_blocking_rule(model, t):
+            if t in block_starts:
+                return Constraint.Skip
+            return model.Pb[t] == model.Pb[t - 1]
+
+        model.define_move_blocking = Constraint(model.T, rule=define_move_blocking_rule)
+
+        return model
+
+    @staticmethod
+    def mpc_model_condensed(Pd, Pn_max, blocks=None, **kwargs):
+        """Same problem as mpc_model() with Pb as the only decision variable. Pn[t] = Pd[t] + Pb[t] is substituted in
+        the objective, and the SoC bounds become bounds on the prefix sums of Pb (SoCb[0] = SoCini is not a constraint,
+        so the caller checks SoCmin <= SoCini <= SoCmax, see ControlModule.soc_ini_within_limits()).
+        With move blocking, Pb is indexed by the blocks of the horizon and the SoC is bounded at the end of each block,
+        the last one at the last step of the horizon.
+        """
+        # Set default parameters to avoid a crash in the optimizer
+        Pbnom = kwargs.setdefault(BatteryParameters.NOMINAL_ENERGY, 15)
+        Pb_discharg_max = kwargs.setdefault(BatteryParameters.MAX_POWER_DISCHARGE, 6)
+        Pb_charg_max = kwargs.setdefault(BatteryParameters.MAX_POWER_CHARGE, 6)
+        Delta_t = kwargs.setdefault(BatteryParameters.DELTA_T, 0.25)
+        SoCmin = kwargs.setdefault(BatteryParameters.SOC_MIN, 0.2)
+        SoCmax = kwargs.setdefault(BatteryParameters.SOC_MAX, 1.0)
+        n_b = kwargs.setdefault(BatteryParameters.EFFICIENCY, 1.0)
+        SoCini = kwargs.setdefault(BatteryParameters.SOC_INI_ACTUAL, 0.8)
+        T = list(Pd.keys())
+
+        # Type of Model
+        model = ConcreteModel()
+
+        blocks = [1] * len(T) if blocks is None else list(blocks)
+        B = list(range(len(blocks)))
+        block_of = dict(zip(T, np.repeat(B, blocks).tolist()))  # Block that contains each time step
+
+        # Sets
+        model.T = Set(initialize=T)
+        model.B = Set(initialize=B)
+
+        # Parameters
+        model.Pd = Param(model.T, initialize=Pd, mutable=True)
+        model.n_b = Param(initialize=n_b, mutable=True)
+        model.SoCini = Param(initialize=SoCini, mutable=True)
+        model.SoCmin = Param(initialize=SoCmin, mutable=True)
+        model.SoCmax = Param(initialize=SoCmax, mutable=True)
+        model.Delta_t = Param(initialize=Delta_t, mutable=True)
+        model.Pbnom = Param(initialize=Pbnom, mutable=True)
+        model.Pb_charg_max = Param(initialize=Pb_charg_max, mutable=True)
+        model.Pb_discharg_max = Param(initialize=Pb_discharg_max, mutable=True)
+        model.Pn_max = Param(initialize=Pn_max, mutable=True)
+
+        # Variables
+        model.Pb = Var(model.B, initialize=0.0)
+
+        # -----------    Objective Function  ----------------------------------
+        def min_net_power(model):
+            return sum(((model.Pd[t] + model.Pb[block_of[t]] - model.Pn_max) ** 2) for t in model.T)
+
+        model.obj = Objective(rule=min_net_power)
+
+        # -----------    Constraints  -----------------------------------------
+        # The end of the last block is outside the horizon: its SoC is bounded at the last step (t = n - 1)
+        soc_weights = blocks[:-1] + [blocks[-1] - 1]
+
+        def define_limits_soc_rule(model, b):
+            if soc_weights[b] == 0:  # Last block of one step: its last step is the end of the previous block
+                return Constraint.Skip
+            energy_change = ((model.n_b * model.Delta_t / model.Pbnom)
+                             * sum(soc_weights[i] * model.Pb[i] for i in B[:b + 1]))
+            return inequality(model.SoCmin - model.SoCini, energy_change, model.SoCmax - model.SoCini)
+
+        model.define_limits_soc = Constraint(model.B, rule=define_limits_soc_rule)
+
+        def define_limits_power_rule(model, b):
+            return inequality(- model.Pb_discharg_max, model.Pb[b], model.Pb_charg_max)
+
+        model.define_limits_power = Constraint(model.B, rule=define_limits_power_rule)
+
+        return model
+
+    @staticmethod
+    def update_mpc_model(model, Pd, Pn_max, **kwargs):
+        """Patch the mutable parameters of a model created by mpc_model() or mpc_model_condensed(). Pd must have the same keys as model.T.
+        Parameters not given in kwargs keep their current value in the model."""
+        assert len(Pd) == len(model.T), "Forecast length differs from the model window. Rebuild the model."
+
+        model.Pd.store_values(Pd)
+        model.Pn_max.set_value(Pn_max)
+        model.Pbnom.set_value(kwargs.get(BatteryParameters.NOMINAL_ENERGY, value(model.Pbnom)))
+        model.Pb_discharg_max.set_value(kwargs.get(BatteryParameters.MAX_POWER_DISCHARGE, value(model.Pb_discharg_max)))
+        model.Pb_charg_max.set_value(kwargs.get(BatteryParameters.MAX_POWER_CHARGE, value(model.Pb_charg_max)))
+        model.Delta_t.set_value(kwargs.get(BatteryParameters.DELTA_T, value(model.Delta_t)))
+        model.SoCmin.set_value(kwargs.get(BatteryParameters.SOC_MIN, value(model.SoCmin)))
+        model.SoCmax.set_value(kwargs.get(BatteryParameters.SOC_MAX, value(model.SoCmax)))
+        model.n_b.set_value(kwargs.get(BatteryParameters.EFFICIENCY, value(model.n_b)))
+        model.SoCini.set_value(kwargs.get(BatteryParameters.SOC_INI_ACTUAL, value(model.SoCini)))
+
         return model
 
 
-class ControlMQTT(ControlModule, mqtt.Client):
+class ControlAgent(ControlModule):
     """
-    This class handles the subscription and publications of the control module.
-    The module checks the message and executes the control and/or updates accordingly
+    One controller (control_id) with its own topic table, fed by an MQTT client that calls inbox.put() and used by
+    the agent to publish the results.
+
+    The messages are processed by a worker thread, so the MQTT network loop is never blocked by the solver.
+    If a solve takes longer than solve_deadline [seconds], the last valid trajectory shifted by one step is published.
+    Forecasts and battery status messages are coalesced (latest wins): the worker applies all pending updates in one
+    batch and solves once for the newest forecast.
     """
 
     def __init__(self,
@@ -222,84 +562,206 @@ class ControlMQTT(ControlModule, mqtt.Client):
                  controlled_sensor_id,
                  controlled_phase_id,
                  battery_id,
-                 client_id_mqtt,
-                 mqtt_server_ip,
-                 mqtt_server_port):
-
-        ControlModule.__init__(self)
-        mqtt.Client.__init__(self, client_id=client_id_mqtt + "_" + str(control_id))
+                 client=None,
+                 publisher=None,
+                 solver_executor=None,
+                 fleet=None,
+                 wire_format='json',
+                 solver='ipopt',
+                 formulation='full',
+                 fine_steps=None,
+                 block_length=4,
+                 solve_deadline=None,
+                 cache_size=0,
+                 cache_tolerance=1e-3):
+        """
+        client: MQTT client used to publish the results.
+        publisher: Publisher (see commons.publisher) of the client. Agents hosted on the same client share it. None
+                   creates a publisher for the client.
+        solver_executor: Executor that runs the solves. Agents hosted in the same process share one executor, so only
+                         one pyomo model is written/solved at a time. None creates an executor for this agent.
+        fleet: FleetSolver (see fleet_solver.py). If given, the model and the solves of this agent live in a worker
+               process of the fleet and solver_executor is not used.
+        wire_format: Format of the published results and set points (see commons.wire_format). The received
+                     forecasts are decoded in any format.
+        """
+
+        self.fleet = fleet  # Needed before the first update of the model
+
+        ControlModule.__init__(self, solver=solver, formulation=formulation, fine_steps=fine_steps,
+                               block_length=block_length, cache_size=cache_size, cache_tolerance=cache_tolerance)
 
         self.control_id = control_id
         self.controlled_sensor_id = controlled_sensor_id
         self.controlled_phase_id = controlled_phase_id
         self.battery_id = battery_id
         self.battery_on_line = False
+        self.client = client
+        self.publisher = publisher if (publisher is not None or client is None) else Publisher(client)
+        self.wire_format = wire_format
+
+        self.topics = Topics.table(# Subscribe
+                                   forecast_topic=f"{controlled_sensor_id}_" + f"{controlled_phase_id}",
+                                   battery_settings_topic=f"battery_{battery_id}",
+                                   user_control_setting_topic=f"control_{control_id}",
+                                   user_set_model_topic=f"control_{control_id}",
+                                   # Publish
+                                   controller_settings_response=f"control_{control_id}",
+                                   controller_set_battery_power_topic=f"battery_{battery_id}",
+                                   controller_results=f"control_{control_id}")
+        if self.publisher is not None:  # A new trajectory supersedes the queued one, the set points are never dropped
+            self.publisher.set_policy(self.topics.controller_results, SUPERSEDED)
+            self.publisher.set_policy(self.topics.controller_set_battery_power_topic, GUARANTEED)
+
+        # Worker that updates the model and solves it, fed by inbox.put()
+        self.solve_deadline = solve_deadline
+        self.last_results = None  # Last valid optimal trajectory
+        self.inbox = CoalescingInbox(latest_wins_topics=[self.topics.forecast_topic,
+                                                         self.topics.battery_settings_topic])
+        self.forecast_stream = StreamDecoder()  # Window of the forecast in streaming mode
+        self.messages_solved = 0
+        self.trace = None  # Latency trace of the forecast being solved (see commons.tracing)
+        self.latency = StageHistograms()
+        self.owns_executor = solver_executor is None
+        self.solver_executor = futures.ThreadPoolExecutor(max_workers=1) if self.owns_executor else solver_executor
+        self.worker = threading.Thread(target=self.solver_worker, daemon=True)
+        self.worker.start()
+
+        if self.fleet is not None:
+            self.fleet.register(control_id,
+                                solver=solver,
+                                formulation=formulation,
+                                fine_steps=fine_steps,
+                                block_length=block_length,
+                                cache_size=cache_size,
+                                cache_tolerance=cache_tolerance)
 
-        self.topics = Topics
-
-        # Subscribe
-        self.topics.forecast_topic += f"{controlled_sensor_id}_" + f"{controlled_phase_id}"
-        self.topics.battery_settings_topic += f"battery_{battery_id}"
-        self.topics.user_control_setting_topic += f"control_{control_id}"
-        self.topics.user_set_model_topic += f"control_{control_id}"
-
-        # Publish
-        self.topics.controller_settings_response += f"control_{control_id}"
-        self.topics.controller_set_battery_power_topic += f"battery_{battery_id}"
-        self.topics.controller_results += f"control_{control_id}"
-
-        self.qos = 1
-        self.connect(host=mqtt_server_ip,
-                     port=mqtt_server_port)
-
-    def on_connect(self, mqtt, obj, flags, rc):
-        print("Connected with result code " + str(rc))
-
-        # Subscriber topics
-        print(f"Subscribing to: {self.topics.forecast_topic}")
-        self.subscribe(self.topics.forecast_topic, self.qos)
-
-        print(f"Subscribing to: {self.topics.battery_settings_topic}")
-        self.subscribe(self.topics.battery_settings_topic, self.qos)
-
-        print(f"Subscribing to: {self.topics.user_control_setting_topic}")
-        self.subscribe(self.topics.user_control_setting_topic, self.qos)
+    def update_optimization_model(self):
+        if self.fleet is None:  # Otherwise, the model is updated in the worker of the fleet
+            ControlModule.update_optimization_model(self)
 
-        print(f"Subscribing to: {self.topics.user_set_model_topic}")
-        self.subscribe(self.topics.user_set_model_topic, self.qos)
+    def create_solver_session(self):
+        if self.fleet is None:  # Otherwise, the session lives in the worker of the fleet
+            ControlModule.create_solver_session(self)
 
-    def on_message(self, client, userdata, msg):
+    def solve_model(self):
+        """With a fleet, the model and the solver session of this process are only built if the agent solves locally"""
+        if self.fleet is not None:
+            ControlModule.update_optimization_model(self)
+            if self.solver_session is None:
+                ControlModule.create_solver_session(self)
+
+        return ControlModule.solve_model(self)
+
+    def submit_solve(self):
+        """Returns a future with the results data frame"""
+        if self.fleet is None:
+            return self.solver_executor.submit(self.solve_model)
+
+        return self.fleet.submit(self.control_id,
+                                 list(self.forecast.values()),
+                                 self.time_stamps_forecast,
+                                 battery_params=self.battery_params,
+                                 controller_params=self.controller_params)
+
+    def receive(self, topic, payload):
+        """
+        Called by the MQTT client (network loop) for every message of this agent. The forecasts are decoded here
+        (TimeSeriesView) and stamped with their arrival time if they are traced. The deltas of a forecast stream are
+        applied before the inbox coalesces the forecasts, so no delta is lost. The rebuilt window is queued.
+        """
+        if topic == self.topics.forecast_topic:
+            if is_stream(payload):
+                payload = self.forecast_stream.decode(payload)
+                if payload is None:
+                    log.warning('forecast_stream_out_of_sync', control_id=self.control_id, rate_limit=10.0,
+                                key=self.control_id)
+                    return
+            else:
+                payload = TimeSeriesView.from_payload(payload, date_column=ControlParameters.DATE_STAMP_OPTIMAL)
+            stamp(payload.trace, Stages.CONTROL_RECEIVE)
+
+        self.inbox.put(topic, payload)
+
+    def subscribed_topics(self):
+        return [self.topics.forecast_topic,
+                self.topics.battery_settings_topic,
+                self.topics.user_control_setting_topic,
+                self.topics.user_set_model_topic]
+
+    def solver_worker(self):
+        while True:
+            batch = self.inbox.take_all()
+            if batch is None:
+                break
+
+            # Apply all the pending updates, then solve once for the newest forecast
+            forecast_updated = False
+            for (topic, payloads) in batch.items():
+                for payload in payloads:
+                    try:
+                        forecast_updated = self.process_message(topic, payload) or forecast_updated
+                    except Exception as error:
+                        log.error('message_failed', control_id=self.control_id, topic=topic,
+                                  error=f"{type(error).__name__}: {error}")
+
+            if forecast_updated:
+                try:
+                    self.solve_and_publish()
+                    self.messages_solved += 1
+                except Exception as error:
+                    log.error('solve_failed', control_id=self.control_id, error=f"{type(error).__name__}: {error}")
+                log.info('message_counters', control_id=self.control_id, rate_limit=10.0, key=self.control_id,
+                         received=self.inbox.received, coalesced=self.inbox.coalesced, solved=self.messages_solved)
+
+            self.inbox.task_done(batch)
+
+    def wait_idle(self, timeout=None):
+        """Wait until the received messages were processed and the results published. False if the timeout expired."""
+        return self.inbox.join(timeout)
+
+    def stop_worker(self):
+        self.inbox.close()
+        self.worker.join()
+        if self.owns_executor:
+            self.solver_executor.shutdown(wait=True)
+        self.close()
+        if self.latency.traces:
+            self.latency.print_summary(f"Latency per stage, controller {self.control_id}")
+
+    def message_counters(self):
+        """Counters to size the deployment. Coalesced messages were superseded before being processed (dropped)."""
+        return {'received': self.inbox.received,
+                'coalesced': self.inbox.coalesced,
+                'coalesced_forecasts': self.inbox.coalesced_per_topic.get(self.topics.forecast_topic, 0),
+                'stream_dropped': self.forecast_stream.dropped,
+                'solved': self.messages_solved,
+                'pending': self.inbox.pending_count()}
+
+    def process_message(self, topic, payload):
+        """Update the controller with the message. Returns True if the forecast was updated (a solve is needed)."""
         is_command_processed = False
-        print("--" * 100)
-        print(bcolors.OKGREEN + f"Message received on topic: {msg.topic}" + bcolors.ENDC)
+        forecast_updated = False
 
-        if msg.topic == self.topics.forecast_topic:  # Received a Forecast
-            print(bcolors.OKGREEN + "Receiving forecast" + bcolors.ENDC)
-            received_message = msg.payload.decode('utf-8')
-            received_message_frame = pd.read_json(received_message,
-                                                  convert_dates=[ControlParameters.DATE_STAMP_OPTIMAL])
-            received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL, drop=True)
+        if topic == self.topics.forecast_topic:  # Received a Forecast
+            log.debug('forecast_received', control_id=self.control_id)
+            if isinstance(payload, TimeSeriesView):  # Decoded by receive()
+                received_message_frame = payload.to_frame()
+                self.trace = payload.trace
+            else:
+                received_message_frame = read_frame(payload, date_column=ControlParameters.DATE_STAMP_OPTIMAL)
+                self.trace = None
 
             self.update_forecast(received_message_frame)
-            results_optimizer = self.solve_model()
-            message = results_optimizer.to_json(date_format='iso')
-            self.publish_response(topic=self.topics.controller_results, payload=message)  # For the DB Manager module
-
-            if self.battery_on_line:
-                print("Sending the new battery output power...")
-                message = results_optimizer[[ControlParameters.DATE_STAMP_OPTIMAL,
-                                             ControlParameters.BATTERY_POWER_OPTIMAL]].to_json(date_format='iso',
-                                                                                               orient='records')
-                # For the battery module
-                self.publish_response(topic=self.topics.controller_set_battery_power_topic, payload=message)
-            else:
-                print("Battery is off-line... THE OUTPUT POWER WAS NOT SET")
+            if self.fleet is None:  # Otherwise, the model is built by the fleet worker (included in the solve)
+                stamp(self.trace, Stages.MODEL_BUILD)
+            forecast_updated = True
 
             is_command_processed = True
 
-        elif msg.topic == self.topics.battery_settings_topic:  # Received new battery settings DO NOT SOLVE ANYTHING
-            print(bcolors.WARNING + "Receiving battery settings" + bcolors.ENDC)
-            received_message = msg.payload.decode('utf-8')
+        elif topic == self.topics.battery_settings_topic:  # Received new battery settings DO NOT SOLVE ANYTHING
+            log.debug('battery_settings_received', control_id=self.control_id)
+            received_message = payload.decode('utf-8')
             received_message_dict = json.loads(received_message)
 
             # Remove the timestamp of the parameters (Not used for this update but used for the Database manager module)
@@ -309,31 +771,211 @@ class ControlMQTT(ControlModule, mqtt.Client):
 
             if not self.battery_on_line:  # Battery send updates for the first time
                 self.battery_on_line = True
-                print("**** BATTERY ON-LINE ****")
+                log.info('battery_online', control_id=self.control_id, battery_id=self.battery_id)
 
             is_command_processed = True
 
-        elif msg.topic == self.topics.user_control_setting_topic:  # New controller settings DO NOT SOLVE ANYTHING
-            received_message = msg.payload.decode('utf-8')
+        elif topic == self.topics.user_control_setting_topic:  # New controller settings DO NOT SOLVE ANYTHING
+            received_message = payload.decode('utf-8')
             received_message_dict = json.loads(received_message)
             try:
                 assert isinstance(received_message, dict), "Controller settings should be a dictionary"
                 self.update_controller_parameters(**received_message_dict)
                 is_command_processed = True
             except AssertionError:
-                print("Battery settings was not a dictionary, UPDATE ABORTED")
+                log.warning('invalid_controller_settings', control_id=self.control_id)
                 is_command_processed = False
 
-        if is_command_processed:
-            print("All messages processed")
+        if not is_command_processed:
+            log.warning('message_not_processed', control_id=self.control_id, topic=topic)
+
+        return forecast_updated
+
+    def solve_and_publish(self):
+        solution = self.submit_solve()
+        try:
+            results_optimizer = solution.result(timeout=self.solve_deadline)
+        except futures.TimeoutError:
+            log.warning('solve_deadline_exceeded', control_id=self.control_id, deadline=self.solve_deadline,
+                        shifted_trajectory=self.last_results is not None)
+            if self.last_results is not None:  # Publish the last valid trajectory shifted by one step
+                self.last_results = ControlModule.shift_results(self.last_results)
+                self.publish_results(self.last_results)
+
+            # The model can not be updated while the solver is running. The late solution is not published, but it
+            # is newer than the shifted trajectory, so it is kept as the last valid one.
+            self.last_results = solution.result()
+            return
+
+        stamp(self.trace, Stages.SOLVE)
+        self.last_results = results_optimizer
+        self.publish_results(results_optimizer)
+
+    def publish_results(self, results_optimizer):
+        (trajectories, header) = ControlModule.split_results(results_optimizer)
+        trace = stamp(self.trace, Stages.CONTROL_PUBLISH)
+        self.trace = None  # A trace is published once (not with the late solution after a deadline)
+        message = write_frame(trajectories, self.wire_format, header=header, trace=trace)
+        self.publish_response(topic=self.topics.controller_results, payload=message)  # For the DB Manager module
+
+        if self.battery_on_line:
+            message = write_frame(trajectories[[ControlParameters.BATTERY_POWER_OPTIMAL]], self.wire_format,
+                                  orient='records', trace=trace)
+            # For the battery module
+            self.publish_response(topic=self.topics.controller_set_battery_power_topic, payload=message)
         else:
-            print("Something went wrong")
+            log.warning('battery_offline', control_id=self.control_id, battery_id=self.battery_id, rate_limit=60.0,
+                        key=self.control_id)
+
+        self.latency.record(trace)
 
     def publish_response(self, topic, payload):
-        print(bcolors.OKBLUE + f"Publishing on topic: {topic}" + bcolors.ENDC)
-        result_mqtt = self.publish(topic=topic, payload=payload)
+        log.debug('publish', topic=topic, payload=lazy(payload_summary, payload))
+        self.publisher.publish(topic, payload)
 
-        return result_mqtt
+
+class ControlMQTT(ControlAgent, mqtt.Client):
+    """
+    This class handles the subscription and publications of one control module on its own MQTT connection.
+    The module checks the message and executes the control and/or updates accordingly.
+    """
+
+    def __init__(self,
+                 control_id,
+                 controlled_sensor_id,
+                 controlled_phase_id,
+                 battery_id,
+                 client_id_mqtt,
+                 mqtt_server_ip,
+                 mqtt_server_port,
+                 wire_format='json',
+                 solver='ipopt',
+                 formulation='full',
+                 fine_steps=None,
+                 block_length=4,
+                 solve_deadline=None,
+                 cache_size=0,
+                 cache_tolerance=1e-3):
+
+        mqtt.Client.__init__(self, client_id=client_id_mqtt + "_" + str(control_id))
+        ControlAgent.__init__(self,
+                              control_id=control_id,
+                              controlled_sensor_id=controlled_sensor_id,
+                              controlled_phase_id=controlled_phase_id,
+                              battery_id=battery_id,
+                              client=self,
+                              wire_format=wire_format,
+                              solver=solver,
+                              formulation=formulation,
+                              fine_steps=fine_steps,
+                              block_length=block_length,
+                              solve_deadline=solve_deadline,
+                              cache_size=cache_size,
+                              cache_tolerance=cache_tolerance)
+
+        self.qos = 1
+        self.connect(host=mqtt_server_ip,
+                     port=mqtt_server_port)
+
+    def on_connect(self, mqtt, obj, flags, rc):
+        log.info('connected', client_id=self._client_id.decode('utf-8'), rc=rc)
+
+        # Subscriber topics
+        for topic in self.subscribed_topics():
+            log.info('subscribe', topic=topic)
+            self.subscribe(topic, self.qos)
+
+    def on_message(self, client, userdata, msg):
+        """Runs in the network loop: only hands the message over to the solver worker"""
+        log.debug('message_received', topic=msg.topic, size=len(msg.payload))
+        self.receive(msg.topic, msg.payload)
+
+    def process_mqtt_messages(self):
+        self.loop()
+
+
+class ControlHost(mqtt.Client):
+    """
+    Runs N controllers (one per control_id/sensor/phase) on a single MQTT connection.
+
+    The host subscribes with wildcards to the input topics of all the controllers and dispatches every message to the
+    inbox of its controller with a dict lookup on the topic. Each controller keeps its own topic table, worker thread
+    and model; the solves are serialized on one executor shared by all the controllers. With a fleet of worker
+    processes, the models live in the workers and the solves of different controllers run in parallel.
+    """
+    SUBSCRIPTIONS = [Topics.forecast_topic + "+",
+                     Topics.battery_settings_topic + "+",
+                     Topics.user_control_setting_topic + "+",
+                     Topics.user_set_model_topic + "+"]
+
+    def __init__(self, client_id_mqtt, mqtt_server_ip, mqtt_server_port, fleet=None):
+        """
+        fleet: FleetSolver (see fleet_solver.py) that solves the MPC of the hosted controllers. None solves them in
+               this process.
+        """
+        mqtt.Client.__init__(self, client_id=client_id_mqtt)
+
+        self.agents = dict()  # control_id -> ControlAgent
+        self.routes = dict()  # topic -> list of ControlAgent subscribed to the topic
+        self.messages_unrouted = 0
+        self.solver_executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.fleet = fleet
+        self.publisher = Publisher(self)  # Shared by the controllers
+
+        self.qos = 1
+        self.connect(host=mqtt_server_ip,
+                     port=mqtt_server_port)
+
+    def add_controller(self, control_id, controlled_sensor_id, controlled_phase_id, battery_id, **control_settings):
+        """
+        Parameters:
+        -----------
+            control_settings: Keyword arguments of ControlAgent e.g., solver='qp', solve_deadline=10.0
+        """
+        assert control_id not in self.agents, f"Controller {control_id} already exists"
+
+        agent = ControlAgent(control_id=control_id,
+                             controlled_sensor_id=controlled_sensor_id,
+                             controlled_phase_id=controlled_phase_id,
+                             battery_id=battery_id,
+                             client=self,
+                             publisher=self.publisher,
+                             solver_executor=self.solver_executor,
+                             fleet=self.fleet,
+                             **control_settings)
+        self.agents[control_id] = agent
+        for topic in agent.subscribed_topics():
+            self.routes.setdefault(topic, []).append(agent)
+
+        return agent
+
+    def on_connect(self, mqtt, obj, flags, rc):
+        log.info('connected', client_id=self._client_id.decode('utf-8'), rc=rc)
+
+        for topic in self.SUBSCRIPTIONS:
+            log.info('subscribe', topic=topic)
+            self.subscribe(topic, self.qos)
+
+    def on_message(self, client, userdata, msg):
+        """Runs in the network loop: only hands the message over to the workers of the controllers"""
+        agents = self.routes.get(msg.topic)
+        if agents is None:
+            self.messages_unrouted += 1
+            log.debug('message_unrouted', topic=msg.topic)
+            return
+
+        for agent in agents:
+            agent.receive(msg.topic, msg.payload)
+
+    def message_counters(self):
+        return {control_id: agent.message_counters() for (control_id, agent) in self.agents.items()}
+
+    def stop_workers(self):
+        for agent in self.agents.values():
+            agent.stop_worker()
+        self.solver_executor.shutdown(wait=True)
+        if self.fleet is not None:
+            self.fleet.shutdown()
 
     def process_mqtt_messages(self):
         self.loop()
@@ -355,6 +997,32 @@ if __name__ == '__main__':
                         help="Name of the sensor measurement")
     parser.add_argument('-L', '--phaseid', required=False, default='l1',
                         help="Phase of the sensor measurement e.g., 'l1', 'l2' or 'l3'")
+    parser.add_argument('--solver', required=False, type=str, default='ipopt', choices=ControlModule.SOLVERS,
+                        help="'ipopt': Pyomo model solved by ipopt. 'qp': Native in-process convex QP solver.")
+    parser.add_argument('--formulation', required=False, type=str, default='full', choices=ControlModule.FORMULATIONS,
+                        help="'full': Pb, Pn and SoCb as variables. 'condensed': Pb as the only variable (ipopt).")
+    parser.add_argument('--finesteps', required=False, type=int, default=None,
+                        help="Steps of the horizon at full resolution. After that, Pb is held constant in blocks.")
+    parser.add_argument('--blocklength', required=False, type=int, default=4,
+                        help="Steps per block after the fine steps of the horizon, e.g., 4 for hourly blocks.")
+    parser.add_argument('--deadline', required=False, type=float, default=None,
+                        help="Max. seconds per solve. If exceeded, the last trajectory shifted one step is published.")
+    parser.add_argument('--cachesize', required=False, type=int, default=0,
+                        help="Number of optimal solutions kept in a LRU cache for repeated inputs. 0 disables it.")
+    parser.add_argument('--cachetolerance', required=False, type=float, default=1e-3,
+                        help="Quantization step [kW] of the forecast values for the keys of the solution cache.")
+    parser.add_argument('-M', '--controllers', required=False, type=str, default=None,
+                        help="Host several controllers on one MQTT connection. Comma separated list of "
+                             "control_id:sensor_id:phase_id:battery_id e.g., '1:gebouw:l1:1,2:gebouw:l2:2'. "
+                             "The control, sensor, phase and battery ids of the command line are then ignored.")
+    parser.add_argument('--wire-format', required=False, type=str, default='json', choices=WIRE_FORMATS,
+                        help="Format of the published results and set points. Received messages are auto-detected.")
+    parser.add_argument('-W', '--workers', required=False, type=int, default=0,
+                        help="Worker processes that solve the MPC of the hosted controllers in parallel (only with "
+                             "--controllers). 0 solves them in the MQTT process.")
+    parser.add_argument('--log-level', required=False, type=str, default=None, choices=LEVELS,
+                        help="Level of the log. DEBUG logs every message and its payload. Default: the environment "
+                             "variable LOG_LEVEL or INFO.")
 
     args, unknown = parser.parse_known_args()
 
@@ -367,13 +1035,58 @@ if __name__ == '__main__':
     print(f"Battery id: {args.batteryid}")
     print(f"Sensor id: {args.sensorid}")
     print(f"Phase id: {args.phaseid}")
-
-    power_controller_mqtt = ControlMQTT(control_id=args.controlid,
-                                        controlled_sensor_id=args.sensorid,
-                                        controlled_phase_id=args.phaseid,
-                                        battery_id=args.batteryid,
-                                        client_id_mqtt=args.clientid,
-                                        mqtt_server_ip=args.host,
-                                        mqtt_server_port=args.port)
-    while True:
-        power_controller_mqtt.process_mqtt_messages()
+    print(f"Solver: {args.solver}")
+    print(f"Formulation: {args.formulation}")
+    print(f"Horizon: {args.finesteps} fine steps, blocks of {args.blocklength} steps")
+    print(f"Solver deadline: {args.deadline} seconds")
+    print(f"Solution cache: {args.cachesize} entries, tolerance {args.cachetolerance} kW")
+    print(f"Hosted controllers: {args.controllers}")
+    print(f"Worker processes: {args.workers}")
+    print(f"Wire format: {args.wire_format}")
+    print(f"Log level: {args.log_level or os.environ.get('LOG_LEVEL', 'INFO')}")
+    configure(args.log_level)
+
+    control_settings = dict(wire_format=args.wire_format,
+                            solver=args.solver,
+                            formulation=args.formulation,
+                            fine_steps=args.finesteps,
+                            block_length=args.blocklength,
+                            solve_deadline=args.deadline,
+                            cache_size=args.cachesize,
+                            cache_tolerance=args.cachetolerance)
+
+    runtime = ModuleRuntime()
+    if args.controllers is not None:
+        fleet = None
+        if args.workers > 0:
+            from fleet_solver import FleetSolver  # fleet_solver imports this module
+            fleet = FleetSolver(workers=args.workers)
+
+        control_host = ControlHost(client_id_mqtt=args.clientid,
+                                   mqtt_server_ip=args.host,
+                                   mqtt_server_port=args.port,
+                                   fleet=fleet)
+        for controller in args.controllers.split(','):
+            (control_id, sensor_id, phase_id, battery_id) = controller.strip().split(':')
+            control_host.add_controller(control_id=int(control_id),
+                                        controlled_sensor_id=sensor_id,
+                                        controlled_phase_id=phase_id,
+                                        battery_id=int(battery_id),
+                                        **control_settings)
+        runtime.add_client(control_host)
+        runtime.add_stop_callback(control_host.stop_workers)
+        runtime.add_stop_callback(control_host.publisher.close)
+    else:
+        power_controller_mqtt = ControlMQTT(control_id=args.controlid,
+                                            controlled_sensor_id=args.sensorid,
+                                            controlled_phase_id=args.phaseid,
+                                            battery_id=args.batteryid,
+                                            client_id_mqtt=args.clientid,
+                                            mqtt_server_ip=args.host,
+                                            mqtt_server_port=args.port,
+                                            **control_settings)
+        runtime.add_client(power_controller_mqtt)
+        runtime.add_stop_callback(power_controller_mqtt.stop_worker)
+        runtime.add_stop_callback(power_controller_mqtt.publisher.close)
+
+    runtime.run()
@@ -3,10 +3,21 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import json
-from commons.parameters import BatteryParameters, ControlParameters, Topics, bcolors
-from commons.timescaledb_connection import TimescaledbConnection
+from commons.parameters import BatteryParameters, ControlParameters, Topics
+from commons.timescaledb_connection import TimescaledbConnection, BufferedWriter, LongFrame, LATENCY_COLUMNS
+from commons.timescaledb_connection import SCHEMAS, PLAIN
+from commons.message_view import TimeSeriesView
+from commons.forecast_stream import StreamDecoder, is_stream
+from commons.module_runtime import ModuleRuntime
+from commons.tracing import Stages, StageHistograms, stamp, stage_latencies, LATENCY_TABLE
+from commons.log import get_logger, configure, LEVELS
+from commons.inbox import BoundedInbox, POLICIES, BLOCK
+import datetime
+import threading
 import argparse
 
+log = get_logger('dbmanager')
+
 
 class DBManager:
     def __init__(self):
@@ -16,20 +27,22 @@ class DBManager:
         self.continue_simulation = True
 
     def melt_dataframe(self, message_frame):
-        """Return a dataframe with the PostgreSQL table format."""
-
-        ## Optional way to melt the dataframe.
-        # df_new = df.reset_index()
-        # df_new = pd.melt(df_new, id_vars="datetimeFC", value_vars=df_new.drop('datetimeFC', axis=1), var_name="channel", value_name="values_channel")
+        """Rows of a wide data frame (time index, one column per channel) in the PostgreSQL table format."""
+        return LongFrame.from_frame(message_frame, decimals=2)
 
-        df_output = message_frame.stack(0).reset_index().rename(columns={"level_1": "channel", 0: "value"})
-        df_output['channel'] = pd.Categorical(df_output['channel'].tolist(), ordered=True,
-                                              categories=df_output['channel'].unique().tolist())
-        df_output = df_output.sort_values(['channel', 'datetimeFC']).reset_index(drop=True)
-        df_output['datetimeFC'] = df_output['datetimeFC'].astype(str)
-        df_output = df_output.round(2)
+    def melt_view(self, message_view, rows=None):
+        """
+        Rows of a message in the PostgreSQL table format, straight from its arrays: sorted by channel, then by time,
+        and rounded to 2 decimals.
 
-        return df_output
+        Parameters:
+        -----------
+            message_view: TimeSeriesView: Decoded message.
+            rows: int: Only the first rows of the message (None: all of them).
+        """
+        return LongFrame.from_columns(message_view.time_stamps_ns[:rows],
+                                      {name: values[:rows] for (name, values) in message_view.columns.items()},
+                                      decimals=2)
 
 
 class DBManagerMQTT(DBManager, mqtt.Client, TimescaledbConnection):
@@ -46,26 +59,68 @@ class DBManagerMQTT(DBManager, mqtt.Client, TimescaledbConnection):
                  password_db,
                  port_db=5432,
                  ip_db='localhost',
-                 clear_table_db=True):
+                 clear_table_db=True,
+                 collect_latency=False,
+                 pool_size_db=4,
+                 flush_rows_db=500,
+                 flush_interval_db=1.0,
+                 queue_size_db=10000,
+                 backpressure_db=BLOCK,
+                 spill_dir_db=None,
+                 schema_db=PLAIN,
+                 chunk_interval_db='1 day',
+                 compress_after_db='7 days'):
+        """
+        collect_latency: Collector mode: store the latency traces (results of the controller and set points applied
+                         by the battery) in the table commons.tracing.LATENCY_TABLE (see latency_report.py).
+        pool_size_db: Persistent connections to the database (see commons.timescaledb_connection.ConnectionPool).
+        flush_rows_db: Rows of a table written together with COPY (see commons.timescaledb_connection.BufferedWriter).
+        flush_interval_db: Max. time a row waits in the buffer before it is written [seconds].
+        queue_size_db: Messages waiting for the writer thread in memory (see commons.inbox.BoundedInbox).
+        backpressure_db: What happens when the queue is full: 'block' the network loop, 'drop-oldest' or 'spill' the
+                         messages to a file in spill_dir_db (default: temporary directory).
+        schema_db: Schema of the log tables: 'plain' or 'hypertable' (Timescale hypertables with channel ids, index and
+                   compression, see commons.timescaledb_connection.TimescaledbConnection).
+        chunk_interval_db: Time range of a chunk of the hypertables (PostgreSQL interval).
+        compress_after_db: Age of the chunks compressed by Timescale (PostgreSQL interval). None: not compressed.
+        """
         DBManager.__init__(self)
         mqtt.Client.__init__(self, client_id=user_id_mqtt)
-        TimescaledbConnection.__init__(self, username=username_db, password=password_db, host=ip_db, port=port_db)
+        TimescaledbConnection.__init__(self, username=username_db, password=password_db, host=ip_db, port=port_db,
+                                       pool_size=pool_size_db, schema=schema_db, chunk_interval=chunk_interval_db,
+                                       compress_after=compress_after_db)
         self.db_table_name_control = f"operation_log_control_{control_id}"
         self.db_table_name_battery = f"operation_log_battery_{battery_id}"
+        self.db_table_name_parameters = f"operation_log_parameters_control_{control_id}"
 
         self.create_table(table_name=self.db_table_name_control, clear_table=clear_table_db)
         self.create_table(table_name=self.db_table_name_battery, clear_table=clear_table_db)
+        self.create_table(table_name=self.db_table_name_parameters, clear_table=clear_table_db)
+        self.last_parameters = dict()  # Last value of each parameter stored in the parameters table
+        self.db_writer = BufferedWriter(self, max_rows=flush_rows_db, max_delay=flush_interval_db)
+
+        self.collect_latency = collect_latency
+        self.latency = StageHistograms()
+        if collect_latency:
+            self.create_latency_table(table_name=LATENCY_TABLE, clear_table=clear_table_db)
 
         self.last_message_controller = []
         self.last_message_forecast = []
         self.last_message_sensor = []
 
-        self.topics = Topics
-        # Subscribe
-        self.topics.controller_results += f"control_{control_id}"
-        self.topics.forecast_topic += f"{controlled_sensor_id}_" + f"{controlled_phase_id}"
-        self.topics.sensor_topic += f"{controlled_sensor_id}_" + f"{controlled_phase_id}"
-        self.topics.battery_settings_topic += f"battery_{battery_id}"
+        self.topics = Topics.table(# Subscribe
+                                   controller_results=f"control_{control_id}",
+                                   forecast_topic=f"{controlled_sensor_id}_" + f"{controlled_phase_id}",
+                                   sensor_topic=f"{controlled_sensor_id}_" + f"{controlled_phase_id}",
+                                   battery_settings_topic=f"battery_{battery_id}")
+        self.streams = {self.topics.forecast_topic: StreamDecoder(),  # Windows of the forecast module (streaming mode)
+                        self.topics.sensor_topic: StreamDecoder()}
+
+        # Writer thread: decodes, melts and stores the messages queued by on_message(), so a slow database does not
+        # stall the network loop
+        self.db_inbox = BoundedInbox(max_items=queue_size_db, policy=backpressure_db, spill_dir=spill_dir_db)
+        self.db_worker = threading.Thread(target=self.writer_worker, name='db_writer', daemon=True)
+        self.db_worker.start()
 
         # Connect to the MQTT Mosquitto
         self.qos = 1
@@ -73,89 +128,149 @@ class DBManagerMQTT(DBManager, mqtt.Client, TimescaledbConnection):
                      port=mqtt_server_port)
 
     def on_connect(self, mqtt, obj, flags, rc):
-        print("Connected with result code " + str(rc))
+        log.info('connected', client_id=self._client_id.decode('utf-8'), rc=rc)
 
         # Subscriber topics
-        print(f"Subscribing to: {self.topics.controller_results}")
-        self.subscribe(self.topics.controller_results, self.qos)
-
-        print(f"Subscribing to: {self.topics.forecast_topic}")
-        self.subscribe(self.topics.forecast_topic, self.qos)
+        topics = [self.topics.controller_results,
+                  self.topics.forecast_topic,
+                  self.topics.sensor_topic,
+                  self.topics.forecast_stop_simulation,
+                  self.topics.battery_settings_topic]
+        if self.collect_latency:  # Traces finished by the battery modules
+            topics.append(Topics.latency_trace + '+')
+
+        for topic in topics:
+            log.info('subscribe', topic=topic)
+            self.subscribe(topic, self.qos)
 
-        print(f"Subscribing to: {self.topics.sensor_topic}")
-        self.subscribe(self.topics.sensor_topic, self.qos)
+    def on_message(self, client, userdata, msg):
+        """Network loop: the messages are only queued, they are decoded and stored by the writer thread"""
+        log.debug('message_received', topic=msg.topic, size=len(msg.payload))
 
-        print(f"Subscribing to: {self.topics.forecast_stop_simulation}")
-        self.subscribe(self.topics.forecast_stop_simulation, self.qos)
+        if msg.topic == self.topics.forecast_stop_simulation:  # The writer stores the queued messages in the shutdown
+            log.info('simulation_stopped')
+            self.continue_simulation = False
+            return
 
-        print(f"Subscribing to: {self.topics.battery_settings_topic}")
-        self.subscribe(self.topics.battery_settings_topic, self.qos)
+        self.db_inbox.put((msg.topic, msg.payload))
 
-    def on_message(self, client, userdata, msg):
-        print("--" * 100)
-        print(bcolors.OKGREEN + f"Message received on topic: {msg.topic}" + bcolors.ENDC)
+    def process_message(self, topic, payload):
+        if topic == self.topics.controller_results:  # Received the solution of the optimization
+            received_message = TimeSeriesView.from_payload(payload,
+                                                           date_column=ControlParameters.DATE_STAMP_OPTIMAL)
+            first_row_frame = received_message.to_frame(rows=1)  # Only the first step is stored
 
-        if msg.topic == self.topics.controller_results:  # Received the solution of the optimization
-            received_message = msg.payload.decode('utf-8')
-            received_message_frame = pd.read_json(received_message,
-                                                  convert_dates=[ControlParameters.DATE_STAMP_OPTIMAL])
-            received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL, drop=True)
-            # self.last_message_controller.append(received_message_frame)
+            # Save message on database: first step of the trajectories and only the parameters that changed
+            self.store(self.melt_view(received_message, rows=1), table_name=self.db_table_name_control)
 
-            # Save message on database:
-            df_output = self.melt_dataframe(received_message_frame.iloc[[0], :])
-            self.insert_data(df_output, table_name=self.db_table_name_control)
+            parameters = received_message.header
+            changed_parameters = {key_: value_ for (key_, value_) in parameters.items()
+                                  if self.last_parameters.get(key_) != value_}
+            if changed_parameters:
+                parameters_rows = LongFrame.from_columns(received_message.time_stamps_ns[:1],
+                                                         {key_: [value_] for (key_, value_)
+                                                          in changed_parameters.items()})
+                self.store(parameters_rows, table_name=self.db_table_name_parameters)
+                self.last_parameters.update(changed_parameters)
 
             # Save message locally:
-            self.solutions = pd.concat([self.solutions, received_message_frame.iloc[[0], :]])
+            self.solutions = pd.concat([self.solutions, first_row_frame.assign(**parameters)])
 
+            if received_message.trace is not None:
+                self.finish_trace(stamp(received_message.trace, Stages.DB_INSERT))
 
-        elif msg.topic == self.topics.forecast_topic:  # This data is also in controller_results
-            received_message = msg.payload.decode('utf-8')
-            received_message_frame = pd.read_json(received_message,
-                                                  convert_dates=[ControlParameters.DATE_STAMP_OPTIMAL])
-            received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL, drop=True)
-            # self.last_message_forecast.append(received_message_frame)
-            self.predicted_power = pd.concat([self.predicted_power, received_message_frame.iloc[[0], :]])
 
-        elif msg.topic == self.topics.sensor_topic:
-            received_message = msg.payload.decode('utf-8')
-            received_message_frame = pd.read_json(received_message,
-                                                  convert_dates=[ControlParameters.DATE_STAMP_OPTIMAL])
-            received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL, drop=True)
-            self.last_message_sensor.append(received_message_frame)
+        elif topic == self.topics.forecast_topic:  # This data is also in controller_results
+            received_message = self.read_time_series(topic, payload)
+            if received_message is None:
+                return
+            self.predicted_power = pd.concat([self.predicted_power, received_message.to_frame(rows=1)])
+
+        elif topic == self.topics.sensor_topic:
+            received_message = self.read_time_series(topic, payload)
+            if received_message is None:
+                return
+            self.last_message_sensor.append(received_message)
+            first_row_frame = received_message.to_frame(rows=1)
 
             # Save message on database:
-            df_output = self.melt_dataframe(received_message_frame.iloc[[0], :])
-            self.insert_data(df_output, table_name=self.db_table_name_control)
+            self.store(self.melt_view(received_message, rows=1), table_name=self.db_table_name_control)
 
             # Save message locally:
-            self.real_power = pd.concat([self.real_power, received_message_frame.iloc[[0], :]])
+            self.real_power = pd.concat([self.real_power, first_row_frame])
 
 
-        elif msg.topic == self.topics.battery_settings_topic:  # Received new battery settings DO NOT SOLVE ANYTHING
-            print(bcolors.WARNING + "Receiving battery settings" + bcolors.ENDC)
-            received_message = msg.payload.decode('utf-8')
+        elif topic == self.topics.battery_settings_topic:  # Received new battery settings DO NOT SOLVE ANYTHING
+            received_message = payload.decode('utf-8')
             received_message_dict = json.loads(received_message)
 
-            received_message_frame = pd.DataFrame.from_dict(received_message_dict, orient='index').transpose()
-            received_message_frame = received_message_frame.set_index(ControlParameters.DATE_STAMP_OPTIMAL, drop=True)
-            df_output = user_module_mqtt.melt_dataframe(received_message_frame)
+            (time_stamps_ns, _) = TimeSeriesView.parse_iso_dates(
+                [received_message_dict.pop(ControlParameters.DATE_STAMP_OPTIMAL)])
+            settings_rows = LongFrame.from_columns(time_stamps_ns, {key_: [value_] for (key_, value_)
+                                                                    in received_message_dict.items()})
 
-            self.insert_data(df_output, table_name=self.db_table_name_battery)
+            self.store(settings_rows, table_name=self.db_table_name_battery)
 
 
 
 
-        elif msg.topic == self.topics.forecast_stop_simulation:
-            print("---" * 200)
-            print("SIMULATION STOPPED")
-            print("---" * 200)
-            self.continue_simulation = False
+        elif topic.startswith(Topics.latency_trace):  # Collector mode
+            # The stages of the controller are already stored with the trace of the results
+            self.finish_trace(json.loads(payload), stages=[Stages.BATTERY_APPLY])
+
+    def read_time_series(self, topic, payload):
+        """Forecast/sensor message (full window or stream) as a TimeSeriesView. None if the stream is out of sync."""
+        if is_stream(payload):
+            received_message_frame = self.streams[topic].decode(payload)
+            if received_message_frame is None:
+                log.warning('stream_out_of_sync', topic=topic, rate_limit=10.0, key=topic)
+            return received_message_frame
+
+        return TimeSeriesView.from_payload(payload, date_column=ControlParameters.DATE_STAMP_OPTIMAL)
+
+    def store(self, rows, table_name):
+        """Buffer the rows of a melted message (LongFrame), written to the table by the next flush of the writer"""
+        self.db_writer.add(table_name, rows)
+
+    def writer_worker(self):
+        while True:
+            batch = self.db_inbox.take_all(timeout=self.db_writer.max_delay / 4)
+            if batch is None:
+                break
+
+            for (topic, payload) in batch:
+                try:
+                    self.process_message(topic, payload)
+                except Exception as error:
+                    log.error('message_failed', topic=topic, error=f"{type(error).__name__}: {error}")
+            self.db_writer.flush_due()
+            self.db_inbox.task_done(batch)
+            log.info('db_inbox_stats', rate_limit=60.0, **self.db_inbox.stats())
+
+    def stop_writer(self):
+        """Store the queued messages and flush the writer (stop callback, before the connections are closed)"""
+        self.db_inbox.close()
+        self.db_worker.join()
+        self.db_inbox.release()
+        log.info('db_inbox_closed', **self.db_inbox.stats())
+        self.db_writer.close()
 
     def process_mqtt_messages(self):
         self.loop()
 
+    def finish_trace(self, trace, stages=None):
+        """Record the latency of a finished trace (and store it in collector mode)"""
+        self.latency.record(trace, stages=stages)
+        if self.collect_latency:
+            time_trace = datetime.datetime.fromtimestamp(min(trace['stages'].values()), tz=datetime.timezone.utc)
+            rows = [(time_trace.isoformat(), trace['id'], stage, latency)
+                    for (stage, latency) in stage_latencies(trace, stages=stages).items()]
+            self.db_writer.add(LATENCY_TABLE, rows, columns=LATENCY_COLUMNS)
+
+    def print_latency_summary(self):
+        if self.latency.traces:
+            self.latency.print_summary("Latency per stage, DB manager")
+
     def check_stop_simulation(self):
         return self.continue_simulation
 
@@ -182,8 +297,35 @@ if __name__ == '__main__':
                         help="Password for PostrgreSQL database")
     parser.add_argument('--cleardbtable', required=False, default=False, action='store_true',
                         help="Delete the databases")
+    parser.add_argument('--collector', required=False, default=False, action='store_true',
+                        help="Store the latency traces of the control loop (see latency_report.py)")
+    parser.add_argument('--dbpool', required=False, type=int, default=4,
+                        help="Persistent connections to the database")
+    parser.add_argument('--dbflushrows', required=False, type=int, default=500,
+                        help="Rows of a table written to the database together (COPY)")
+    parser.add_argument('--dbflushinterval', required=False, type=float, default=1.0,
+                        help="Max. time a row waits before it is written to the database [seconds]")
+    parser.add_argument('--dbqueue', required=False, type=int, default=10000,
+                        help="Messages waiting in memory to be stored in the database")
+    parser.add_argument('--dbbackpressure', required=False, type=str, default=BLOCK, choices=POLICIES,
+                        help="What happens when the database does not keep up and the queue is full")
+    parser.add_argument('--dbspilldir', required=False, type=str, default=None,
+                        help="Directory of the spill file of the queue (--dbbackpressure spill)")
+    parser.add_argument('--dbschema', required=False, type=str, default=PLAIN, choices=SCHEMAS,
+                        help="Schema of the tables. 'hypertable': Timescale hypertables with channel ids, an index per "
+                             "channel and compression. Tables that exist with the plain schema stay plain (use "
+                             "--cleardbtable to convert them).")
+    parser.add_argument('--dbchunkinterval', required=False, type=str, default='1 day',
+                        help="Time range of a chunk of the hypertables, e.g., '1 day'")
+    parser.add_argument('--dbcompressafter', required=False, type=str, default='7 days',
+                        help="Age of the chunks of the hypertables that are compressed, e.g., '7 days'")
+    parser.add_argument('--log-level', required=False, type=str, default=None, choices=LEVELS,
+                        help="Level of the log. DEBUG logs every message. Default: the environment variable "
+                             "LOG_LEVEL or INFO.")
     args, unknown = parser.parse_known_args()
 
+    configure(args.log_level)
+
     user_module_mqtt = DBManagerMQTT(control_id=1,
                                      battery_id=1,
                                      controlled_sensor_id=args.sensorid,
@@ -195,13 +337,31 @@ if __name__ == '__main__':
                                      password_db=args.dbpassword,
                                      port_db=args.dbport,
                                      ip_db=args.dbip,
-                                     clear_table_db=args.cleardbtable)
-
-    # while True:
-    continue_simulation = True
-    while continue_simulation:
-        user_module_mqtt.process_mqtt_messages()
-        continue_simulation = user_module_mqtt.check_stop_simulation()
+                                     clear_table_db=args.cleardbtable,
+                                     collect_latency=args.collector,
+                                     pool_size_db=args.dbpool,
+                                     flush_rows_db=args.dbflushrows,
+                                     flush_interval_db=args.dbflushinterval,
+                                     queue_size_db=args.dbqueue,
+                                     backpressure_db=args.dbbackpressure,
+                                     spill_dir_db=args.dbspilldir,
+                                     schema_db=args.dbschema,
+                                     chunk_interval_db=args.dbchunkinterval,
+                                     compress_after_db=args.dbcompressafter)
+
+    runtime = ModuleRuntime()
+    runtime.add_client(user_module_mqtt)
+    runtime.add_stop_callback(user_module_mqtt.print_latency_summary)
+    runtime.add_stop_callback(user_module_mqtt.stop_writer)  # Final flush, before the connections are closed
+    runtime.add_stop_callback(user_module_mqtt.close_db)
+
+    def check_stop_simulation_job():
+        if not user_module_mqtt.check_stop_simulation():
+            runtime.stop()
+            return False
+
+    runtime.every(0.25, check_stop_simulation_job)
+    runtime.run()
 
 
 #%% Plotting the simulations
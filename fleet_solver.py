@@ -0,0 +1,225 @@
+"""
+Fleet solver: spreads the MPC problems of many controllers (buildings/phases) over worker processes.
+
+Building the pyomo models is pure python and holds the GIL, so the solves of the controllers of one node only run in
+parallel in different processes. Every worker is a single-process executor (a shard) that owns a fixed set of
+control_ids and keeps their ControlModule (model and solver session) alive between solves. Only compact arrays are sent
+to the workers: the forecast values, the first time stamp and the time step.
+"""
+
+from concurrent import futures
+from control_mqtt import ControlModule
+from commons.parameters import BatteryParameters, ControlParameters
+import pandas as pd
+import numpy as np
+import threading
+import argparse
+import time
+import sys
+import os
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+# State of the worker process: control_id -> ControlModule
+_controllers = dict()
+
+
+def _init_worker(quiet):
+    if quiet:  # The control module prints every update
+        sys.stdout = open(os.devnull, 'w')
+
+
+def _register(control_id, control_settings):
+    _controllers[control_id] = ControlModule(**control_settings)
+
+    return os.getpid()
+
+
+def _solve(control_id, forecast_values, start, step, battery_params, controller_params):
+    tic = time.perf_counter()
+    controller = _controllers[control_id]
+
+    if battery_params:
+        controller.update_battery_parameters(**battery_params)
+    if controller_params:
+        controller.update_controller_parameters(**controller_params)
+
+    time_stamps = pd.date_range(start=start, periods=len(forecast_values), freq=step)
+    controller.update_forecast_values(forecast_values, time_stamps)
+    results_optimizer = controller.solve_model()
+
+    return results_optimizer, time.perf_counter() - tic
+
+
+def _close():
+    for controller in _controllers.values():
+        controller.close()
+    _controllers.clear()
+
+
+class WorkerStats:
+    def __init__(self):
+        self.controllers = 0
+        self.queue_depth = 0  # Solves submitted and not finished yet
+        self.solved = 0
+        self.failed = 0
+        self.total_latency = 0.0  # From submit() until the result is back [seconds]
+        self.max_latency = 0.0
+        self.total_solve_time = 0.0  # Time in the worker process [seconds]
+
+    def as_dict(self):
+        finished = self.solved + self.failed
+        return {'controllers': self.controllers,
+                'queue_depth': self.queue_depth,
+                'solved': self.solved,
+                'failed': self.failed,
+                'mean_latency': self.total_latency / finished if finished else None,
+                'max_latency': self.max_latency,
+                'mean_solve_time': self.total_solve_time / self.solved if self.solved else None}
+
+
+class FleetSolver:
+    DEFAULT_STEP = pd.Timedelta(minutes=15)
+
+    def __init__(self, workers=None, quiet=True):
+        """
+        Parameters:
+        -----------
+            workers: int: Number of worker processes. None uses the number of cores.
+            quiet: bool: Silence the prints of the control modules in the workers.
+        """
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.shards = [futures.ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(quiet,))
+                       for _ in range(self.workers)]
+        self.owner = dict()  # control_id -> index of the shard
+        self.stats = [WorkerStats() for _ in range(self.workers)]
+        self.lock = threading.Lock()
+
+    def register(self, control_id, **control_settings):
+        """
+        Create the control module of control_id in its worker (round robin).
+
+        Parameters:
+        -----------
+            control_settings: Keyword arguments of ControlModule e.g., solver='ipopt', formulation='condensed'
+        """
+        assert control_id not in self.owner, f"Controller {control_id} already registered"
+        shard = len(self.owner) % self.workers
+        self.owner[control_id] = shard
+        self.stats[shard].controllers += 1
+
+        return self.shards[shard].submit(_register, control_id, control_settings)
+
+    def submit(self, control_id, forecast_values, time_stamps, battery_params=None, controller_params=None):
+        """
+        Solve the MPC of control_id in its worker.
+
+        Parameters:
+        -----------
+            forecast_values: array-like: Forecast of the horizon [kW].
+            time_stamps: pd.DatetimeIndex: Regular time stamps of the forecast. Only the first one and the step are
+                                           sent to the worker.
+            battery_params: dict: Battery parameters to update before the solve. None keeps the last ones.
+            controller_params: dict: Controller parameters to update before the solve. None keeps the last ones.
+
+        Returns:
+        --------
+            concurrent.futures.Future: Results data frame of the controller (see ControlModule.solve_model()).
+        """
+        shard = self.owner[control_id]
+        forecast_values = np.ascontiguousarray(forecast_values, dtype=np.float64)
+        step = time_stamps[1] - time_stamps[0] if len(time_stamps) > 1 else self.DEFAULT_STEP
+
+        with self.lock:
+            self.stats[shard].queue_depth += 1
+        tic = time.perf_counter()
+        job = self.shards[shard].submit(_solve, control_id, forecast_values, time_stamps[0], step,
+                                        battery_params, controller_params)
+
+        solution = futures.Future()
+        solution.set_running_or_notify_cancel()
+
+        def job_done(job_):
+            stats = self.stats[shard]
+            latency = time.perf_counter() - tic
+            error = job_.exception()
+            with self.lock:
+                stats.queue_depth -= 1
+                stats.total_latency += latency
+                stats.max_latency = max(stats.max_latency, latency)
+                if error is None:
+                    (results_optimizer, solve_time) = job_.result()
+                    stats.solved += 1
+                    stats.total_solve_time += solve_time
+                else:
+                    stats.failed += 1
+
+            if error is None:
+                solution.set_result(results_optimizer)
+            else:
+                solution.set_exception(error)
+
+        job.add_done_callback(job_done)
+
+        return solution
+
+    def worker_stats(self):
+        with self.lock:
+            return {f"worker_{shard}": stats.as_dict() for (shard, stats) in enumerate(self.stats)}
+
+    def shutdown(self, wait=True):
+        for shard in self.shards:  # Runs after the pending solves of the worker
+            shard.submit(_close)
+        for shard in self.shards:
+            shard.shutdown(wait=wait)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-W', '--workers', required=False, type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument('-N', '--controllers', required=False, type=int, default=16,
+                        help="Number of (simulated) controllers in the fleet")
+    parser.add_argument('-R', '--rounds', required=False, type=int, default=4,
+                        help="Number of forecast updates per controller")
+    parser.add_argument('--solver', required=False, type=str, default='ipopt', choices=ControlModule.SOLVERS)
+    parser.add_argument('--formulation', required=False, type=str, default='full',
+                        choices=ControlModule.FORMULATIONS)
+
+    args, unknown = parser.parse_known_args()
+
+    print(f"Workers: {args.workers}")
+    print(f"Controllers: {args.controllers}")
+    print(f"Rounds: {args.rounds}")
+    print(f"Solver: {args.solver}")
+    print(f"Formulation: {args.formulation}")
+
+    fleet = FleetSolver(workers=args.workers)
+    futures.wait([fleet.register(control_id, solver=args.solver, formulation=args.formulation)
+                  for control_id in range(args.controllers)])
+
+    window = 96
+    time_stamps = pd.date_range(start='2021-01-01', periods=window + args.rounds, freq='15min', tz='UTC')
+    random_generator = np.random.default_rng(1)
+    profiles = 5.0 + 3.0 * np.sin(np.arange(window + args.rounds) / 10.0 + random_generator.uniform(
+        0, 2 * np.pi, size=(args.controllers, 1)))
+
+    tic = time.perf_counter()
+    for round_ in range(args.rounds):
+        solutions = [fleet.submit(control_id,
+                                  profiles[control_id, round_:round_ + window],
+                                  time_stamps[round_:round_ + window],
+                                  battery_params={BatteryParameters.SOC_INI_ACTUAL: 0.5},
+                                  controller_params={ControlParameters.POWER_THRESHOLD: 5.0})
+                     for control_id in range(args.controllers)]
+        futures.wait(solutions)
+    elapsed = time.perf_counter() - tic
+
+    print(f"Solves: {args.controllers * args.rounds} in {elapsed:.2f} s "
+          f"({args.controllers * args.rounds / elapsed:.1f} solves/s)")
+    for (worker, stats) in fleet.worker_stats().items():
+        print(f"{worker}: {stats}")
+
+    fleet.shutdown()
@@ -3,9 +3,18 @@ from commons.influxDB_to_icarus import influxToIcarus
 import datetime
 import json
 import paho.mqtt.client as mqtt
-import time
 from commons.parameters import Topics
+from commons.wire_format import WIRE_FORMATS, write_frame, payload_summary
+from commons.forecast_stream import StreamEncoder
+from commons.module_runtime import ModuleRuntime
+from commons.tracing import Stages, new_trace
+from commons.publisher import Publisher, SUPERSEDED, GUARANTEED
+from commons.log import get_logger, configure, lazy, LEVELS
+import numpy as np
 import argparse
+import os
+
+log = get_logger('forecast')
 
 
 class ForecastIcarus:
@@ -119,19 +128,37 @@ class ForecastMQTT(ForecastIcarus, mqtt.Client):
                  mqtt_server_ip,
                  mqtt_server_port,
                  enable_inverter,
-                 use_forecast=True):
+                 use_forecast=True,
+                 forecast_window=100,
+                 wire_format='json',
+                 stream_keyframe=0,
+                 trace_messages=False):
         ForecastIcarus.__init__(self, id_sensor=id_sensor, phase=phase, use_forecast=use_forecast,
                                 enable_inverter=enable_inverter)
         mqtt.Client.__init__(self, client_id=client_id_mqtt)
 
         self.enable_inverter = enable_inverter
         self.time_counter = 0
-        self.temporary_window = 100
-        self.topics = Topics
-
-        # Publish
-        self.topics.forecast_topic += f"{id_sensor}_{phase}"
-        self.topics.sensor_topic += f"{id_sensor}_{phase}"
+        self.temporary_window = forecast_window  # Time steps sent to the controller in simulation mode
+        self.wire_format = wire_format  # Format of the published time series (see commons.wire_format)
+        self.trace_messages = trace_messages  # Start a latency trace with every forecast (see commons.tracing)
+
+        # Streaming mode (simulation): a keyframe every 'stream_keyframe' messages and only the new samples in between.
+        self.stream_encoders = None
+        if stream_keyframe > 0 and not enable_inverter:
+            float_dtype = np.float32 if wire_format == 'binary32' else np.float64
+            self.stream_encoders = {'forecast': StreamEncoder(stream_keyframe, float_dtype=float_dtype),
+                                    'real': StreamEncoder(stream_keyframe, float_dtype=float_dtype)}
+
+        self.topics = Topics.table(# Publish
+                                   forecast_topic=f"{id_sensor}_{phase}",
+                                   sensor_topic=f"{id_sensor}_{phase}")
+
+        # A new window supersedes the queued one. The deltas of a stream can not be dropped (the window is rebuilt).
+        window_policy = GUARANTEED if self.stream_encoders is not None else SUPERSEDED
+        self.publisher = Publisher(self, policies={self.topics.forecast_topic: window_policy,
+                                                   self.topics.sensor_topic: window_policy,
+                                                   self.topics.forecast_stop_simulation: GUARANTEED})
 
         self.qos = 1
         self.connect(host=mqtt_server_ip,
@@ -141,10 +168,10 @@ class ForecastMQTT(ForecastIcarus, mqtt.Client):
         self.time_counter = 0
 
     def on_connect(self, mqtt, obj, flags, rc):
-        print("Connected with result code " + str(rc))
+        log.info('connected', client_id=self._client_id.decode('utf-8'), rc=rc)
 
     def on_message(self, client, userdata, msg):
-        print(f"Message received on topic: {msg.topic}")
+        log.debug('message_received', topic=msg.topic)
 
     def publish_response(self):
         """Every time it is called, the prediction is rolled one time step"""
@@ -157,29 +184,36 @@ class ForecastMQTT(ForecastIcarus, mqtt.Client):
             power_real = self.get_prediction()
             power_prediction = power_real
 
-        message_predicted_power = power_prediction.reset_index().to_json(date_format='iso')
-        message_real_power = power_real.reset_index().to_json(date_format='iso')
+        # Only the message of the controller is traced, the real power is stored by the DB manager
+        trace = new_trace(Stages.FORECAST_PUBLISH) if self.trace_messages else None
+        use_prediction = self.use_forecast or self.enable_inverter
+        if self.stream_encoders is not None:
+            message_predicted_power = self.stream_encoders['forecast'].encode(power_prediction,
+                                                                              trace=trace if use_prediction else None)
+            message_real_power = self.stream_encoders['real'].encode(power_real,
+                                                                     trace=None if use_prediction else trace)
+        else:
+            message_predicted_power = write_frame(power_prediction, self.wire_format,
+                                                  trace=trace if use_prediction else None)
+            message_real_power = write_frame(power_real, self.wire_format, trace=None if use_prediction else trace)
 
-        if self.use_forecast or self.enable_inverter:
+        if use_prediction:
             message_to_controller = message_predicted_power
         else:
             message_to_controller = message_real_power
 
         # The controller could have or forecasted values or real values
-        print(f"Publishing topic: {self.topics.forecast_topic}")
-        print(f"Publishing payload: {message_to_controller}")
-        self.publish(topic=self.topics.forecast_topic, payload=message_to_controller)
+        log.debug('publish', topic=self.topics.forecast_topic, payload=lazy(payload_summary, message_to_controller))
+        self.publisher.publish(self.topics.forecast_topic, message_to_controller)
 
         # Either way the "real value" is being published ("real" beacuse if the inverter is enabled, the "real" is a copy of the forecast)
-        print(f"Publishing topic: {self.topics.sensor_topic}")
-        print(f"Publishing payload: {message_real_power}")
-        self.publish(topic=self.topics.sensor_topic, payload=message_real_power)
+        log.debug('publish', topic=self.topics.sensor_topic, payload=lazy(payload_summary, message_real_power))
+        self.publisher.publish(self.topics.sensor_topic, message_real_power)
 
 
     def stop_simulation(self):
         # This is only for the user module, to know when the simulation ended.
-        self.publish(topic=self.topics.forecast_stop_simulation,
-                     payload=json.dumps({'stop': True}))
+        self.publisher.publish(self.topics.forecast_stop_simulation, json.dumps({'stop': True}))
 
     def process_mqtt_messages(self):
         self.loop()
@@ -205,6 +239,18 @@ if __name__ == '__main__':
     #                     help="False: Enables simulation mode (data from past), True: Uses only forecast (real operation).")
     parser.add_argument('--delay', required=False, type=float, default=0.25,
                         help="Delay time between simulation/forecast update.")
+    parser.add_argument('--window', required=False, type=int, default=100,
+                        help="Time steps of the forecast sent in simulation mode, e.g., 300 for a 3 day horizon.")
+    parser.add_argument('--wire-format', required=False, type=str, default='json', choices=WIRE_FORMATS,
+                        help="Format of the published time series. 'binary'/'binary32' are packed float64/float32.")
+    parser.add_argument('--stream-keyframe', required=False, type=int, default=0,
+                        help="Simulation mode: send the full window every N messages and only the new samples in "
+                             "between (binary frames). 0 sends the full window every time.")
+    parser.add_argument('--trace', required=False, default=False, action='store_true',
+                        help="Send a latency trace with every forecast (see latency_report.py)")
+    parser.add_argument('--log-level', required=False, type=str, default=None, choices=LEVELS,
+                        help="Level of the log. DEBUG logs every message and its payload. Default: the environment "
+                             "variable LOG_LEVEL or INFO.")
 
     args, unknown = parser.parse_known_args()
 
@@ -217,8 +263,14 @@ if __name__ == '__main__':
     print(f"Use forecast: {args.forecast}")
     print(f"Mode of operation: {args.mode}")
     print(f"Simulation every: {args.delay} seconds")
+    print(f"Forecast window (simulation): {args.window} steps")
+    print(f"Wire format: {args.wire_format}")
+    print(f"Stream keyframe every: {args.stream_keyframe} messages")
+    print(f"Latency tracing: {args.trace}")
     print(f"Updating forecast every: {60} seconds")
+    print(f"Log level: {args.log_level or os.environ.get('LOG_LEVEL', 'INFO')}")
     print("*" * 70)
+    configure(args.log_level)
 
     forecast_module_mqtt = ForecastMQTT(id_sensor=args.sensorid,
                                         phase=args.phaseid,
@@ -226,33 +278,41 @@ if __name__ == '__main__':
                                         mqtt_server_ip=args.host,
                                         mqtt_server_port=args.port,
                                         use_forecast=args.forecast,
-                                        enable_inverter=args.mode)
+                                        enable_inverter=args.mode,
+                                        forecast_window=args.window,
+                                        wire_format=args.wire_format,
+                                        stream_keyframe=args.stream_keyframe,
+                                        trace_messages=args.trace)
+
+    runtime = ModuleRuntime()
+    runtime.add_client(forecast_module_mqtt)
+    runtime.add_stop_callback(forecast_module_mqtt.publisher.close)
 
     if args.mode == 0:  # Simulation mode using past data
         print(f"Simulation mode!! -- Sim delay: {args.delay} seconds")
-        delay = args.delay
-        ii = 0
-        total_iterations = len(forecast_module_mqtt.join_time_series.index) - 100
-        while ii < total_iterations:
-            print(f"Iteration: {ii} of {total_iterations - 1}")
-            forecast_module_mqtt.process_mqtt_messages()
+        total_iterations = len(forecast_module_mqtt.join_time_series.index) - args.window
+
+        def simulation_step():
+            if forecast_module_mqtt.time_counter >= total_iterations:
+                forecast_module_mqtt.stop_simulation()
+                forecast_module_mqtt.reset_time_counter()
+                runtime.stop()
+                return False
+
+            log.info('simulation_step', iteration=forecast_module_mqtt.time_counter, total=total_iterations,
+                     rate_limit=10.0)
             forecast_module_mqtt.publish_response()
-            time.sleep(delay)
-            ii = ii + 1
 
-        forecast_module_mqtt.stop_simulation()
-        forecast_module_mqtt.reset_time_counter()
+        runtime.every(args.delay, simulation_step)
 
-    else:  # Real operation: This should be an infinite loop. Now truncated to test. Uses icarus Forecast.
+    else:  # Real operation: This should be an infinite loop. Uses icarus Forecast.
         delay = 60  # Every 1 min
         print(f"SMA enabled. Real deal control!!! -- Sending forecast every: {delay} seconds.")
-        while True:
-            # while True:
-            print(f"Seding update: {datetime.datetime.now()}")
-            forecast_module_mqtt.process_mqtt_messages()
-            forecast_module_mqtt.publish_response()
-            time.sleep(delay)
-
 
+        def forecast_step():
+            log.info('forecast_update', time=lazy(datetime.datetime.now))
+            forecast_module_mqtt.publish_response()
 
+        runtime.every(delay, forecast_step, in_executor=True)  # The requests to influxDB/icarus are blocking
 
+    runtime.run()
@@ -0,0 +1,66 @@
+"""
+Percentiles of the latency of the control loop per stage, from the traces stored by the DB manager in collector mode:
+
+    python forecast_mqtt.py --trace ...
+    python dbmanager_mqtt.py --collector ...
+    python latency_report.py --minutes 60
+"""
+
+from commons.timescaledb_connection import TimescaledbConnection
+from commons.tracing import StageHistograms, stage_order, LATENCY_TABLE
+import argparse
+
+__version__ = "1.0.0"
+__author__ = "Mauricio Salazar"
+
+QUANTILES = [q / 100 for q in StageHistograms.PERCENTILES]
+
+
+def latency_percentiles(connection, table_name, minutes=None):
+    """
+    Returns:
+    --------
+        list: Tuples (stage, count, [p50, p95, p99] [seconds]) sorted in the order of the control loop.
+    """
+    query = f"""SELECT stage, count(*), percentile_cont(%s) WITHIN GROUP (ORDER BY latency)
+                FROM {table_name}"""
+    parameters = [QUANTILES]
+    if minutes:
+        query += " WHERE time_trace >= now() - %s * interval '1 minute'"
+        parameters.append(minutes)
+    query += " GROUP BY stage"
+
+    rows = connection.fetch_all(query, parameters)
+
+    return sorted(rows, key=lambda row: stage_order(row[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dbip', required=False, type=str, default='localhost',
+                        help="IP address of the PostrgreSQL database")
+    parser.add_argument('--dbport', required=False, type=int, default=5432,
+                        help="Port of the PostrgreSQL database")
+    parser.add_argument('--dbusername', required=False, type=str, default='postgres',
+                        help="Username for PostrgreSQL database")
+    parser.add_argument('--dbpassword', required=False, type=str, default='postgres',
+                        help="Password for PostrgreSQL database")
+    parser.add_argument('--table', required=False, type=str, default=LATENCY_TABLE,
+                        help="Table of the latency traces")
+    parser.add_argument('--minutes', required=False, type=float, default=0,
+                        help="Only the traces of the last N minutes. 0 uses all the traces.")
+    args, unknown = parser.parse_known_args()
+
+    print(f"Database: {args.dbip}:{args.dbport}")
+    print(f"Table: {args.table}")
+    print(f"Last minutes: {args.minutes if args.minutes else 'all'}")
+
+    connection = TimescaledbConnection(username=args.dbusername, password=args.dbpassword, host=args.dbip,
+                                       port=args.dbport, pool_size=1)
+
+    print(f"{'stage':<28} {'count':>8} " + " ".join(f"{f'p{q} [ms]':>12}" for q in StageHistograms.PERCENTILES))
+    for (stage, count, values) in latency_percentiles(connection, args.table, minutes=args.minutes):
+        print(f"{stage:<28} {count:>8} " + " ".join(f"{value * 1e3:>12.2f}" for value in values))
+
+    connection.close_db()
@@ -1,93 +1,98 @@
-from forecast_mqtt import ForecastIcarus
-from control_mqtt import ControlModule
-from battery_mqtt import BatteryModule
+"""
+Closed-loop simulation of the forecast, control and battery modules in one process.
+
+The production MQTT classes (ForecastMQTT, ControlMQTT, BatteryMQTT) run unchanged on an in-process message bus (see
+commons.message_bus), with the same topics and payloads as with a broker, but without mosquitto and without a network.
+"""
+
+from forecast_mqtt import ForecastMQTT
+from control_mqtt import ControlMQTT
+from battery_mqtt import BatteryMQTT
+from commons.message_bus import MessageBus, on_bus
 import pandas as pd
 import numpy as np
+import time
 from commons.parameters import BatteryParameters, ControlParameters
 import matplotlib.pyplot as plt
 
-# Create forecast
-icarus = ForecastIcarus(id_sensor='gebouw')
-controller = ControlModule()
+SENSOR_ID = 'gebouw'
+PHASE_ID = 'l1'
+BATTERY_ID = 1
+CONTROL_ID = 1
+WINDOW = 100
+SIMULATION_STEPS = 2
 
-#%%
+bus = MessageBus()
+
+# Create forecast, controller and battery (the host/port of the broker are not used on the bus)
 PERFECT_PREDICTION = True
+icarus = on_bus(ForecastMQTT, bus)(id_sensor=SENSOR_ID,
+                                   phase=PHASE_ID,
+                                   client_id_mqtt="FORECAST",
+                                   mqtt_server_ip=None,
+                                   mqtt_server_port=None,
+                                   enable_inverter=0,
+                                   use_forecast=not PERFECT_PREDICTION,
+                                   forecast_window=WINDOW)
+controller = on_bus(ControlMQTT, bus)(control_id=CONTROL_ID,
+                                      controlled_sensor_id=SENSOR_ID,
+                                      controlled_phase_id=PHASE_ID,
+                                      battery_id=BATTERY_ID,
+                                      client_id_mqtt="CONTROL",
+                                      mqtt_server_ip=None,
+                                      mqtt_server_port=None)
+battery = on_bus(BatteryMQTT, bus)(battery_id=BATTERY_ID,
+                                   client_id_mqtt="BATTERY",
+                                   mqtt_server_ip=None,
+                                   mqtt_server_port=None,
+                                   enable_sma=False,
+                                   modbus_ip=None,
+                                   modbus_port=None)
+bus.run_until_idle(workers=[controller])  # Subscriptions and first report of the battery parameters
+
+#%%
 solutions_frame = list()
 real_consumption = list()
 forecast_consumption = list()
 
-
-for simulation_time_step in range(len(icarus.join_time_series.index)-100):
-    if simulation_time_step == 2:
+time_start = time.perf_counter()
+for simulation_time_step in range(len(icarus.join_time_series.index) - WINDOW):
+    if simulation_time_step == SIMULATION_STEPS:
         break
 
     print("-" * 80)
     print(f"Simulation step: {simulation_time_step}" )
     print("-" * 80)
-    print('*' * 200)
-
-    if PERFECT_PREDICTION:
-        (real_, prediction_) = icarus.get_prediction_for_simulation(simulation_time_step, 100)
-        forecast_ = real_
-    else:
-        (real_, prediction_) = icarus.get_prediction_for_simulation(simulation_time_step, 100)
-        forecast_ = prediction_
-
 
-    # Simulate the send and receive of the forecast and controller via the MQTT class
-    sent_message = forecast_.reset_index().to_json(date_format='iso')  # Sent by forecast
-    received_message = pd.read_json(sent_message, convert_dates=['datetimeFC'])  # Received by Controller
-    received_message = received_message.set_index('datetimeFC', drop=True)
+    (real_, prediction_) = icarus.get_prediction_for_simulation(simulation_time_step, WINDOW)
+    forecast_ = real_ if PERFECT_PREDICTION else prediction_
 
-    # Controller process the data
-    controller.update_forecast(received_message)
-    results_optimizer = controller.solve_model()
+    # Forecast -> controller -> battery (set point)
+    icarus.publish_response()
+    bus.run_until_idle(workers=[controller])
+    results_optimizer = controller.last_results
     print(f"Results optimizer: \n"
           f"{results_optimizer[[ControlParameters.DATE_STAMP_OPTIMAL, ControlParameters.BATTERY_POWER_OPTIMAL, ControlParameters.SOC_BATTERY_OPTIMAL]].head()}")
 
-    if simulation_time_step == 0:
-        print('X' * 200)
-        print('Battery connected')
-        print('X' * 200)
-        # Battery connected
-        battery = BatteryModule(id=1)
-        controller.update_battery_parameters(**battery.get_battery_parameters())
-
-    # if simulation_time_step == 50:
-    #     print("Use changed the Power set point")
-    #     change_max_power={ControlParameters.POWER_THRESHOLD: 7.5}
-    #     controller.update_controller_parameters(**change_max_power)
-
-    # if simulation_time_step == 100:
-    #     print("Use changed the Power set point")
-    #     change_max_power={ControlParameters.POWER_THRESHOLD: 7.5}
-    #     controller.update_controller_parameters(**change_max_power)
-
-    # if simulation_time_step == 200:
-    #     print("Use changed the Power set point")
-    #     change_max_power={ControlParameters.POWER_THRESHOLD: 5.0}
-    #     controller.update_controller_parameters(**change_max_power)
-
-    # Simulate send and receive of the controller to te battery via the MQTT class
-    sent_message_to_battery = results_optimizer[['datetimeFC', 'p_battery']].to_json(date_format='iso', orient='records')
-    received_message_from_controller = pd.read_json(sent_message_to_battery, convert_dates=['datetimeFC'])
-    received_message_from_controller = received_message_from_controller.set_index('datetimeFC', drop=True)
-
-    # Set new power output on the battery
-    if simulation_time_step != 0:
-        battery.set_power_output(received_message_from_controller['p_battery'].iloc[0])
-
-        # Simulate battery charge/discharge
-        for ii in range(4):
-            battery.simulate_battery_operation(delta_t_sim=4)
-
-    # Send the new status of the SoC
-    controller.update_battery_parameters(**{'soc_ini': battery.battery_params['soc_ini']})
+    # Simulate battery charge/discharge, then send the new status of the SoC to the controller
+    for ii in range(4):
+        battery.simulate_battery_operation(delta_t_sim=4)
+    battery.send_battery_parameters()
+    bus.run_until_idle(workers=[controller])
 
     solutions_frame.append(results_optimizer.iloc[0,:])
     real_consumption.append(real_[0])
     forecast_consumption.append(forecast_[0])
 
+time_simulation = time.perf_counter() - time_start
+print(f"Simulated {len(solutions_frame)} steps in {time_simulation:.2f} seconds "
+      f"({len(solutions_frame) / time_simulation:.2f} steps/s). Messages on the bus: {bus.messages}, "
+      f"deliveries: {bus.deliveries}")
+
+icarus.stop_simulation()
+bus.run_until_idle(workers=[controller])
+controller.stop_worker()
+
 solutions_frame = pd.concat(solutions_frame, axis=1).transpose().set_index('datetimeFC', drop=True)
 real_consumption = np.array(real_consumption)
 forecast_consumption = np.array(forecast_consumption)
@@ -0,0 +1,150 @@
+import threading
+import time
+import pytest
+from commons.inbox import BoundedInbox, BLOCK, DROP_OLDEST, SPILL
+
+
+def take_everything(inbox):
+    """Items taken by the worker until the inbox is closed and empty"""
+    items = []
+    while True:
+        batch = inbox.take_all(timeout=5.0)
+        if batch is None:
+            return items
+        items.extend(batch)
+        inbox.task_done(batch)
+
+
+def start_put(inbox, item):
+    """put() in a producer thread. Returns the thread and the list that receives the result of put()."""
+    result = []
+    producer = threading.Thread(target=lambda: result.append(inbox.put(item)), daemon=True)
+    producer.start()
+
+    return producer, result
+
+
+def test_block_waits_for_room():
+    inbox = BoundedInbox(max_items=2, policy=BLOCK)
+    assert inbox.put(1) and inbox.put(2)
+
+    (producer, result) = start_put(inbox, 3)
+    time.sleep(0.1)
+    assert producer.is_alive() and not result  # No room: the producer waits
+
+    batch = inbox.take_all()
+    producer.join(5.0)
+
+    assert batch == [1, 2]
+    assert result == [True]
+    assert inbox.take_all() == [3]
+    assert inbox.stats()['blocked_time'] > 0
+
+
+def test_block_close_during_put():
+    inbox = BoundedInbox(max_items=1, policy=BLOCK)
+    inbox.put('a')
+
+    (producer, result) = start_put(inbox, 'b')
+    time.sleep(0.1)
+    inbox.close()
+    producer.join(5.0)
+
+    assert result == [False]  # Not queued: the worker is stopping
+    assert inbox.stats()['dropped'] == 1
+    assert take_everything(inbox) == ['a']
+    assert inbox.join(timeout=1.0)
+
+
+def test_drop_oldest():
+    inbox = BoundedInbox(max_items=3, policy=DROP_OLDEST)
+    for item in range(5):
+        assert inbox.put(item)
+
+    assert inbox.take_all() == [2, 3, 4]
+    stats = inbox.stats()
+    assert (stats['received'], stats['dropped'], stats['max_depth']) == (5, 2, 3)
+
+
+def test_drop_oldest_join_does_not_wait_for_dropped_items():
+    inbox = BoundedInbox(max_items=1, policy=DROP_OLDEST)
+    inbox.put(1)
+    inbox.put(2)
+
+    inbox.task_done(inbox.take_all())
+
+    assert inbox.join(timeout=1.0)
+
+
+def test_spill_keeps_the_order(tmp_path):
+    inbox = BoundedInbox(max_items=3, policy=SPILL, spill_dir=str(tmp_path))
+    items = [{'topic': f"sensor_{i}", 'payload': bytes([i])} for i in range(10)]
+    for item in items:
+        assert inbox.put(item)
+
+    assert inbox.depth() == 10
+    assert inbox.stats()['spilled'] == 7
+
+    batches = []
+    inbox.close()
+    while True:
+        batch = inbox.take_all(timeout=1.0)
+        if batch is None:
+            break
+        assert len(batch) <= 3  # Read back up to max_items at a time
+        batches.append(batch)
+        inbox.task_done(batch)
+
+    assert [item for batch in batches for item in batch] == items
+    assert inbox.join(timeout=1.0)
+    inbox.release()
+
+
+def test_spill_new_items_after_the_spilled_ones(tmp_path):
+    inbox = BoundedInbox(max_items=2, policy=SPILL, spill_dir=str(tmp_path))
+    for item in range(4):
+        inbox.put(item)
+
+    assert inbox.take_all() == [0, 1]
+    inbox.put(4)  # Spilled too: items 2 and 3 are still on disk
+
+    inbox.close()
+    assert take_everything(inbox) == [2, 3, 4]
+    assert inbox.stats()['spilled'] == 3
+    inbox.release()
+
+
+def test_closed_inbox_rejects_items():
+    inbox = BoundedInbox(max_items=2)
+    inbox.put(1)
+    inbox.close()
+
+    assert not inbox.put(2)
+    assert take_everything(inbox) == [1]
+
+
+def test_take_all_timeout():
+    inbox = BoundedInbox(max_items=2)
+
+    assert inbox.take_all(timeout=0.01) == []
+
+
+@pytest.mark.parametrize('policy', [BLOCK, DROP_OLDEST, SPILL])
+def test_producer_and_worker_threads(policy, tmp_path):
+    inbox = BoundedInbox(max_items=4, policy=policy, spill_dir=str(tmp_path))
+    taken = []
+    worker = threading.Thread(target=lambda: taken.extend(take_everything(inbox)), daemon=True)
+    worker.start()
+
+    for item in range(200):
+        inbox.put(item)
+    assert inbox.join(timeout=10.0)
+    inbox.close()
+    worker.join(5.0)
+
+    stats = inbox.stats()
+    assert taken == sorted(taken)  # In order with every policy
+    assert len(taken) + stats['dropped'] == 200
+    if policy != DROP_OLDEST:
+        assert taken == list(range(200))
+    inbox.release()
@@ -0,0 +1,172 @@
+import paho.mqtt.client as mqtt
+import pytest
+from commons.publisher import Publisher, PublishPolicy, SUPERSEDED, GUARANTEED, BEST_EFFORT
+
+
+class MessageInfo:
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+
+class RecordingClient:
+    """paho client that records the messages. QoS 0 messages are acknowledged at once, like paho does when it writes
+    them to the socket (before publish() returns); QoS > 0 messages when the test calls ack()."""
+
+    def __init__(self, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.rc = rc
+        self.on_publish = None
+        self.max_inflight = None
+        self.sent = []  # (mid, topic, payload, qos)
+        self.unacknowledged = []
+
+    def max_inflight_messages_set(self, inflight):
+        self.max_inflight = inflight
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if not isinstance(payload, (str, bytes)):
+            raise TypeError("payload must be a string or bytes")
+        mid = len(self.sent) + 1
+        self.sent.append((mid, topic, payload, qos))
+        if self.rc == mqtt.MQTT_ERR_SUCCESS:
+            if qos == 0:
+                self.on_publish(self, None, mid)
+            else:
+                self.unacknowledged.append(mid)
+
+        return MessageInfo(mid, self.rc)
+
+    def ack(self, count=1):
+        for _ in range(count):
+            self.on_publish(self, None, self.unacknowledged.pop(0))
+
+    def payloads(self):
+        return [payload for (_, _, payload, _) in self.sent]
+
+
+def test_inflight_window():
+    client = RecordingClient()
+    publisher = Publisher(client, max_inflight=2)
+
+    for i in range(5):
+        publisher.publish('battery_1', f"set point {i}")
+
+    assert client.payloads() == ['set point 0', 'set point 1']
+    assert publisher.stats()['inflight'] == 2
+    assert publisher.stats()['queued'] == {'battery_1': 3}
+
+    client.ack()
+    assert client.payloads()[-1] == 'set point 2'
+    assert publisher.inflight == 2
+
+    client.ack(4)
+    stats = publisher.stats()
+    assert client.payloads() == [f"set point {i}" for i in range(5)]
+    assert (stats['published'], stats['acknowledged'], stats['inflight'], stats['queued']) == (5, 5, 0, {})
+    assert stats['ack_latency_p50'] is not None
+    assert publisher.drain(timeout=0.1)
+
+
+def test_drain_times_out_without_acks():
+    client = RecordingClient()
+    publisher = Publisher(client, max_inflight=1)
+    publisher.publish('battery_1', 'set point')
+
+    assert not publisher.drain(timeout=0.05)
+    client.ack()
+    assert publisher.drain(timeout=0.05)
+
+
+def test_client_inflight_window_is_not_smaller():
+    client = RecordingClient()
+    Publisher(client, max_inflight=5)
+    assert client.max_inflight == 20
+
+
+def test_qos0_acknowledged_before_publish_returns():
+    client = RecordingClient()
+    publisher = Publisher(client, policies={'trace': BEST_EFFORT}, max_inflight=1)
+
+    for i in range(3):
+        publisher.publish('trace', f"trace {i}")
+
+    stats = publisher.stats()
+    assert [qos for (_, _, _, qos) in client.sent] == [0, 0, 0]
+    assert (stats['published'], stats['acknowledged'], stats['inflight']) == (3, 3, 0)
+    assert not publisher.early_acks and not publisher.pending_acks
+
+
+def test_superseded_keeps_the_newest():
+    client = RecordingClient()
+    publisher = Publisher(client, policies={'results': SUPERSEDED}, max_inflight=1)
+    publisher.publish('results', 'trajectory 0')  # Fills the window
+
+    for i in range(1, 4):
+        publisher.publish('results', f"trajectory {i}")
+    client.ack(2)
+
+    assert client.payloads() == ['trajectory 0', 'trajectory 3']
+    assert publisher.stats()['dropped'] == {'results': 2}
+
+
+def test_guaranteed_sent_first():
+    client = RecordingClient()
+    publisher = Publisher(client, policies={'results': SUPERSEDED, 'battery_1': GUARANTEED}, max_inflight=1)
+    publisher.publish('results', 'trajectory 0')
+
+    publisher.publish('results', 'trajectory 1')
+    publisher.publish('battery_1', 'set point')
+    client.ack(3)
+
+    assert client.payloads() == ['trajectory 0', 'set point', 'trajectory 1']
+
+
+def test_guaranteed_never_dropped():
+    client = RecordingClient()
+    publisher = Publisher(client, max_inflight=1)
+
+    for i in range(50):
+        publisher.publish('battery_1', f"set point {i}")
+    assert publisher.occupancy() == 49
+    client.ack(50)
+
+    assert client.payloads() == [f"set point {i}" for i in range(50)]
+    assert publisher.stats()['dropped'] == {}
+
+
+def test_rejected_payload_frees_the_window():
+    client = RecordingClient()
+    publisher = Publisher(client, max_inflight=1)
+
+    publisher.publish('battery_1', None)
+    publisher.publish('battery_1', 'set point')
+
+    assert client.payloads() == ['set point']
+    assert (publisher.failed, publisher.inflight) == (1, 1)
+
+
+@pytest.mark.parametrize('policy', [BEST_EFFORT, GUARANTEED])
+def test_client_error(policy):
+    client = RecordingClient(rc=mqtt.MQTT_ERR_NO_CONN)
+    publisher = Publisher(client, default_policy=policy, max_inflight=4)
+
+    publisher.publish('topic', 'payload')
+
+    stats = publisher.stats()
+    if policy.qos == 0:  # Lost
+        assert (stats['failed'], stats['inflight']) == (1, 0)
+    else:  # Kept by the client and sent after a reconnection: still in flight
+        assert (stats['failed'], stats['inflight'], stats['published']) == (0, 1, 1)
+
+
+def test_policy_of_the_topic():
+    custom = PublishPolicy(qos=2, max_queued=5, retain=True)
+    client = RecordingClient()
+    publisher = Publisher(client, default_policy=BEST_EFFORT)
+    publisher.set_policy('status', custom)
+
+    publisher.publish('status', 'online')
+
+    assert publisher.policy('status') is custom
+    assert publisher.policy('other') is BEST_EFFORT
+    assert client.sent[0][3] == 2
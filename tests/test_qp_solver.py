@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import minimize
+from commons.qp_solver import PrefixSumQP, QPStatus
+from commons.parameters import BatteryParameters, ControlParameters
+from control_mqtt import ControlModule
+
+
+def reference_solve(p, q, w, x_lower, x_upper, s_lower, s_upper):
+    """Same QP solved by scipy (SLSQP), with the prefix sum bounds as dense linear constraints"""
+    prefix = np.tril(np.ones((len(q), len(q)))) * w
+    constraints = []
+    for (bounds, sign) in [(s_upper, 1.0), (s_lower, -1.0)]:
+        rows = np.isfinite(bounds)
+        if np.any(rows):
+            constraints.append({'type': 'ineq',
+                                'fun': lambda x, rows=rows, bounds=bounds, sign=sign:
+                                sign * (bounds[rows] - prefix[rows] @ x),
+                                'jac': lambda x, rows=rows, sign=sign: -sign * prefix[rows]})
+    result = minimize(lambda x: 0.5 * np.sum(p * x ** 2) + q @ x, np.zeros(len(q)), jac=lambda x: p * x + q,
+                      bounds=list(zip(x_lower, x_upper)), constraints=constraints, method='SLSQP',
+                      options={'ftol': 1e-12, 'maxiter': 1000})
+    assert result.success, result.message
+
+    return result.x
+
+
+def objective(p, q, x):
+    return 0.5 * np.sum(p * x ** 2) + q @ x
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_optimum_matches_reference(seed):
+    random_generator = np.random.default_rng(seed)
+    n = 24
+    p = random_generator.uniform(0.5, 4.0, n)
+    q = random_generator.normal(0.0, 5.0, n)
+    w = random_generator.integers(1, 5, n).astype(float)
+    x_lower, x_upper = np.full(n, -2.0), np.full(n, 3.0)
+    s_lower, s_upper = np.full(n, -4.0), np.full(n, 6.0)
+    s_upper[::5] = np.inf  # Inactive rows
+
+    (x, status) = PrefixSumQP(tolerance=1e-9).solve(p, q, w, x_lower, x_upper, s_lower, s_upper)
+    x_reference = reference_solve(p, q, w, x_lower, x_upper, s_lower, s_upper)
+
+    assert status == QPStatus.OPTIMAL
+    assert objective(p, q, x) == pytest.approx(objective(p, q, x_reference), rel=1e-9)
+    np.testing.assert_allclose(x, x_reference, atol=1e-5)
+    assert np.all(np.cumsum(w * x) <= s_upper + 1e-6) and np.all(np.cumsum(w * x) >= s_lower - 1e-6)
+
+
+def test_unconstrained_optimum():
+    p, q = np.array([2.0, 4.0]), np.array([-2.0, 4.0])
+    infinite = np.full(2, np.inf)
+
+    (x, status) = PrefixSumQP().solve(p, q, np.ones(2), -infinite, infinite, -infinite, infinite)
+
+    assert status == QPStatus.OPTIMAL
+    np.testing.assert_allclose(x, [1.0, -1.0], atol=1e-6)
+
+
+def test_crossed_bounds_are_infeasible():
+    (x, status) = PrefixSumQP().solve(np.ones(3), np.zeros(3), np.ones(3), np.full(3, -1.0), np.full(3, 1.0),
+                                      np.array([0.0, 2.0, 0.0]), np.array([1.0, 1.0, 1.0]))
+
+    assert status == QPStatus.INFEASIBLE
+    np.testing.assert_array_equal(x, np.zeros(3))
+
+
+def mpc_controller(soc_ini, window=48, **control_settings):
+    controller = ControlModule(solver='qp', **control_settings)
+    controller.update_controller_parameters(**{ControlParameters.OPTIMIZER_WINDOW: window})
+    controller.update_battery_parameters(**{BatteryParameters.SOC_INI_ACTUAL: soc_ini})
+    time_stamps = pd.date_range('2021-01-01', periods=window, freq='15min', tz='UTC')
+    forecast = 5.0 + 4.0 * np.sin(np.arange(window) / 6.0)
+    controller.update_forecast(pd.DataFrame({'power': forecast}, index=time_stamps))
+
+    return controller, forecast
+
+
+def mpc_reference(controller, forecast):
+    """Peak shaving MPC of mpc_model() written in the block powers and solved by scipy"""
+    battery = controller.battery_params
+    blocks = controller.horizon_blocks()
+    c = (battery[BatteryParameters.EFFICIENCY] * battery[BatteryParameters.DELTA_T]
+         / battery[BatteryParameters.NOMINAL_ENERGY])
+
+    def soc(x):
+        p_battery = np.repeat(x, blocks)
+        return battery[BatteryParameters.SOC_INI_ACTUAL] + c * np.concatenate([[0.0], np.cumsum(p_battery[:-1])])
+
+    result = minimize(lambda x: np.sum((forecast + np.repeat(x, blocks)
+                                        - controller.controller_params[ControlParameters.POWER_THRESHOLD]) ** 2),
+                      np.zeros(len(blocks)),
+                      bounds=[(-battery[BatteryParameters.MAX_POWER_DISCHARGE],
+                               battery[BatteryParameters.MAX_POWER_CHARGE])] * len(blocks),
+                      constraints=[{'type': 'ineq', 'fun': lambda x: battery[BatteryParameters.SOC_MAX] - soc(x)},
+                                   {'type': 'ineq', 'fun': lambda x: soc(x) - battery[BatteryParameters.SOC_MIN]}],
+                      method='SLSQP', options={'ftol': 1e-12, 'maxiter': 1000})
+    assert result.success, result.message
+
+    return np.repeat(result.x, blocks)
+
+
+@pytest.mark.parametrize('control_settings', [{}, {'fine_steps': 8, 'block_length': 4},
+                                              {'fine_steps': 7, 'block_length': 4}])
+@pytest.mark.parametrize('soc_ini', [0.25, 0.8, 0.99])
+def test_mpc_matches_reference(soc_ini, control_settings):
+    (controller, forecast) = mpc_controller(soc_ini, **control_settings)
+
+    (p_battery, p_net_demand, soc_battery) = controller.solve_qp()
+
+    np.testing.assert_allclose(p_battery, mpc_reference(controller, forecast), atol=1e-3)
+    np.testing.assert_allclose(p_net_demand, forecast + p_battery)
+    assert soc_battery[0] == soc_ini
+    assert soc_battery.min() >= 0.2 - 1e-6 and soc_battery.max() <= 1.0 + 1e-6
+
+
+@pytest.mark.parametrize('soc_ini', [0.1, 1.05])
+def test_mpc_infeasible_soc_ini(soc_ini):
+    (controller, forecast) = mpc_controller(soc_ini)
+
+    (p_battery, p_net_demand, soc_battery) = controller.solve_qp()
+
+    np.testing.assert_array_equal(p_battery, np.zeros(len(forecast)))
+    np.testing.assert_allclose(p_net_demand, forecast)
+    np.testing.assert_allclose(soc_battery, soc_ini)
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import pytest
+from commons.wire_format import WIRE_FORMATS, write_frame, read_frame, encode_frame, decode_frame, is_binary
+from commons.message_view import TimeSeriesView
+from commons.forecast_stream import StreamEncoder, StreamDecoder, is_stream
+
+DATE_COLUMN = 'datetimeFC'
+TOLERANCES = {'json': 1e-9, 'binary': 0.0, 'binary32': 1e-6}  # pandas writes 10 decimals in JSON
+
+
+def time_series(tz='UTC', periods=96, start='2021-01-01'):
+    time_stamps = pd.date_range(start, periods=periods, freq='15min', tz=tz, name=DATE_COLUMN)
+    values = np.linspace(-3.0, 7.0, periods)
+
+    return pd.DataFrame({'forecast': values, 'p_battery': np.sin(values)}, index=time_stamps)
+
+
+def assert_same_series(received, sent, rtol=0.0):
+    assert list(received.columns) == list(sent.columns)
+    assert received.index.tz == sent.index.tz or str(received.index.tz) == str(sent.index.tz)
+    np.testing.assert_array_equal(received.index.asi8, sent.index.asi8)
+    np.testing.assert_allclose(received.values, sent.values, rtol=rtol, atol=rtol)
+
+
+@pytest.mark.parametrize('tz', ['UTC', None])
+@pytest.mark.parametrize('wire_format', WIRE_FORMATS)
+def test_round_trip(wire_format, tz):
+    frame = time_series(tz=tz)
+    rtol = TOLERANCES[wire_format]
+
+    payload = write_frame(frame, wire_format)
+    payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+
+    assert is_binary(payload) == (wire_format != 'json')
+    assert_same_series(read_frame(payload, date_column=DATE_COLUMN), frame, rtol=rtol)
+    assert_same_series(TimeSeriesView.from_payload(payload, date_column=DATE_COLUMN).to_frame(), frame, rtol=rtol)
+
+
+@pytest.mark.parametrize('wire_format', WIRE_FORMATS)
+def test_header_and_trace(wire_format):
+    header = {'soc_ini': 0.5, 'mpc_window': 96}
+    trace = {'id': 'abc', 'stages': [['forecast_publish', 1.5]]}
+
+    payload = write_frame(time_series(), wire_format, header=header, trace=trace)
+    payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+    view = TimeSeriesView.from_payload(payload, date_column=DATE_COLUMN)
+
+    assert view.header == header
+    assert view.trace == trace
+    assert_same_series(read_frame(payload, date_column=DATE_COLUMN), time_series(), rtol=TOLERANCES[wire_format])
+
+
+@pytest.mark.parametrize('wire_format', WIRE_FORMATS)
+def test_records_round_trip(wire_format):
+    frame = time_series()[['p_battery']]
+
+    payload = write_frame(frame, wire_format, orient='records')
+    payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+
+    view = TimeSeriesView.from_payload(payload, date_column=DATE_COLUMN)
+    assert view.first('p_battery') == pytest.approx(frame['p_battery'].iloc[0], rel=TOLERANCES[wire_format])
+    assert len(view) == len(frame)
+
+
+def test_irregular_and_integer_columns():
+    time_stamps = pd.DatetimeIndex(['2021-01-01 00:00', '2021-01-01 00:15', '2021-01-01 01:00'], name=DATE_COLUMN)
+    frame = pd.DataFrame({'power': [1.0, 2.0, 3.0], 'count': np.array([1, 2, 3], dtype=np.int32)}, index=time_stamps)
+
+    received = decode_frame(encode_frame(frame))
+
+    assert_same_series(received, frame)
+    assert received['count'].dtype == np.int32
+
+
+def test_series_is_one_column():
+    series = time_series()['forecast']
+
+    received = decode_frame(encode_frame(series))
+
+    assert list(received.columns) == ['forecast']
+    np.testing.assert_array_equal(received['forecast'].values, series.values)
+
+
+def windows(count, window=96):
+    """Rolling forecast windows, shifted by one step"""
+    frame = time_series(periods=window + count)
+
+    return [frame.iloc[i:i + window] for i in range(count)]
+
+
+def test_stream_rebuilds_the_window():
+    encoder = StreamEncoder(keyframe_interval=10)
+    decoder = StreamDecoder()
+
+    for frame in windows(25):
+        payload = encoder.encode(frame)
+        assert is_stream(payload)
+        assert_same_series(decoder.decode(payload).to_frame(), frame)
+
+    assert (decoder.keyframes, decoder.deltas, decoder.dropped) == (3, 22, 0)
+
+
+def test_stream_resyncs_on_keyframe_after_a_dropped_delta():
+    encoder = StreamEncoder(keyframe_interval=5)
+    decoder = StreamDecoder()
+    payloads = [encoder.encode(frame) for frame in windows(12)]
+    frames = windows(12)
+
+    assert_same_series(decoder.decode(payloads[0]).to_frame(), frames[0])
+    assert_same_series(decoder.decode(payloads[1]).to_frame(), frames[1])
+    # payloads[2] is lost: the deltas are dropped until the next keyframe (payloads[5])
+    for payload in payloads[3:5]:
+        assert decoder.decode(payload) is None
+    for (payload, frame) in zip(payloads[5:], frames[5:]):
+        assert_same_series(decoder.decode(payload).to_frame(), frame)
+
+    assert decoder.dropped == 2
+
+
+def test_stream_keyframe_when_the_window_is_not_a_shift():
+    encoder = StreamEncoder(keyframe_interval=96)
+    decoder = StreamDecoder()
+    (first, second) = windows(2)
+    second = second.copy()
+    second.iloc[0, 0] += 1.0  # Updated value in the overlap
+
+    decoder.decode(encoder.encode(first))
+    assert_same_series(decoder.decode(encoder.encode(second)).to_frame(), second)
+    assert decoder.keyframes == 2